@@ -2,17 +2,15 @@
 
 from urllib import parse
 
-from flask import Response
 from flask_restx import Resource
 from sqlalchemy import or_
 from api.restplus import api
-import json
 
 from db.germline_set_db import GermlineSet
 from head import db
-from ogrdb.germline_set.to_airr import germline_set_to_airr
-from ogrdb.germline_set.descs_to_fasta import descs_to_fasta
-from db.species_lookup_db import SpeciesLookup
+from ogrdb.germline_set.to_airr import stream_germline_set_to_airr
+from ogrdb.germline_set.germline_set_service import resolve_germline_set, send_germline_set, SET_NOT_FOUND, VERSION_NOT_FOUND, SUPERCEDED, \
+    RENDER_FAILED
 
 
 ns = api.namespace('germline', description='Germline sets available from OGRDB')
@@ -79,7 +77,7 @@ class versionsApi(Resource):
         set, which should normally be used for AIRR-seq analysis). 
         """
 
-        q = db.session.query(GermlineSet).filter(GermlineSet.germline_set_id == germline_set_id)
+        q = db.session.query(GermlineSet.id, GermlineSet.species).filter(GermlineSet.germline_set_id == germline_set_id)
 
         if release_version == 'published' or release_version == 'latest':
             q = q.filter(GermlineSet.status == 'published')
@@ -87,10 +85,10 @@ class versionsApi(Resource):
             q = q.filter(GermlineSet.release_version == release_version)
 
         germline_set = q.one_or_none()
-        if not format:
-            format = 'airr_ex' if 'Homo sapiens' in germline_set.species else 'airr'
 
         if germline_set:
+            if not format:
+                format = 'airr_ex' if 'Homo sapiens' in germline_set.species else 'airr'
             return download_germline_set_by_id(germline_set.id, format)
         else:
             return {'error': 'Set not found'}, 404
@@ -124,88 +122,28 @@ def download_set_by_name(species, subspecies, germline_set_name, version, format
     subspecies = parse.unquote(parse.unquote(subspecies)) if subspecies else None
     germline_set_name = parse.unquote(parse.unquote(germline_set_name))
 
-    # check for common species name
+    resolution = resolve_germline_set(species, subspecies, germline_set_name, version)
 
-    requested_species = species
-
-    q = db.session.query(SpeciesLookup).filter(SpeciesLookup.common == species).one_or_none()
-    if q:
-        species = q.binomial
-
-    q = db.session.query(
-            GermlineSet.id,
-        )\
-        .filter(GermlineSet.species == species)\
-        .distinct()
-    
-    result = q.all()
-
-    if not result:
-        return {'error': 'Species not found'}, 404
-
-    if subspecies:
-        q = q.filter(GermlineSet.species_subgroup == subspecies)
-
-
-    if not result:
-        return {'error': 'Subspecies not found'}, 404
-
-    result = q.all()
-
-    q = q.filter(GermlineSet.germline_set_name == germline_set_name)
-    
-    result = q.all()
-
-    if not result:
-        return {'error': 'Germline set name not found'}, 404
-
-    if version == 'published' or version == 'latest':
-        q = q.filter(GermlineSet.status == 'published')
+    if resolution.set_id:
+        return download_germline_set_by_id(resolution.set_id, format, species)
+    elif resolution.error == SUPERCEDED:
+        return {'error': VERSION_NOT_FOUND}, 404
     else:
-        if not version.isdigit():
-            return {'error': 'Invalid release_version'}, 404
-        
-        q = q.filter(GermlineSet.release_version == int(version))\
-            .filter(or_(GermlineSet.status == 'published', GermlineSet.status == 'superceded'))
+        return {'error': resolution.error}, 404
 
-    result = q.one_or_none()
 
-    if result:
-        return download_germline_set_by_id(result[0], format, requested_species)
-    else:
-        return {'error': 'Germline set version not found'}, 404
+def render_airr(germline_set, extend, taxonomy):
+    return stream_germline_set_to_airr(germline_set, extend, taxonomy, indent=4)
 
-def download_germline_set_by_id(germline_set_id, format, use_species_name=None):
-    if format not in ['gapped', 'ungapped', 'airr', 'gapped_ex', 'ungapped_ex', 'airr_ex']:
-        return {'error': 'invalid format specified'}, 404
 
-    q = db.session.query(GermlineSet).filter(GermlineSet.id == germline_set_id)
-    germline_set = q.one_or_none()
+def download_germline_set_by_id(germline_set_id, format, use_species_name=None):
+    response, error = send_germline_set(germline_set_id, format, render_airr, airr_variant='v1', species_name=use_species_name)
 
-    if not germline_set:
+    if error == SET_NOT_FOUND:
         return {'error': 'Set not found'}, 404
+    elif error == RENDER_FAILED:
+        return {'error': error}, 500
+    elif error:
+        return {'error': error}, 404
 
-    if len(germline_set.gene_descriptions) < 1:
-        return {'error': 'No sequences to download'}, 404
-    
-    extend = False
-    if '_ex' in format:
-        if 'Homo sapiens' not in germline_set.species:
-            return {'error': 'Set not found'}, 404
-        extend = True
-
-    species_for_file = use_species_name if use_species_name else germline_set.species
-    species_for_file = species_for_file.replace(' ', '_')
-
-    if 'airr' in format:
-        taxonomy = db.session.query(SpeciesLookup.ncbi_taxon_id).filter(SpeciesLookup.binomial == germline_set.species).one_or_none()
-        taxonomy = taxonomy[0] if taxonomy else 0
-        dl = germline_set_to_airr(germline_set, extend, taxonomy)
-        dl = json.dumps(dl, indent=4)
-        filename = '%s_%s_rev_%d%s.json' % (species_for_file, germline_set.germline_set_name, germline_set.release_version, '_ex' if 'ex' in format else '')
-    else:
-        dl = descs_to_fasta(germline_set.gene_descriptions, format, fake_allele=True, extend=extend)
-        filename = '%s_%s_rev_%d_%s.fasta' % (species_for_file, germline_set.germline_set_name, germline_set.release_version, format)
-    
-    return Response(dl, mimetype="application/octet-stream", headers={"Content-disposition": "attachment; filename=%s" % filename})
-
+    return response
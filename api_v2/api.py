@@ -1,15 +1,22 @@
-from flask import Blueprint, jsonify, Response
+import functools
+import math
+
+from flask import Blueprint, jsonify, current_app, request
 from pydantic import BaseModel
 from api_v2.models import ErrorResponse, ServiceInfoObject, Contact, License, InfoObject, Ontology, GermlineSpeciesResponseItem, \
     GermlineSpeciesResponse, VersionsResponse, GermlineSetResponse, SpeciesSubgroupType, Locus, \
     AlleleDescription, SequenceType, InferenceType, SequenceDelineationV, Strand, UnrearrangedSequence, RearrangedSequence, \
     Derivation, ObservationType, CurationalTag, SpeciesResponse, Acknowledgement
 from api_v2.models import GermlineSet as GS
+from api_v2.download_cache import store_download, is_cacheable
 from db.germline_set_db import GermlineSet
 from db.species_lookup_db import SpeciesLookup
 from head import db
-from ogrdb.germline_set.to_airr import germline_set_to_airr
-from ogrdb.germline_set.descs_to_fasta import descs_to_fasta
+from ogrdb.germline_set.to_airr import airr_germline_set, iter_airr_allele_descriptions, stream_json_with_list
+from ogrdb.germline_set.germline_set_loader import load_germline_set
+from ogrdb.germline_set.germline_set_service import resolve_germline_set, send_germline_set, render_germline_set, germline_set_filename, \
+    download_cache_format, resolve_species, DOWNLOAD_FORMATS, SET_NOT_FOUND, SPECIES_NOT_FOUND, SUPERCEDED, RENDER_FAILED
+from ogrdb.release_diff import germline_set_diff
 from sqlalchemy import or_
 from datetime import datetime
 from pydantic.fields import FieldInfo
@@ -230,65 +237,35 @@ def get_germline_sets_by_id_and_version(germline_set_id, release_version, format
     """
     try:
         species_id, germline_set_name, species_subgroup = parse_germline_set_id(germline_set_id)
-        species = db.session.query(SpeciesLookup.binomial).filter(SpeciesLookup.ncbi_taxon_id == species_id).one_or_none()[0]
-
-        q = db.session.query(GermlineSet) \
-            .filter(GermlineSet.species == species) \
-            .filter(GermlineSet.germline_set_name == germline_set_name)
-        
-        if species_subgroup:
-            q = q.filter(GermlineSet.species_subgroup == species_subgroup)
-
-        if release_version == 'published' or release_version == 'latest':
-            q = q.filter(GermlineSet.status == 'published')
-        else:
-            q = q.filter(GermlineSet.release_version == release_version)
-
-        germline_set = q.one_or_none()
+        resolution = resolve_germline_set(species_id, species_subgroup, germline_set_name, release_version)
 
-        if not germline_set:
-            if release_version == 'published' or release_version == 'latest':
-                q = db.session.query(GermlineSet) \
-                    .filter(GermlineSet.species == species) \
-                    .filter(GermlineSet.germline_set_name == germline_set_name) \
-                    .filter(GermlineSet.status == 'superceded')
-                    
-                if species_subgroup:
-                    q = q.filter(GermlineSet.species_subgroup == species_subgroup)
-
-                germline_sets = q.all()
-
-                if germline_sets:
-                    # Find the most recent version
-                    germline_set = max(germline_sets, key=lambda x: x.release_version)
-                    error_response = {'message': "This set has been superceded: there is no current published version. The most recent superceded version is {}".format(germline_set.release_version)}
-                    return jsonify(error_response), 404
+        if resolution.error == SUPERCEDED:
+            error_response = {'message': "This set has been superceded: there is no current published version. The most recent superceded version is {}".format(resolution.latest_version)}
+            return jsonify(error_response), 404
 
+        if not resolution.set_id:
             error_response = {'message': "Set not found"}
             return jsonify(error_response), 404
 
         if not format:
-            format = 'airr_ex' if 'Homo sapiens' in germline_set.species else 'airr'
+            format = 'airr_ex' if 'Homo sapiens' in resolution.species else 'airr'
 
-        if germline_set:
-            res = download_germline_set_by_id(germline_set.id, format)
-            return res
+        return download_germline_set_by_id(resolution.set_id, format)
 
-        else:
-            error_response = {'message': str(e)}
-            return jsonify(error_response), 500
-    
     except Exception as e:
         error_response = {'message': str(e)}
         return jsonify(error_response), 500
 
 
-
 @api_bp.route('/germline/set/<germline_set_id>/versions', methods=['GET'])
 def list_all_versions_of_germline_set(germline_set_id):
     try:
         species_id, germline_set_name, species_subgroup = parse_germline_set_id(germline_set_id)
-        species = db.session.query(SpeciesLookup.binomial).filter(SpeciesLookup.ncbi_taxon_id == species_id).one_or_none()[0]
+        species = resolve_species(species_id)
+
+        if species is None:
+            error_response = ErrorResponse(message=SPECIES_NOT_FOUND)
+            return jsonify(error_response.model_dump()), 404
 
         q = db.session.query(GermlineSet) \
             .filter(GermlineSet.species == species) \
@@ -313,10 +290,83 @@ def list_all_versions_of_germline_set(germline_set_id):
         return jsonify(error_response), 500
 
 
+@api_bp.route('/germline/set/<germline_set_id>/changelog', methods=['GET'])
+def get_germline_set_changelog(germline_set_id):
+    """
+    List the changes made in each release of a germline set.
+
+    Args:
+        germline_set_id: The ID of the germline set.
+        since: (query parameter, optional) only list releases after this version
+
+    Returns:
+        Response containing, for each release, the allele descriptions added, removed and changed since the
+        previous release.
+    """
+    try:
+        species_id, germline_set_name, species_subgroup = parse_germline_set_id(germline_set_id)
+        species = db.session.query(SpeciesLookup.binomial).filter(SpeciesLookup.ncbi_taxon_id == species_id).one_or_none()[0]
+
+        q = db.session.query(GermlineSet) \
+            .filter(GermlineSet.species == species) \
+            .filter(GermlineSet.germline_set_name == germline_set_name) \
+            .filter(GermlineSet.status.in_(['published', 'superceded']))
+
+        if species_subgroup:
+            q = q.filter(GermlineSet.species_subgroup == species_subgroup)
+
+        since = request.args.get('since')
+        if since is not None:
+            try:
+                since = float(since)
+                if not math.isfinite(since):
+                    raise ValueError()
+            except ValueError:
+                error_response = ErrorResponse(message='Invalid since: must be a release version number')
+                return jsonify(error_response.model_dump()), 400
+            q = q.filter(GermlineSet.release_version > since)
+
+        germline_sets = q.order_by(GermlineSet.release_version).all()
+
+        if not germline_sets and since is None:
+            error_response = {'message': "Set not found"}
+            return jsonify(error_response), 404
+
+        def allele_ref(desc):
+            return {'allele_description_id': 'OGRDB:' + desc['description_id'], 'label': desc['sequence_name'], 'release_version': desc['release_version']}
+
+        changes = []
+        for germline_set in germline_sets:
+            diff = germline_set_diff(germline_set)
+            changes.append({
+                'release_version': germline_set.release_version,
+                'previous_version': diff['prev_version'],
+                'release_date': germline_set.release_date.strftime('%Y-%m-%d') if germline_set.release_date else None,
+                'added': [allele_ref(desc) for desc in diff['added']],
+                'removed': [allele_ref(desc) for desc in diff['removed']],
+                'changed': [{
+                    'allele_description_id': 'OGRDB:' + desc['description_id'],
+                    'label': desc['sequence_name'],
+                    'previous_version': desc['prev_version'],
+                    'release_version': desc['version'],
+                    'sequence_changed': desc['sequence_changed'],
+                } for desc in diff['changed']],
+            })
+
+        return jsonify({'germline_set_id': germline_set_id, 'changes': changes}), 200
+
+    except Exception as e:
+        error_response = {'message': str(e)}
+        return jsonify(error_response), 500
+
+
 def download_germline_set_by_id(germline_set_id, format):
     """
     Download a germline set by ID and format.
 
+    Published and superceded releases are served from the download cache, with an ETag. Renderings that
+    are not yet in the cache are added to it.
+
     Args:
         germline_set_id: The ID of the germline set.
         format: The format of the germline set (e.g., gapped, ungapped, airr).
@@ -324,57 +374,96 @@ def download_germline_set_by_id(germline_set_id, format):
     Returns:
         Response containing the germline set data.
     """
-    if format not in ['gapped', 'ungapped', 'airr', 'gapped_ex', 'ungapped_ex', 'airr_ex']:
-        return {'error': 'invalid format specified'}, 400
-
-    q = db.session.query(GermlineSet).filter(GermlineSet.id == germline_set_id)
-    germline_set = q.one_or_none()
+    try:
+        response, error = send_germline_set(germline_set_id, format, render_airr_germline_set)
+    except Exception as e:
+        return {'message': f'Error constructing response: {e}'}, 500
 
-    if not germline_set:
+    if error == SET_NOT_FOUND:
         return {'error': 'Set not found'}, 400
+    elif error == RENDER_FAILED:
+        return {'message': error}, 500
+    elif error:
+        return {'error': error}, 400
 
-    if len(germline_set.gene_descriptions) < 1:
-        return {'error': 'No sequences to download'}, 400
+    return response
 
-    extend = False
-    if '_ex' in format:
-        if 'Homo sapiens' not in germline_set.species:
-            return {'error': 'Set not found'}, 400
-        extend = True
 
-    if 'airr' in format:
-        taxonomy = db.session.query(SpeciesLookup.ncbi_taxon_id).filter(SpeciesLookup.binomial == germline_set.species).one_or_none()
-        taxonomy = taxonomy[0] if taxonomy else 0
+def render_airr_germline_set(germline_set, extend, taxonomy):
+    """
+    Render a germline set as an API v2 GermlineSetResponse.
 
-        dl = germline_set_to_airr(germline_set, extend, taxonomy)
+    The rendering is streamed: the set-level fields are converted and serialised with allele_descriptions set
+    to null. Allele descriptions are then converted individually and spliced in as they are serialised.
+    With API_V2_TRUSTED_SERIALIZATION set, the models are validated directly from the to_airr output (see
+    trusted_record).
 
-        try:
-            germline_set_response = convert_to_GermlineSetResponse_obj(dl)
-            germline_set_response = germline_set_response.model_dump_json(by_alias=True)  # Convert the object to a dictionary
-        except Exception as e:
-            return {'message': f'Error constructing response: {e}'}, 500
-        
-        filename = '%s_%s_rev_%d%s.json' % (germline_set.species, germline_set.germline_set_name, germline_set.release_version, '_ex' if 'ex' in format else '')
+    Args:
+        germline_set: The GermlineSet to render, as returned by load_germline_set.
+        extend: True to render the extended set.
+        taxonomy: NCBI taxon id of the set's species.
 
-    else:
-        dl = descs_to_fasta(germline_set.gene_descriptions, format, fake_allele=True, extend=extend)
-        filename = '%s_%s_rev_%d_%s.fasta' % (germline_set.species, germline_set.germline_set_name, germline_set.release_version, format)
-        germline_set_response = dl
+    Returns:
+        An iterable yielding the rendered content.
+    """
+    trusted = trusted_serialization()
+    germline_set_response = convert_to_GermlineSetResponse_obj(airr_germline_set(germline_set, None, extend, taxonomy), trusted)
+    germline_set_response = germline_set_response.model_dump_json(by_alias=True)
+    allele_descriptions = (allele_description_json(ad, trusted) for ad in iter_airr_allele_descriptions(germline_set, extend, taxonomy))
+    return stream_json_with_list(germline_set_response, 'allele_descriptions', allele_descriptions)
 
-    return Response(germline_set_response, mimetype="application/octet-stream", headers={"Content-disposition": "attachment; filename=%s" % filename})
 
+def trusted_serialization():
+    """
+    Returns True if trusted serialization has been enabled with the API_V2_TRUSTED_SERIALIZATION config option.
+    """
+    return bool(current_app.config.get('API_V2_TRUSTED_SERIALIZATION', False))
+
+
+def prerender_germline_set(germline_set):
+    """
+    Render a newly published germline set in every download format and store the results in the download cache.
+    Failures are logged rather than raised, so that they do not interfere with publication: any format that
+    could not be rendered here will be rendered on first request.
+
+    Args:
+        germline_set: The GermlineSet that has just been published.
+    """
+    if not is_cacheable(germline_set):
+        return
+
+    germline_set = load_germline_set(germline_set.id)
 
-def convert_to_GermlineSetResponse_obj(dl):
+    if len(germline_set.gene_descriptions) < 1:
+        return
+
+    for format in DOWNLOAD_FORMATS:
+        if '_ex' in format and 'Homo sapiens' not in germline_set.species:
+            continue
+
+        try:
+            germline_set_response = render_germline_set(germline_set, format, render_airr_germline_set)
+            store_download(germline_set, download_cache_format(format), germline_set_response, germline_set_filename(germline_set, format))
+        except Exception as e:
+            current_app.logger.error('Error caching %s download of germline set %s: %s' % (format, germline_set.germline_set_id, e))
+
+
+def convert_to_GermlineSetResponse_obj(dl, trusted=False):
     """
     Convert the downloaded germline set data to a GermlineSetResponse object.
 
     Args:
         dl: The downloaded germline set data.
+        trusted: If True, validate the response directly from the data (see trusted_record).
 
     Returns:
         GermlineSetResponse object.
     """
     service_info_obj = create_info_object()
+
+    if trusted:
+        return GermlineSetResponse.model_validate({'Info': service_info_obj, 'GermlineSet': trusted_records(GS, dl['GermlineSet'])})
+
     germline_set_list = []
 
     for i in range(len(dl["GermlineSet"])):
@@ -397,7 +486,7 @@ def convert_to_GermlineSetResponse_obj(dl):
             species_subgroup=temp_dl['species_subgroup'],
             species_subgroup_type=temp_dl['species_subgroup_type'],
             locus=Locus(temp_dl['locus']),
-            allele_descriptions=create_allele_description_list(temp_dl['allele_descriptions']),
+            allele_descriptions=create_allele_description_list(temp_dl['allele_descriptions']) if temp_dl['allele_descriptions'] is not None else None,
             curation=temp_dl.get('curation', None)
         )
         germline_set_list.append(germline_set)
@@ -539,6 +628,25 @@ def create_allele_description_list(allele_descriptions):
     return allele_description_list
 
 
+def allele_description_json(allele_description, trusted=False):
+    """
+    Convert a single allele description from to_airr to its JSON serialisation.
+
+    Args:
+        allele_description: The allele description data.
+        trusted: If True, validate the AlleleDescription directly from the data (see trusted_record).
+
+    Returns:
+        The serialised AlleleDescription.
+    """
+    if trusted:
+        allele_description_obj = AlleleDescription.model_validate(trusted_record(AlleleDescription, allele_description))
+    else:
+        allele_description_obj = create_allele_description_list([allele_description])[0]
+
+    return allele_description_obj.model_dump_json(by_alias=True)
+
+
 def create_sequence_delineationV_list(v_gene_delineations):
     """
     Create a list of sequence delineations from the given data.
@@ -704,6 +812,41 @@ def get_default_value(field_type: Any) -> Any:
     return None
 
 
+# Default types whose values are made afresh each time they are used
+
+FRESH_DEFAULTS = {'list': list, 'dict': dict, 'datetime': datetime.now}
+
+
+@functools.cache
+def required_field_defaults(model_cls: type[BaseModel]) -> dict:
+    """
+    Find the fields of a model that must be given a value, and can take a default. Computed once for each model.
+
+    Args:
+        model_cls: The Pydantic model class.
+
+    Returns:
+        Dict of field name to the field's default value, for required fields that are not Optional and have a
+        default value. Defaults that must be made afresh for each record (lists, dicts and datetimes) are given
+        as a function that makes them.
+    """
+    field_defaults = {}
+
+    for field_name, field_info in model_cls.model_fields.items():
+        if is_required(field_info):
+            field_type = model_cls.__annotations__[field_name]
+            if field_type.startswith('Optional'):
+                continue
+            if field_type in FRESH_DEFAULTS:
+                field_defaults[field_name] = FRESH_DEFAULTS[field_type]
+                continue
+            default = get_default_value(field_type)
+            if default is not None:
+                field_defaults[field_name] = default
+
+    return field_defaults
+
+
 def fill_missing_required_fields(model_cls: type[BaseModel], data: dict) -> dict:
     """
     Fill missing required fields in the given data with default values.
@@ -717,15 +860,9 @@ def fill_missing_required_fields(model_cls: type[BaseModel], data: dict) -> dict
     """
     filled_data = data.copy()
 
-    for field_name, field_info in model_cls.model_fields.items():
+    for field_name, default in required_field_defaults(model_cls).items():
         if field_name in data and data[field_name] is None:
-            if is_required(field_info):
-                field_type = model_cls.__annotations__[field_name]
-                if field_type.startswith('Optional'):
-                    continue
-                default_value = get_default_value(field_type)
-                if default_value is not None:
-                    filled_data[field_name] = default_value
+            filled_data[field_name] = default() if callable(default) else default
 
     return filled_data
 
@@ -740,7 +877,169 @@ def is_required(field_info: FieldInfo) -> bool:
     Returns:
         Boolean indicating if the field is required.
     """
-    if 'required=True' in str(field_info):
-        return True
-    
-    return False
\ No newline at end of file
+    return field_info.is_required()
+
+
+# Trusted serialization
+#
+# The create_* functions above build every model by hand from the to_airr output. When that output is trusted,
+# each record is instead mapped to its model's fields by a table compiled once, below, and the resulting tree of
+# dicts is validated with a single model_validate call. Each entry of the table gives a field and a function that
+# reads its value from the record, making the same conversions as the create_* functions (dates, enum names and
+# the defaults they substitute), so that the validated models, and their serialisation, are the same.
+
+def trusted_record(model_cls: type[BaseModel], record: dict) -> dict:
+    """
+    Map a to_airr record to the fields of a model, ready for model_validate.
+
+    Args:
+        model_cls: The Pydantic model class: one of those in TRUSTED_FIELDS.
+        record: The to_airr record.
+
+    Returns:
+        Dict of field name to value.
+    """
+    record = fill_missing_required_fields(model_cls, record)
+    return {field_name: read(record) for field_name, read in TRUSTED_FIELDS[model_cls]}
+
+
+def trusted_records(model_cls: type[BaseModel], records: list, **fields) -> list:
+    """
+    Map a list of to_airr records with trusted_record, adding the given fields to each.
+    """
+    return [dict(trusted_record(model_cls, record), **fields) for record in records]
+
+
+def trusted_field(key: str, convert=None, default: Any = None):
+    """
+    Make the reader for a field: the value of key in the record, passed through convert if it is not None,
+    and otherwise replaced by the default.
+    """
+    def read(record):
+        value = record.get(key)
+        if value is None:
+            return default
+        return convert(value) if convert is not None else value
+
+    return read
+
+
+def trusted_date(date_format: str):
+    return lambda value: datetime.strptime(value, date_format)
+
+
+def trusted_acknowledgements(acknowledgements):
+    return trusted_records(Acknowledgement, acknowledgements) or None
+
+
+def trusted_curational_tags(curational_tags):
+    return [tag for tag in curational_tags if tag is not None] or None
+
+
+TRUSTED_FIELDS = {
+    GS: tuple((field_name, trusted_field(field_name, convert)) for field_name, convert in (
+        ('germline_set_id', None),
+        ('author', None),
+        ('lab_name', None),
+        ('lab_address', None),
+        ('acknowledgements', trusted_acknowledgements),
+        ('release_version', None),
+        ('release_description', None),
+        ('release_date', trusted_date('%Y-%m-%d')),
+        ('germline_set_name', None),
+        ('germline_set_ref', None),
+        ('pub_ids', None),
+        ('species', None),
+        ('species_subgroup', None),
+        ('species_subgroup_type', None),
+        ('locus', None),
+        ('allele_descriptions', lambda value: trusted_records(AlleleDescription, value)),
+        ('curation', None),
+    )),
+    Acknowledgement: (
+        ('acknowledgement_id', trusted_field('acknowledgement_id')),
+        ('name', trusted_field('name')),
+        ('institution_name', trusted_field('institution_name')),
+        ('orcid_id', trusted_field('ORCID_id')),
+    ),
+    AlleleDescription: tuple((field_name, trusted_field(field_name, convert)) for field_name, convert in (
+        ('allele_description_id', None),
+        ('allele_description_ref', None),
+        ('maintainer', None),
+        ('acknowledgements', trusted_acknowledgements),
+        ('lab_address', None),
+        ('release_version', None),
+        ('release_date', trusted_date('%d-%b-%Y')),
+        ('release_description', None),
+        ('label', None),
+        ('sequence', None),
+        ('coding_sequence', None),
+        ('aliases', None),
+        ('locus', None),
+        ('chromosome', None),
+        ('sequence_type', None),
+        ('functional', None),
+        ('inference_type', enum_to_snake_case),
+        ('species', None),
+        ('species_subgroup', None),
+        ('species_subgroup_type', None),
+        ('subgroup_designation', None),
+        ('gene_designation', None),
+        ('allele_designation', None),
+        ('j_codon_frame', None),
+        ('gene_start', None),
+        ('gene_end', None),
+        ('utr_5_prime_start', None),
+        ('utr_5_prime_end', None),
+        ('leader_1_start', None),
+        ('leader_1_end', None),
+        ('leader_2_start', None),
+        ('leader_2_end', None),
+        ('v_rs_start', None),
+        ('v_rs_end', None),
+        ('d_rs_3_prime_start', None),
+        ('d_rs_3_prime_end', None),
+        ('d_rs_5_prime_start', None),
+        ('d_rs_5_prime_end', None),
+        ('j_cdr3_end', None),
+        ('j_rs_start', None),
+        ('j_rs_end', None),
+        ('j_donor_splice', None),
+        ('v_gene_delineations', lambda value: trusted_records(SequenceDelineationV, value)),
+        ('paralogs', None),
+        ('curation', None),
+        ('curational_tags', trusted_curational_tags),
+    )) + (
+        # support sequences take the curation of the allele description
+        ('unrearranged_support', lambda record: trusted_records(UnrearrangedSequence, record['unrearranged_support'] or [], curation=record['curation'])),
+        ('rearranged_support', lambda record: trusted_records(RearrangedSequence, record['rearranged_support'] or [], curation=record['curation'])),
+    ),
+    SequenceDelineationV: (
+        ('sequence_delineation_id', trusted_field('sequence_delineation_id')),
+        ('delineation_scheme', trusted_field('delineation_scheme')),
+    ) + tuple((field_name, trusted_field(field_name, default=0)) for field_name in (
+        'fwr1_start', 'fwr1_end', 'cdr1_start', 'cdr1_end', 'fwr2_start', 'fwr2_end', 'cdr2_start', 'cdr2_end', 'fwr3_start', 'fwr3_end', 'cdr3_start'
+    )),
+    UnrearrangedSequence: (
+        ('sequence_id', trusted_field('sequence_id')),
+        ('sequence', trusted_field('sequence')),
+        ('repository_name', trusted_field('repository_name')),
+        ('repository_ref', trusted_field('repository_ref')),
+        ('patch_no', trusted_field('patch_no')),
+        ('gff_seqid', trusted_field('gff_seqid', default='')),
+        ('gff_start', trusted_field('gff_start')),
+        ('gff_end', trusted_field('gff_end')),
+        ('strand', trusted_field('strand', default='+')),
+    ),
+    RearrangedSequence: (
+        ('sequence_id', trusted_field('sequence_id')),
+        ('sequence', trusted_field('sequence')),
+        ('derivation', trusted_field('derivation')),
+        ('observation_type', trusted_field('observation_type', enum_to_snake_case)),
+        ('repository_name', trusted_field('repository_name')),
+        ('repository_ref', trusted_field('repository_ref')),
+        ('deposited_version', trusted_field('deposited_version')),
+        ('sequence_start', trusted_field('sequence_start')),
+        ('sequence_end', trusted_field('sequence_end')),
+    ),
+}
@@ -0,0 +1,115 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Content-addressed, on-disk cache of rendered germline set downloads
+#
+# A published release never changes, so each (set id, release_version, format) is rendered once and stored
+# under the sha256 digest of its content. An index file per (set id, release_version, format) points at the
+# digest. The digest doubles as the ETag when the file is served.
+#
+# The cache lives in API_V2_CACHE_PATH if that is configured, otherwise in a subdirectory of the attachment path.
+
+import hashlib
+import os
+import tempfile
+
+import head
+from head import app
+
+CACHEABLE_STATUSES = ('published', 'superceded')
+
+
+def get_cache_dir():
+    if app.config.get('API_V2_CACHE_PATH'):
+        return app.config['API_V2_CACHE_PATH']
+
+    return os.path.join(head.attach_path, 'api_v2_cache')
+
+
+def is_cacheable(germline_set):
+    return germline_set.status in CACHEABLE_STATUSES and germline_set.release_version
+
+
+def _index_path(set_id, release_version, format):
+    return os.path.join(get_cache_dir(), 'index', '%s_%s_%s' % (set_id, release_version, format))
+
+
+def _object_path(digest):
+    return os.path.join(get_cache_dir(), 'objects', digest[:2], digest)
+
+
+def _atomic_write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+
+    with open(tmp, 'wb') as fo:
+        fo.write(content)
+
+    os.replace(tmp, path)
+
+
+def get_cached_download(germline_set, format):
+    """
+    Look up a previously rendered download
+
+    Returns:
+        (path, digest, filename), or None if the set is not cacheable or has not been rendered in this format
+    """
+    if not is_cacheable(germline_set):
+        return None
+
+    try:
+        with open(_index_path(germline_set.id, germline_set.release_version, format), 'r') as fi:
+            digest, filename = fi.read().split('\n', 1)
+    except (OSError, ValueError):
+        return None
+
+    path = _object_path(digest)
+
+    if not os.path.isfile(path):
+        return None
+
+    return path, digest, filename
+
+
+def store_download(germline_set, format, content, filename):
+    """
+    Store a rendered download. Identical content is only stored once, whichever sets refer to it
+
+    Args:
+        content: the rendering, as str or bytes, or as an iterable of str or bytes chunks. Chunks are written
+                 to disk as they arrive, so that a streamed rendering is never held in memory in full
+
+    Returns:
+        (path, digest, filename)
+    """
+    if isinstance(content, (str, bytes)):
+        content = [content]
+
+    tmp_dir = os.path.join(get_cache_dir(), 'objects')
+    os.makedirs(tmp_dir, exist_ok=True)
+    digest = hashlib.sha256()
+
+    with tempfile.NamedTemporaryFile(dir=tmp_dir, suffix='.tmp', delete=False) as fo:
+        try:
+            for chunk in content:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                digest.update(chunk)
+                fo.write(chunk)
+        except:
+            fo.close()
+            os.remove(fo.name)
+            raise
+
+    digest = digest.hexdigest()
+    path = _object_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(fo.name, path)
+
+    _atomic_write(_index_path(germline_set.id, germline_set.release_version, format), ('%s\n%s' % (digest, filename)).encode('utf-8'))
+
+    return path, digest, filename
@@ -44,6 +44,21 @@ from ogrdb.index.index_routes import *
 from custom_logging import init_logging
 init_logging(app, mail)
 
+from query_stats import init_query_stats
+init_query_stats(app, head.db)
+
+from mail import init_mail_dispatcher
+init_mail_dispatcher(app)
+
+from ogrdb.index.landing_snapshot import init_landing_snapshot
+init_landing_snapshot(app)
+
+from db.duplicate_mapping import init_duplicate_mapping
+init_duplicate_mapping(app, head.db)
+
+from genotype_stats import init_genotype_stats
+init_genotype_stats(head.db)
+
 # Read IMGT germline reference sets
 
 from imgt.imgt_ref import init_imgt_ref, init_igpdb_ref
@@ -10,7 +10,7 @@ from flask import has_request_context
 from flask_mail import email_dispatched
 import sys
 
-from mail_log_handler import FlaskMailLogHandler
+from mail_log_handler import init_mail_log_handler
 from mail import log_mail
 from security_log_handler import init_security_logging
 
@@ -40,9 +40,8 @@ def init_logging(app, mail):
         pydevd.settrace('127.0.0.1', port=30000, stdoutToServer=True, stderrToServer=True)
 
     if app.config['MAIL_LOG']:
-        mail_handler = FlaskMailLogHandler(mail, 'william@lees.org.uk', ['william@lees.org.uk'], 'Error from OGRDB')
-        mail_handler.setLevel(logging.ERROR)
-        mail_handler.setFormatter(formatter)
+        mail_handler = init_mail_log_handler(mail, 'william@lees.org.uk', ['william@lees.org.uk'], 'Error from OGRDB',
+                                             logging.ERROR, formatter, window=app.config.get('MAIL_LOG_WINDOW', 60))
         root.addHandler(mail_handler)
 
     email_dispatched.connect(log_mail)
@@ -8,6 +8,7 @@
 
 from db.submission_db import *
 from sequence_format import check_duplicate
+from permission_context import get_permission_context
 
 class GeneDescriptionMixin:
     def delete_dependencies(self, db):
@@ -17,24 +18,24 @@ class GeneDescriptionMixin:
             db.session.delete(d)
 
     def can_see(self, user):
-        return(self.status == 'published' or self.status == 'superceded' or (user and
-            user.is_authenticated and
-               #(user.has_role('Admin') or
-                user.has_role(self.species)))
+        user = get_permission_context(user)
+        return(self.status == 'published' or self.status == 'superceded' or
+               #user.has_role('Admin') or
+               user.has_role(self.species))
 
     def can_edit(self, user):
-        return(user and user.is_authenticated and
-            ((user.has_role('AdminEdit') or
-            (user.has_role(self.species) and self.status == 'draft'))))
+        user = get_permission_context(user)
+        return(user.has_role('AdminEdit') or
+            (user.has_role(self.species) and self.status == 'draft'))
 
     def can_draft(self, user):
-        return(user and user.is_authenticated and
-            #(user.has_role('Admin') or
-             (user.has_role(self.species) and self.status == 'published'))
+        user = get_permission_context(user)
+        return(#user.has_role('Admin') or
+             user.has_role(self.species) and self.status == 'published')
 
     def can_see_notes(self, user):
-        return(user and user.is_authenticated and
-            #(user.has_role('Admin') or
+        user = get_permission_context(user)
+        return(#user.has_role('Admin') or
              user.has_role(self.species))
 
     # Find any submitted inferences out there that refer to this sequence
@@ -45,14 +46,8 @@ class GeneDescriptionMixin:
         if new_seq is not None:
             # new_seq is the sequence about to be added to the gene description
             new_seq = new_seq.replace('.', '')      # ignore leading or trailing dots
-            subs = db.session.query(Submission).filter(Submission.submission_status.in_(['reviewing', 'complete']), Submission.species == self.species).all()
-
-            for sub in subs:
-                for desc in sub.genotype_descriptions:
-                    if desc.sequence_type == self.sequence_type:
-                        for genotype in desc.genotypes:
-                            if check_duplicate(genotype.nt_sequence, new_seq, self.sequence_type):
-                                self.duplicate_sequences.append(genotype)
+            from db.genotype_index import find_duplicate_genotypes      # imported here to avoid a circular import
+            self.duplicate_sequences = find_duplicate_genotypes(db, self.species, self.sequence_type, new_seq)
 
             db.session.commit()
 
@@ -7,6 +7,7 @@
 # Mixin methods for GermlineSet and associated objects
 
 from sequence_format import check_duplicate
+from permission_context import get_permission_context
 
 class GermlineSetMixin:
     def delete_dependencies(self, db):
@@ -14,24 +15,24 @@ class GermlineSetMixin:
             db.session.delete(a)
 
     def can_see(self, user):
+        user = get_permission_context(user)
         return(self.status == 'published' or self.status == 'superceded' or
-               (user and user.is_authenticated and
-               #(user.has_role('Admin') or
-                user.has_role(self.species)))
+               #user.has_role('Admin') or
+               user.has_role(self.species))
 
     def can_edit(self, user):
-        return((user and user.is_authenticated) and
-            ((user.has_role('AdminEdit') or
-            (user.has_role(self.species) and self.status == 'draft'))))
+        user = get_permission_context(user)
+        return(user.has_role('AdminEdit') or
+            (user.has_role(self.species) and self.status == 'draft'))
 
     def can_draft(self, user):
-        return((user and user.is_authenticated) and
-            #(user.has_role('Admin') or
-             (user.has_role(self.species) and self.status == 'published'))
+        user = get_permission_context(user)
+        return(#user.has_role('Admin') or
+             user.has_role(self.species) and self.status == 'published')
 
     def can_see_notes(self, user):
-        return((user and user.is_authenticated) and
-            #(user.has_role('Admin') or
+        user = get_permission_context(user)
+        return(#user.has_role('Admin') or
              user.has_role(self.species))
 
 
@@ -12,6 +12,8 @@ from head import app, attach_path
 from traceback import format_exc
 from os import path
 
+from permission_context import get_permission_context
+
 class SubmissionMixin:
     def delete_dependencies(self, db):
         # repertoire and everything downstream
@@ -50,18 +52,18 @@ class SubmissionMixin:
 
 
     def can_see(self, user):
+        user = get_permission_context(user)
         return(self.public or
-            user.is_authenticated and
-               #(user.has_role('Admin') or
-                user.has_role(self.species) or \
-                self.owner == user) or \
-                user in self.delegates
+               #user.has_role('Admin') or
+               user.has_role(self.species) or
+               user.is_user(self.owner_id) or
+               user.is_delegate(self))
 
     def can_edit(self, user):
-        return(user.is_authenticated and
-                (user.has_role('AdminEdit') or
-                (self.owner == user and self.submission_status == 'draft')))
+        user = get_permission_context(user)
+        return(user.has_role('AdminEdit') or
+                (user.is_user(self.owner_id) and self.submission_status == 'draft'))
 
     def can_see_private(self, user):
-        return(user.is_authenticated and
-                (self.owner == user or user.has_role(self.species) or user in self.delegates))
\ No newline at end of file
+        user = get_permission_context(user)
+        return(user.is_user(self.owner_id) or user.has_role(self.species) or user.is_delegate(self))
\ No newline at end of file
@@ -0,0 +1,166 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Rebuild of the duplicate sequences/published duplicates mapping for all the genotypes of a submission
+#
+# The mapping is rebuilt when a submission's status changes. The draft and published gene descriptions of the
+# species are read once, and indexed by sequence type in a ContainmentIndex. Each genotype, trimmed as check_duplicate
+# trims it, is then looked up in the index, and the association rows are deleted and inserted in bulk.
+#
+# In each process started with init_duplicate_mapping, rebuilds are queued when the status change is committed, and
+# run by a worker thread, so that the reviewer's request does not wait for them. The worker reads the submission's
+# status when it runs, so a rebuild is always made against the latest status. If DUPLICATE_MAPPING_BACKGROUND is
+# False, or no worker is running, the mapping is rebuilt in the request, as part of the caller's transaction.
+
+from collections import defaultdict
+import queue
+import threading
+
+from sqlalchemy import event, select
+
+from db.gene_description_db import GeneDescription, duplicate_sequences_published_duplicates
+from db.genotype_db import Genotype
+from db.genotype_description_db import GenotypeDescription
+from db.submission_db import Submission
+from sequence_format import trim_genotype_sequence
+from sequence_index import ContainmentIndex
+
+MAPPED_STATUSES = ['reviewing', 'complete']
+CANDIDATE_STATUSES = ['draft', 'published']
+PENDING_KEY = 'duplicate_mapping_submissions'
+
+duplicate_mapping_worker = None
+
+
+def _submission_genotypes(submission_id):
+    return select(Genotype.id)\
+        .join(GenotypeDescription, Genotype.description_id == GenotypeDescription.id)\
+        .where(GenotypeDescription.submission_id == submission_id)
+
+
+def build_gene_indexes(db, species):
+    """
+    Index the sequences of the draft and published gene descriptions of a species
+
+    Returns:
+        dict of sequence type to ContainmentIndex, keyed by GeneDescription.id
+    """
+    indexes = defaultdict(ContainmentIndex)
+
+    for gene_id, sequence_type, sequence in db.session.query(GeneDescription.id, GeneDescription.sequence_type, GeneDescription.sequence)\
+            .filter(GeneDescription.status.in_(CANDIDATE_STATUSES), GeneDescription.species == species):
+        if sequence is not None:
+            indexes[sequence_type].add(gene_id, sequence.replace('.', ''))
+
+    return indexes
+
+
+def rebuild_duplicate_mapping(db, submission_id, status=None):
+    """
+    Rebuild the published duplicates of every genotype in a submission. The caller commits.
+
+    Args:
+        submission_id: Submission.id
+        status: the submission's status, if it is not yet flushed: otherwise it is read from the database
+
+    Returns:
+        number of association rows written
+    """
+    with db.session.no_autoflush:
+        submission = db.session.query(Submission.species, Submission.submission_status).filter(Submission.id == submission_id).one_or_none()
+
+        if submission is None:
+            return 0
+
+        if status is None:
+            status = submission.submission_status
+
+        db.session.execute(duplicate_sequences_published_duplicates.delete()
+                           .where(duplicate_sequences_published_duplicates.c.duplicate_sequences_id.in_(_submission_genotypes(submission_id))))
+
+        if status not in MAPPED_STATUSES:
+            return 0
+
+        genotypes = db.session.query(Genotype.id, Genotype.nt_sequence, GenotypeDescription.sequence_type)\
+            .join(GenotypeDescription, Genotype.description_id == GenotypeDescription.id)\
+            .filter(GenotypeDescription.submission_id == submission_id)\
+            .all()
+
+        if not genotypes:
+            return 0
+
+        indexes = build_gene_indexes(db, submission.species)
+        rows = []
+
+        for genotype_id, nt_sequence, sequence_type in genotypes:
+            if nt_sequence is None or sequence_type not in indexes:
+                continue        # check_duplicate never matches these
+
+            for gene_id in sorted(indexes[sequence_type].find_containing(trim_genotype_sequence(nt_sequence, sequence_type))):
+                rows.append({'duplicate_sequences_id': genotype_id, 'published_duplicates_id': gene_id})
+
+        if rows:
+            db.session.execute(duplicate_sequences_published_duplicates.insert(), rows)
+
+        return len(rows)
+
+
+class DuplicateMappingWorker:
+    def __init__(self, app, db):
+        self.app = app
+        self.db = db
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='duplicate-mapping', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, submission_id):
+        self.queue.put(submission_id)
+
+    def run(self):
+        while True:
+            submission_id = self.queue.get()
+
+            with self.app.app_context():
+                try:
+                    rows = rebuild_duplicate_mapping(self.db, submission_id)
+                    self.db.session.commit()
+                    self.app.logger.info('Duplicate mapping for submission %d rebuilt: %d links' % (submission_id, rows))
+                except Exception:
+                    self.db.session.rollback()
+                    self.app.logger.exception('Error rebuilding duplicate mapping for submission %d' % submission_id)
+                finally:
+                    self.db.session.remove()
+
+
+def init_duplicate_mapping(app, db):
+    global duplicate_mapping_worker
+
+    if app.config.get('DUPLICATE_MAPPING_BACKGROUND', True):
+        duplicate_mapping_worker = DuplicateMappingWorker(app, db)
+        duplicate_mapping_worker.start()
+
+    # The mapping is always null when the submission is in draft, and this is the only point that the sequences can be changed
+
+    @event.listens_for(Submission.submission_status, 'set')
+    def receive_submission_status_set(target, value, oldvalue, initiator):
+        if target.id is None or value == oldvalue:
+            return
+
+        if duplicate_mapping_worker is None:
+            rebuild_duplicate_mapping(db, target.id, value)
+        else:
+            db.session.info.setdefault(PENDING_KEY, set()).add(target.id)
+
+    @event.listens_for(db.session, 'after_commit')
+    def receive_after_commit(session):
+        for submission_id in sorted(session.info.pop(PENDING_KEY, ())):
+            duplicate_mapping_worker.submit(submission_id)
+
+    @event.listens_for(db.session, 'after_rollback')
+    def receive_after_rollback(session):
+        session.info.pop(PENDING_KEY, None)
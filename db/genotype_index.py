@@ -0,0 +1,79 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Index of submitted genotype sequences, used to find genotypes that duplicate a gene description's sequence
+#
+# One ContainmentIndex is kept per (species, sequence_type), covering the genotypes of all submissions in
+# 'reviewing' or 'complete' status. Sequences are indexed after the same trimming that check_duplicate applies.
+#
+# Each index carries a signature (count, max and sum of the genotype ids it covers). The signature is re-read
+# on every lookup - a single aggregate query - and the index is rebuilt if it has changed. This picks up
+# genotypes uploaded or deleted, and submissions entering or leaving review, in any worker process.
+
+from sqlalchemy import func
+
+from db.genotype_db import Genotype
+from db.genotype_description_db import GenotypeDescription
+from db.submission_db import Submission
+from sequence_format import trim_genotype_sequence
+from sequence_index import ContainmentIndex
+
+INDEXED_STATUSES = ['reviewing', 'complete']
+
+genotype_indexes = {}
+
+
+def _genotype_query(db, species, sequence_type):
+    return db.session.query(Genotype)\
+        .join(GenotypeDescription, Genotype.description_id == GenotypeDescription.id)\
+        .join(Submission, GenotypeDescription.submission_id == Submission.id)\
+        .filter(Submission.submission_status.in_(INDEXED_STATUSES),
+                Submission.species == species,
+                GenotypeDescription.sequence_type == sequence_type)
+
+
+def _build_index(db, species, sequence_type):
+    index = ContainmentIndex()
+
+    for genotype_id, nt_sequence in _genotype_query(db, species, sequence_type).with_entities(Genotype.id, Genotype.nt_sequence):
+        if nt_sequence is None:
+            continue        # check_duplicate never matches these
+        index.add(genotype_id, trim_genotype_sequence(nt_sequence, sequence_type))
+
+    return index
+
+
+def get_genotype_index(db, species, sequence_type):
+    signature = tuple(_genotype_query(db, species, sequence_type)
+                      .with_entities(func.count(Genotype.id), func.max(Genotype.id), func.sum(Genotype.id))
+                      .one())
+
+    key = (species, sequence_type)
+
+    if key not in genotype_indexes or genotype_indexes[key][0] != signature:
+        genotype_indexes[key] = (signature, _build_index(db, species, sequence_type))
+
+    return genotype_indexes[key][1]
+
+
+def find_duplicate_genotypes(db, species, sequence_type, desc_seq):
+    """
+    Find the genotypes, in submissions under review or complete, that check_duplicate would report as
+    duplicates of a gene description's sequence
+
+    Args:
+        desc_seq: the ungapped sequence of the gene description
+
+    Returns:
+        list of Genotype, in id order
+    """
+    index = get_genotype_index(db, species, sequence_type)
+    genotype_ids = index.find_containing(desc_seq)
+
+    if not genotype_ids:
+        return []
+
+    return db.session.query(Genotype).filter(Genotype.id.in_(genotype_ids)).order_by(Genotype.id).all()
@@ -14,3 +14,74 @@ class Committee(db.Model):
     species = db.Column(db.String(80), unique=True)
     loci = db.Column(db.String(80))
     sequence_types = db.Column(db.String(80))
+
+
+# Mail waiting to be sent by the dispatcher in mail.py
+
+class MailOutbox(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(1000))
+    sender = db.Column(db.String(255))
+    recipients = db.Column(db.Text())           # JSON list of addresses and role names, expanded when the mail is sent
+    body = db.Column(db.Text())
+    html = db.Column(db.Text())
+    status = db.Column(db.String(20), index=True)   # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, default=0)
+    created = db.Column(db.DateTime)
+    claimed = db.Column(db.DateTime)
+    sent = db.Column(db.DateTime)
+    last_error = db.Column(db.Text())
+
+
+# Differences between a published version of a germline set or gene description and the version before it,
+# recorded when the version is published. diff holds the JSON-encoded difference
+
+class ReleaseDiff(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    object_type = db.Column(db.String(40))          # germline_set or gene_description
+    object_id = db.Column(db.Integer, index=True)   # id of the published version
+    created = db.Column(db.DateTime)
+    diff = db.Column(db.Text())
+
+
+# Last good snapshot of content that is expensive or slow to compute, such as the landing page's news and statistics.
+# content holds the JSON-encoded snapshot
+
+class SiteSnapshot(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), unique=True)
+    content = db.Column(db.Text())
+    updated = db.Column(db.DateTime)
+
+
+# Published genotypes aggregated for the genotype statistics report, by species, locus and sequence type. A set holds
+# the genotype descriptions that underlie published, affirmed gene descriptions, in the order of the report's columns,
+# and a copy of the frequencies of their genotypes. Sets are maintained by genotype_stats.py
+
+class GenotypeStatsSet(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    species = db.Column(db.String(255))
+    locus = db.Column(db.String(100))
+    sequence_type = db.Column(db.String(100))
+    updated = db.Column(db.DateTime)
+
+    __table_args__ = (db.UniqueConstraint('species', 'locus', 'sequence_type'),)
+
+
+class GenotypeStatsColumn(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    set_id = db.Column(db.Integer, db.ForeignKey('genotype_stats_set.id'), index=True)
+    genotype_description_id = db.Column(db.Integer)
+    name = db.Column(db.String(2000))                   # submission id / genotype name
+    position = db.Column(db.Integer)
+
+
+class GenotypeStatsRow(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    set_id = db.Column(db.Integer, db.ForeignKey('genotype_stats_set.id'), index=True)
+    column_id = db.Column(db.Integer, db.ForeignKey('genotype_stats_column.id'))
+    genotype_id = db.Column(db.Integer)
+    sequence_id = db.Column(db.String(1000))
+    allelic_percentage = db.Column(db.Numeric(precision=(12,2)))
+    assigned_unmutated_frequency = db.Column(db.Numeric(precision=(12,2)))
+    unmutated_frequency = db.Column(db.Numeric(precision=(12,2)))
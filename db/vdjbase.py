@@ -1,19 +1,22 @@
 # FUnctions for the interface with VDJBase
 import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 from flask import url_for
 from markupsafe import Markup
-from sqlalchemy import and_, func
+from sqlalchemy import and_, func, insert, update
 
 from db.misc_db import Committee
-import requests
 from head import app, db
+from http_client import http_get
 from db.notes_entry_db import NotesEntry
 from db.novel_vdjbase_db import NovelVdjbase, make_NovelVdjbase_table
 from db.styled_table import StyledCol
 from sequence_format import popup_seq_button
+from sequence_index import ContainmentIndex
 from db.species_lookup_db import SpeciesLookup
 
 
@@ -64,10 +67,16 @@ class VDJbaseError(Exception):
         self.message = message
 
 
+# Requests to VDJbase time out after VDJBASE_TIMEOUT seconds (default 60). Responses are revalidated on every call
+
+DEFAULT_VDJBASE_TIMEOUT = 60
+DEFAULT_VDJBASE_WORKERS = 4
+
+
 def call_vdjbase(payload):
     try:
         payload = app.config['VDJBASE_API'] + payload
-        resp = requests.get(payload)
+        resp = http_get(payload, ttl=0, timeout=float(app.config.get('VDJBASE_TIMEOUT', DEFAULT_VDJBASE_TIMEOUT)), stale_on_error=False)
     except Exception as e:
         raise VDJbaseError(f'Error contacting VDJbase: request: {payload} status code {e}')
 
@@ -85,26 +94,54 @@ def get_vdjbase_sample_details(species, dataset, sample_name):
 
 
 last_run = None
+import_lock = threading.Lock()
+
+# Fields of a NovelVdjbase record that are copied from VDJbase
+CORRESP_FIELDS = ['subject_count', 'j_haplotypes', 'd_haplotypes', 'hetero_alleleic_j_haplotypes', 'example', 'sequence']
+
+
+def start_vdjbase_import():
+    """
+    Run update_from_vdjbase in a background thread, unless an import is already running
+    """
+    if import_lock.locked():
+        return 'Import already running'
+
+    def run():
+        with app.app_context():
+            try:
+                app.logger.info('Update_from_VDJbase: %s' % update_from_vdjbase())
+            except Exception:
+                app.logger.exception('Error importing from VDJbase')
+            finally:
+                db.session.remove()
+
+    threading.Thread(target=run, name='vdjbase-import', daemon=True).start()
+    return 'Import started'
 
 
 def update_from_vdjbase():
+    if not import_lock.acquire(blocking=False):
+        return 'Import already running'
+
+    try:
+        return import_from_vdjbase()
+    finally:
+        import_lock.release()
+
+
+def import_from_vdjbase():
     global last_run
 
     common_to_binomial = {}
-    binomial_to_common = {}
     for sp in db.session.query(SpeciesLookup.common, SpeciesLookup.binomial).all():
         common_to_binomial[sp[0].lower()] = sp[1]
-        binomial_to_common[sp[1]] = sp[0]
-        
+
     #if last_run and datetime.now() - last_run < timedelta(hours=21):
     #    return 'Update_from_VDJbase: frequency limit exceeded: restart to over-ride'
 
     last_run = datetime.now()
 
-    # Update set of oll novels not just full-length
-
-    update_vdjbase_ref()
-
     # Work out which datasets to collect from VDJbase and process
     ogrdb_sets = {}
     species = db.session.query(Committee.species, Committee.loci).all()
@@ -119,106 +156,145 @@ def update_from_vdjbase():
                 ogrdb_sets[sp] = []
             ogrdb_sets[sp].extend([ds.replace(' ', '') for ds in s[1].split(',')])
 
-    try:
-        vdjbase_sets = {}
-        vdjbase_species = call_vdjbase('repseq/species')
+    # VDJbase requests are made concurrently. The set of all novels (not just full-length) is updated alongside
 
-        for vdjbase_species in vdjbase_species:
-            if vdjbase_species.lower() in common_to_binomial:
-                v_s = common_to_binomial[vdjbase_species.lower()]
-            else:
-                v_s = vdjbase_species
-            if v_s in ogrdb_sets:
-                vdjbase_datasets = call_vdjbase('repseq/ref_seqs/%s' % vdjbase_species)
-                for ds in vdjbase_datasets:
+    with ThreadPoolExecutor(max_workers=int(app.config.get('VDJBASE_WORKERS', DEFAULT_VDJBASE_WORKERS))) as executor:
+        ref_update = executor.submit(update_vdjbase_ref)
+
+        try:
+            vdjbase_species = {}
+            for vs in call_vdjbase('repseq/species'):
+                v_s = common_to_binomial.get(vs.lower(), vs)
+                if v_s in ogrdb_sets:
+                    vdjbase_species[vs] = v_s
+
+            ref_seqs = {vs: executor.submit(call_vdjbase, 'repseq/ref_seqs/%s' % vs) for vs in vdjbase_species}
+
+            vdjbase_sets = []
+            for vs, v_s in vdjbase_species.items():
+                for ds in ref_seqs[vs].result():
                     if ds['dataset'] in ogrdb_sets[v_s]:
-                        if v_s not in vdjbase_sets:
-                            vdjbase_sets[v_s] = []
-                        vdjbase_sets[v_s].append((ds['dataset'], vdjbase_species))
+                        vdjbase_sets.append((v_s, ds['dataset'], vs))
 
-    except VDJbaseError as e:
-        app.logger.error(e)
-        return False
+        except VDJbaseError as e:
+            app.logger.error(e)
+            return False
 
-    # Pull the datasets back and merge results into our table
+        # Pull the datasets back and merge results into our table, one transaction per dataset
 
-    for species, datasets in vdjbase_sets.items():
-        for dataset, vdjbase_species in datasets:
-            ogrdb_species = species
-            # vdjbase_species = binomial_to_common[species]
-            expected_alleles = db.session.query(NovelVdjbase.vdjbase_name) \
-                .filter(and_(NovelVdjbase.species == ogrdb_species, NovelVdjbase.locus == dataset)).all()
-            expected_alleles = [r[0] for r in expected_alleles]
+        novels = [(species, dataset, executor.submit(call_vdjbase, 'repseq/novels/%s/%s' % (vs, dataset))) for species, dataset, vs in vdjbase_sets]
 
+        for species, dataset, future in novels:
             try:
-                results = call_vdjbase('repseq/novels/%s/%s' % (vdjbase_species, dataset))
+                results = future.result()
 
                 if not results or len(results) == 0:
                     continue
 
-                for allele, row in results.items():
-                    db_rec = db.session.query(NovelVdjbase)\
-                        .filter(and_(NovelVdjbase.species == ogrdb_species,
-                                     NovelVdjbase.locus == dataset,
-                                     NovelVdjbase.vdjbase_name == row['name']))\
-                        .one_or_none()
-
-                    corresp_fields = ['subject_count', 'j_haplotypes', 'd_haplotypes', 'hetero_alleleic_j_haplotypes', 'example', 'sequence']
-
-                    if db_rec:
-                        changed = []
-                        db_rec.last_seen = func.now()
-                        for el in corresp_fields:
-                            if getattr(db_rec, el) != row[el]:
-                                changed.append(el)
-                                setattr(db_rec, el, row[el])
-
-                        if db_rec.status == 'not current':
-                            db_rec.status = 'not reviewed'
-                            db_rec.notes_entries[0].notes_text += '\rPresent again in VDJbase at %s' % datetime.ctime(datetime.now())
-
-                        if changed:
-                            db_rec.notes_entries[0].notes_text += '\rfields changed at %s: %s\rPrevious status: %s' % (datetime.ctime(datetime.now()), ','.join(changed), db_rec.status)
-                            db_rec.status = 'modified'
-                    else:
-                        db_rec = NovelVdjbase(
-                            vdjbase_name=row['name'],
-                            species=ogrdb_species,
-                            locus=dataset,
-                            first_seen=func.now(),
-                            last_seen=func.now(),
-                            status='not reviewed',
-                            updated_by='',
-                        )
-                        for el in corresp_fields:
-                            setattr(db_rec, el, row[el])
-
-                        db_rec.notes_entries.append(NotesEntry())
-                        db_rec.notes_entries[0].notes_text = ''
-                        db.session.add(db_rec)
-
-                    if row['name'] in expected_alleles:
-                        expected_alleles.remove(row['name'])
-
-                if expected_alleles:
-                    for name in expected_alleles:
-                        db_rec = db.session.query(NovelVdjbase)\
-                                    .filter(and_(NovelVdjbase.species == ogrdb_species,
-                                     NovelVdjbase.locus == dataset,
-                                     NovelVdjbase.vdjbase_name == name))\
-                                    .one_or_none()
-                        if db_rec and db_rec.status != 'not current':
-                            db_rec.status = 'not current'
-                            db_rec.notes_entries[0].notes_text += '\rNo longer seen in VDJbase at %s' % datetime.ctime(datetime.now())
-
+                merge_vdjbase_novels(species, dataset, results)
                 db.session.commit()
 
             except VDJbaseError as e:
                 app.logger.error(e)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('Error merging VDJbase novels for %s %s' % (species, dataset))
+
+        ref_update.result()
 
     return 'Import complete'
 
 
+def merge_vdjbase_novels(species, locus, results):
+    """
+    Merge the novels VDJbase reports for a dataset into NovelVdjbase. The caller commits.
+
+    Existing records and their notes are read in one query each. New, changed and disappeared records are worked
+    out in memory, and written with bulk inserts and updates.
+
+    Returns:
+        (number added, number updated)
+    """
+    existing = {rec.vdjbase_name: rec for rec in db.session.query(NovelVdjbase.id, NovelVdjbase.vdjbase_name, NovelVdjbase.status, *[getattr(NovelVdjbase, f) for f in CORRESP_FIELDS])
+                .filter(NovelVdjbase.species == species, NovelVdjbase.locus == locus)}
+
+    # The first notes entry of each record, as (id, text)
+    notes = {}
+    for note_id, novel_id, notes_text in db.session.query(NotesEntry.id, NotesEntry.novel_vdjbase_id, NotesEntry.notes_text)\
+            .join(NovelVdjbase, NotesEntry.novel_vdjbase_id == NovelVdjbase.id)\
+            .filter(NovelVdjbase.species == species, NovelVdjbase.locus == locus)\
+            .order_by(NotesEntry.id):
+        if novel_id not in notes:
+            notes[novel_id] = (note_id, notes_text or '')
+
+    now = datetime.ctime(datetime.now())
+    added = {}
+    seen_ids = []
+    record_updates = []
+    changed_notes = set()
+
+    def add_note(novel_id, text):
+        note_id, notes_text = notes.get(novel_id, (None, ''))
+        notes[novel_id] = (note_id, notes_text + text)
+        changed_notes.add(novel_id)
+
+    for allele, row in results.items():
+        rec = existing.pop(row['name'], None)
+
+        if rec is None:
+            if row['name'] not in added:
+                added[row['name']] = dict(vdjbase_name=row['name'], species=species, locus=locus, status='not reviewed', updated_by='',
+                                          **{f: row[f] for f in CORRESP_FIELDS})
+            continue
+
+        seen_ids.append(rec.id)
+        changed = [f for f in CORRESP_FIELDS if getattr(rec, f) != row[f]]
+        status = rec.status
+
+        if status == 'not current':
+            status = 'not reviewed'
+            add_note(rec.id, '\rPresent again in VDJbase at %s' % now)
+
+        if changed:
+            add_note(rec.id, '\rfields changed at %s: %s\rPrevious status: %s' % (now, ','.join(changed), status))
+            status = 'modified'
+
+        if changed or status != rec.status:
+            values = {'id': rec.id, 'status': status}
+            values.update({f: row[f] for f in changed})
+            record_updates.append(values)
+
+    # Records left in existing were not returned this time
+
+    for rec in existing.values():
+        if rec.status != 'not current':
+            record_updates.append({'id': rec.id, 'status': 'not current'})
+            add_note(rec.id, '\rNo longer seen in VDJbase at %s' % now)
+
+    if seen_ids:
+        db.session.execute(update(NovelVdjbase).where(NovelVdjbase.id.in_(seen_ids)).values(last_seen=func.now()))
+
+    if record_updates:
+        db.session.execute(update(NovelVdjbase), record_updates)
+
+    note_updates = [{'id': notes[novel_id][0], 'notes_text': notes[novel_id][1]} for novel_id in changed_notes if notes[novel_id][0] is not None]
+    note_inserts = [{'novel_vdjbase_id': novel_id, 'notes_text': notes[novel_id][1]} for novel_id in changed_notes if notes[novel_id][0] is None]
+
+    if added:
+        db.session.execute(NovelVdjbase.__table__.insert().values(first_seen=func.now(), last_seen=func.now()), list(added.values()))
+        new_ids = db.session.query(NovelVdjbase.id)\
+            .filter(NovelVdjbase.species == species, NovelVdjbase.locus == locus, NovelVdjbase.vdjbase_name.in_(list(added.keys())))
+        note_inserts.extend({'novel_vdjbase_id': novel_id, 'notes_text': ''} for (novel_id,) in new_ids)
+
+    if note_updates:
+        db.session.execute(update(NotesEntry), note_updates)
+
+    if note_inserts:
+        db.session.execute(insert(NotesEntry), note_inserts)
+
+    return len(added), len(record_updates)
+
+
 def setup_vdjbase_review_tables(results, editor):
     table = make_NovelVdjbase_table(results)
 
@@ -247,6 +323,10 @@ vdjbase_genes = {}
 vdjbase_gene_update_stamp = 0
 species_converted = False
 
+# (ContainmentIndex, allele names) for the novel sequences in each dataset, by species and locus
+# Index keys are positions in the list of names
+vdjbase_indexes = {}
+
 
 def update_vdjbase_ref():
     try:
@@ -275,6 +355,7 @@ def init_vdjbase_ref():
             if len(ret) > 0:
                 vdjbase_genes = ret
                 vdjbase_gene_update_stamp = os.path.getmtime(app.config['VDJBASE_NOVEL_FILE'])
+                build_vdjbase_indexes()
             else:
                 app.logger.error('Zero-length VDJbase novels file read from disk')
     except:
@@ -298,6 +379,43 @@ def get_vdjbase_ref():
             if species.lower() in common_to_binomial:
                 vdjbase_genes[common_to_binomial[species.lower()]] = dataset
                 del vdjbase_genes[species]
+                if species in vdjbase_indexes:
+                    vdjbase_indexes[common_to_binomial[species.lower()]] = vdjbase_indexes.pop(species)
 
     return vdjbase_genes
 
+
+def build_vdjbase_indexes():
+    global vdjbase_indexes
+
+    indexes = {}
+    for species, loci in vdjbase_genes.items():
+        indexes[species] = {}
+        for locus, genes in loci.items():
+            index = ContainmentIndex()
+            names = list(genes.keys())
+            for i, vdjbase_name in enumerate(names):
+                index.add(i, genes[vdjbase_name][0])
+            indexes[species][locus] = (index, names)
+
+    vdjbase_indexes = indexes
+
+
+# Find the VDJbase novels that contain, or are contained in, a lower-case ungapped sequence
+# Returns a list of (vdjbase_name, vdjbase_seq, vdjbase_count), in the order of the novels file
+
+def find_vdjbase_matches(species, locus, seq):
+    vdjbase_ref = get_vdjbase_ref()
+
+    if species not in vdjbase_ref or locus not in vdjbase_ref[species] or locus not in vdjbase_indexes.get(species, {}):
+        return []
+
+    genes = vdjbase_ref[species][locus]
+    index, names = vdjbase_indexes[species][locus]
+    matches = []
+
+    for i in sorted(index.find_containing(seq)):
+        vdjbase_seq, vdjbase_count = genes[names[i]]
+        matches.append((names[i], vdjbase_seq, vdjbase_count))
+
+    return matches
@@ -23,12 +23,4 @@ def receive_gd_set(target, value, oldvalue, initiator):
     print('GeneDescription Set event fired')
     target.build_duplicate_list(db, value)
 
-# At the Submission end, the mapping gets rebuilt when the submission status changes
-# The mapping is always null when the submission is in draft, and this is the only point that the sequences can be changed
-
-@event.listens_for(Submission.submission_status, 'set')
-def receive_gd_set(target, value, oldvalue, initiator):
-    print('Submission Set event fired')
-    for gd in target.genotype_descriptions:
-        for genotype in gd.genotypes:
-            genotype.build_duplicate_list(db, value)
+# At the Submission end, the mapping gets rebuilt when the submission status changes: see db/duplicate_mapping.py
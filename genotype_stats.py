@@ -10,10 +10,18 @@ from collections import OrderedDict
 from Bio import SeqIO
 from io import StringIO
 import csv
+from datetime import datetime
 
-from head import db
+from sqlalchemy import LargeBinary, and_, case, cast, delete, event, func, insert, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from head import app, db
 from db.submission_db import *
 from db.gene_description_db import *
+from db.genotype_db import Genotype
+from db.genotype_description_db import GenotypeDescription
+from db.inferred_sequence_db import InferredSequence
+from db.misc_db import GenotypeStatsSet, GenotypeStatsColumn, GenotypeStatsRow
 from imgt.imgt_ref import get_imgt_reference_genes
 
 
@@ -50,6 +58,172 @@ def parse_name(name):
     return(gene_subgroup, subgroup_designation, allele_designation)
 
 
+# Genotypes underlying affirmed inferences, by (species, locus, sequence_type)
+#
+# The report is calculated from a GenotypeStatsSet, which holds the genotype descriptions that underlie published,
+# affirmed gene descriptions, and a copy of their genotypes' frequencies. A set is built the first time it is used.
+# In each process started with init_genotype_stats, the sets that a transaction could have changed are rebuilt as
+# part of it: those of the gene descriptions that are published, withdrawn or re-affirmed, and all those of the
+# species of a submission whose status changes.
+
+PENDING_KEY = 'genotype_stats_pending'
+
+
+def rebuild_genotype_stats(species, locus, sequence_type):
+    """
+    Rebuild, or build, the set for a species, locus and sequence type. The caller commits.
+
+    Returns:
+        the GenotypeStatsSet
+    """
+    stats_set = db.session.query(GenotypeStatsSet)\
+        .filter(GenotypeStatsSet.species == species, GenotypeStatsSet.locus == locus, GenotypeStatsSet.sequence_type == sequence_type)\
+        .one_or_none()
+
+    if stats_set is None:
+        stats_set = GenotypeStatsSet(species=species, locus=locus, sequence_type=sequence_type)
+        db.session.add(stats_set)
+        db.session.flush()
+    else:
+        db.session.execute(delete(GenotypeStatsRow).where(GenotypeStatsRow.set_id == stats_set.id))
+        db.session.execute(delete(GenotypeStatsColumn).where(GenotypeStatsColumn.set_id == stats_set.id))
+
+    # Columns are ordered by the first gene description, and then the first inference, that each genotype description underlies
+
+    inferences = db.session.query(InferredSequence.genotype_id)\
+        .join(inferred_sequences_gene_descriptions, inferred_sequences_gene_descriptions.c.inferred_sequences_id == InferredSequence.id)\
+        .join(GeneDescription, inferred_sequences_gene_descriptions.c.gene_descriptions_id == GeneDescription.id)\
+        .filter(GeneDescription.status == 'published',
+                GeneDescription.species == species,
+                GeneDescription.locus == locus,
+                GeneDescription.sequence_type == sequence_type,
+                GeneDescription.affirmation_level != '0',
+                InferredSequence.genotype_id.isnot(None))\
+        .order_by(GeneDescription.id, InferredSequence.id)\
+        .all()
+
+    desc_ids = list(OrderedDict.fromkeys(genotype_id for (genotype_id,) in inferences))
+    names = {}
+
+    if desc_ids:
+        names = {desc_id: "%s/%s" % (submission_id, genotype_name) for desc_id, submission_id, genotype_name in
+                 db.session.query(GenotypeDescription.id, Submission.submission_id, GenotypeDescription.genotype_name)
+                 .join(Submission, GenotypeDescription.submission_id == Submission.id)
+                 .filter(GenotypeDescription.id.in_(desc_ids))}
+
+    columns = [{'set_id': stats_set.id, 'genotype_description_id': desc_id, 'name': names[desc_id], 'position': position}
+               for position, desc_id in enumerate(desc_ids) if desc_id in names]
+
+    if columns:
+        db.session.execute(insert(GenotypeStatsColumn), columns)
+
+        db.session.execute(insert(GenotypeStatsRow).from_select(
+            ['set_id', 'column_id', 'genotype_id', 'sequence_id', 'allelic_percentage', 'assigned_unmutated_frequency', 'unmutated_frequency'],
+            select(GenotypeStatsColumn.set_id, GenotypeStatsColumn.id, Genotype.id, Genotype.sequence_id, Genotype.allelic_percentage,
+                   Genotype.assigned_unmutated_frequency, Genotype.unmutated_frequency)
+            .join(GenotypeStatsColumn, GenotypeStatsColumn.genotype_description_id == Genotype.description_id)
+            .where(GenotypeStatsColumn.set_id == stats_set.id)
+        ))
+
+    stats_set.updated = datetime.utcnow()
+    return stats_set
+
+
+def get_genotype_stats_set(species, locus, sequence_type):
+    stats_set = db.session.query(GenotypeStatsSet)\
+        .filter(GenotypeStatsSet.species == species, GenotypeStatsSet.locus == locus, GenotypeStatsSet.sequence_type == sequence_type)\
+        .one_or_none()
+
+    if stats_set is None:
+        try:
+            stats_set = rebuild_genotype_stats(species, locus, sequence_type)
+            db.session.commit()
+        except IntegrityError:
+            # another process built the set at the same time
+            db.session.rollback()
+            return get_genotype_stats_set(species, locus, sequence_type)
+
+    return stats_set
+
+
+def rebuild_pending_genotype_stats(session):
+    pending = session.info.pop(PENDING_KEY, None)
+
+    if not pending:
+        return
+
+    keys = set()
+    for item in pending:
+        if isinstance(item, GeneDescription):
+            keys.add((item.species, item.locus, item.sequence_type))
+        else:
+            keys.update(session.query(GenotypeStatsSet.species, GenotypeStatsSet.locus, GenotypeStatsSet.sequence_type)
+                        .filter(GenotypeStatsSet.species == item).all())
+
+    # Sets are only maintained once they have been built
+
+    for species, locus, sequence_type in sorted(keys, key=str):
+        set_id = session.query(GenotypeStatsSet.id)\
+            .filter(GenotypeStatsSet.species == species, GenotypeStatsSet.locus == locus, GenotypeStatsSet.sequence_type == sequence_type)\
+            .scalar()
+
+        if set_id is None:
+            continue
+
+        try:
+            rebuild_genotype_stats(species, locus, sequence_type)
+        except Exception:
+            # don't hold up the caller's transaction: the set is dropped, and built again when it is next used
+            app.logger.exception('Error rebuilding genotype statistics for %s %s %s' % (species, locus, sequence_type))
+            session.execute(delete(GenotypeStatsRow).where(GenotypeStatsRow.set_id == set_id))
+            session.execute(delete(GenotypeStatsColumn).where(GenotypeStatsColumn.set_id == set_id))
+            session.execute(delete(GenotypeStatsSet).where(GenotypeStatsSet.id == set_id))
+
+
+def init_genotype_stats(db):
+    @event.listens_for(GeneDescription.status, 'set')
+    def receive_gene_description_status_set(target, value, oldvalue, initiator):
+        if value != oldvalue and 'published' in (value, oldvalue):
+            db.session.info.setdefault(PENDING_KEY, set()).add(target)
+
+    @event.listens_for(GeneDescription.affirmation_level, 'set')
+    def receive_gene_description_affirmation_set(target, value, oldvalue, initiator):
+        if value != oldvalue and target.status == 'published':
+            db.session.info.setdefault(PENDING_KEY, set()).add(target)
+
+    @event.listens_for(Submission.submission_status, 'set')
+    def receive_submission_status_set(target, value, oldvalue, initiator):
+        if value != oldvalue and target.species:
+            db.session.info.setdefault(PENDING_KEY, set()).add(target.species)
+
+    @event.listens_for(db.session, 'before_commit')
+    def receive_before_commit(session):
+        if session.info.get(PENDING_KEY):
+            session.flush()
+            rebuild_pending_genotype_stats(session)
+
+    @event.listens_for(db.session, 'after_rollback')
+    def receive_after_rollback(session):
+        session.info.pop(PENDING_KEY, None)
+
+
+def gene_thresholds(ref, freq_threshold, rare_genes, rare_threshold, very_rare_genes, very_rare_threshold):
+    """
+    The frequency threshold of each reference gene: a gene is very rare, or rare, if any of the listed names is a
+    substring of it, and very rare takes precedence
+    """
+    thresholds = {}
+
+    for gene in ref:
+        thresholds[gene] = freq_threshold
+        if any(rg in gene for rg in rare_genes):
+            thresholds[gene] = rare_threshold
+        if any(rg in gene for rg in very_rare_genes):
+            thresholds[gene] = very_rare_threshold
+
+    return thresholds
+
+
 def generate_stats(form):
     species = form.species.data
     locus = form.locus.data
@@ -59,25 +233,19 @@ def generate_stats(form):
     if species not in imgt_ref:
         return (0, None, None)
 
-    def gene_match(gene, ref):
-        for k,v in ref.items():
-            if gene in k:
-                return True
-        return False
+    # a gene matches if it is a substring of any reference gene name. Names don't contain newlines, so one search of the joined names will do
+    ref_names = '\n'.join(imgt_ref[species].keys())
+
+    def gene_match(gene):
+        return gene in ref_names
 
     rare_genes = form.rare_genes.data.replace(' ', '').split(',')
-    rare_missing = []
-    for gene in rare_genes:
-        if not gene_match(gene, imgt_ref[species]):
-            rare_missing.append(gene)
+    rare_missing = [gene for gene in rare_genes if not gene_match(gene)]
     if len(rare_missing) > 0:
         form.rare_genes.errors = ['Gene(s) %s not found in IMGT reference database' % ', '.join(rare_missing)]
 
     very_rare_genes = form.very_rare_genes.data.replace(' ', '').split(',')
-    very_rare_missing = []
-    for gene in very_rare_genes:
-        if not gene_match(gene, imgt_ref[species]):
-            very_rare_missing.append(gene)
+    very_rare_missing = [gene for gene in very_rare_genes if not gene_match(gene)]
     if len(very_rare_missing) > 0:
         form.very_rare_genes.errors = ['Gene(s) %s not found in IMGT reference database' % ', '.join(very_rare_missing)]
 
@@ -87,89 +255,67 @@ def generate_stats(form):
     ref = []
 
     for gene in imgt_ref[species].keys():
-        if locus in gene and gene[3] == sequence_type:
+        if locus in gene and gene[3] == sequence_type and '/OR' not in gene:
             ref.append(gene)
 
-    # Calculate thresholds for each reference gene
-
-    gene_thresh = {}
-
-    for gene in imgt_ref[species].keys():
-        gene_thresh[gene] =  form.freq_threshold.data
-        for rg in rare_genes:
-            if rg in gene:
-                gene_thresh[gene] = form.rare_threshold.data
-        for rg in very_rare_genes:
-            if rg in gene:
-                gene_thresh[gene] = form.very_rare_threshold.data
-
-    # Get unique list of genotype descriptions that underlie affirmed inferences
-
-    genotype_descriptions = []
-    seqs = db.session.query(GeneDescription).filter(GeneDescription.status == 'published',
-                                                    GeneDescription.species == species,
-                                                    GeneDescription.locus == locus,
-                                                    GeneDescription.sequence_type == sequence_type,
-                                                    GeneDescription.affirmation_level != '0'
-                                                    ).all()
-
-    for seq in seqs:
-        for genotype in seq.inferred_sequences:
-            if genotype.genotype_description not in genotype_descriptions:
-                genotype_descriptions.append(genotype.genotype_description)
-
-    if len(genotype_descriptions) == 0:
-        return (0, None, None)
-
-    # Initialise stats
-
-    stats = {}
-    for name in ref:
-        if '/OR' not in name:
-            stats[name] = {'occurrences': 0, 'unmutated_freq': [], 'gene': name}
+    ref.sort(key=parse_name)
 
-    stats = OrderedDict(sorted(stats.items(), key=lambda name: parse_name(name[0])[2]))
-    stats = OrderedDict(sorted(stats.items(), key=lambda name: parse_name(name[0])[1]))
-    stats = OrderedDict(sorted(stats.items(), key=lambda name: parse_name(name[0])[0]))
+    # Genotype descriptions that underlie affirmed inferences
 
-    raw = {}
-    for name in ref:
-        if '/OR' not in name:
-            raw[name] = {'gene': name}
+    stats_set = get_genotype_stats_set(species, locus, sequence_type)
+    columns = db.session.query(GenotypeStatsColumn.id, GenotypeStatsColumn.name)\
+        .filter(GenotypeStatsColumn.set_id == stats_set.id)\
+        .order_by(GenotypeStatsColumn.position)\
+        .all()
 
-    raw = OrderedDict(sorted(raw.items(), key=lambda name: parse_name(name[0])[2]))
-    raw = OrderedDict(sorted(raw.items(), key=lambda name: parse_name(name[0])[1]))
-    raw = OrderedDict(sorted(raw.items(), key=lambda name: parse_name(name[0])[0]))
+    if len(columns) == 0:
+        return (0, None, None)
 
     # Compose stats
-
-    gen_names = ['gene']
-
-    for desc in genotype_descriptions:
-        gen_name = "%s/%s" % (desc.submission.submission_id, desc.genotype_name)
-        gen_names.append(gen_name)
-        for gen in desc.genotypes:
-            if gen.sequence_id in stats \
-              and (gen.allelic_percentage is None or gen.allelic_percentage==0 or gen.allelic_percentage >= form.allelic_threshold.data) \
-              and (gen.assigned_unmutated_frequency is None or gen.assigned_unmutated_frequency >= form.assigned_unmutated_threshold.data) \
-              and (gen.unmutated_frequency is not None and gen.unmutated_frequency >= gene_thresh[gen.sequence_id]):
-                stats[gen.sequence_id]['occurrences'] += 1
-                stats[gen.sequence_id]['unmutated_freq'].append(gen.unmutated_frequency)
-            if gen.sequence_id in raw and (gen.allelic_percentage is None or gen.allelic_percentage >= form.allelic_threshold.data):
-                raw[gen.sequence_id][gen_name] = gen.unmutated_frequency
-
-    for (k, stat) in stats.items():
-        stats[k]['unmutated_freq'] = round(sum(stat['unmutated_freq'])/max(len(stat['unmutated_freq']),1), 2)
-
-    ret = []
-    for(k, stat) in stats.items():
-        ret.append(stat)
+    # sequence ids are compared as bytes: MySQL's default collations ignore case and trailing spaces, but a genotype
+    # only counts towards a reference gene if its sequence id is exactly the gene's name
+
+    exact_sequence_id = cast(GenotypeStatsRow.sequence_id, LargeBinary)
+    ref_ids = OrderedDict((name.encode('utf-8'), name) for name in ref)
+
+    thresholds = gene_thresholds(ref, form.freq_threshold.data, rare_genes, form.rare_threshold.data, very_rare_genes, form.very_rare_threshold.data)
+    threshold_whens = {name.encode('utf-8'): threshold for name, threshold in thresholds.items() if threshold != form.freq_threshold.data}
+    threshold = case(threshold_whens, value=exact_sequence_id, else_=form.freq_threshold.data) if threshold_whens else form.freq_threshold.data
+
+    allelic_threshold = form.allelic_threshold.data
+    allelic_included = or_(GenotypeStatsRow.allelic_percentage.is_(None), GenotypeStatsRow.allelic_percentage >= allelic_threshold)
+    included = and_(
+        or_(allelic_included, GenotypeStatsRow.allelic_percentage == 0),
+        or_(GenotypeStatsRow.assigned_unmutated_frequency.is_(None), GenotypeStatsRow.assigned_unmutated_frequency >= form.assigned_unmutated_threshold.data),
+        GenotypeStatsRow.unmutated_frequency.isnot(None),
+        GenotypeStatsRow.unmutated_frequency >= threshold
+    )
+
+    stats = OrderedDict((name, {'occurrences': 0, 'unmutated_freq': 0, 'gene': name}) for name in ref)
+
+    for sequence_id, occurrences, unmutated_freq in db.session.query(exact_sequence_id,
+                                                                     func.sum(case((included, 1), else_=0)),
+                                                                     func.avg(case((included, GenotypeStatsRow.unmutated_frequency))))\
+            .filter(GenotypeStatsRow.set_id == stats_set.id, exact_sequence_id.in_(list(ref_ids)))\
+            .group_by(exact_sequence_id):
+        name = ref_ids[bytes(sequence_id)]
+        stats[name]['occurrences'] = int(occurrences)
+        stats[name]['unmutated_freq'] = round(unmutated_freq, 2) if unmutated_freq is not None else 0
+
+    raw = OrderedDict((name, {'gene': name}) for name in ref)
+    column_names = dict(columns)
+
+    for sequence_id, column_id, unmutated_frequency in db.session.query(exact_sequence_id, GenotypeStatsRow.column_id, GenotypeStatsRow.unmutated_frequency)\
+            .filter(GenotypeStatsRow.set_id == stats_set.id, exact_sequence_id.in_(list(ref_ids)), allelic_included)\
+            .order_by(GenotypeStatsRow.genotype_id):
+        raw[ref_ids[bytes(sequence_id)]][column_names[column_id]] = unmutated_frequency
+
+    ret = list(stats.values())
 
     ro = StringIO()
-    writer = csv.DictWriter(ro, fieldnames=gen_names)
+    writer = csv.DictWriter(ro, fieldnames=['gene'] + [name for column_id, name in columns])
     writer.writeheader()
     for gene in raw:
         writer.writerow(raw[gene])
 
-    return (len(genotype_descriptions), ret, ro)
-
+    return (len(columns), ret, ro)
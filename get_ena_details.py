@@ -7,14 +7,14 @@
 # Get accession detains from ENA
 
 
-import requests
 import argparse
 import sys
 import re
 import html
-import time
 import xml.etree.ElementTree as ET
 
+from http_client import http_get
+
 
 def get_ena_project_details(prj_id):
     ret = {}
@@ -23,7 +23,7 @@ def get_ena_project_details(prj_id):
         raise ValueError('bady formatted project id: %s' % (prj_id))
 
     try:
-        r = requests.get('https://www.ebi.ac.uk/ena/browser/api/xml/%s' % prj_id)
+        r = http_get('https://www.ebi.ac.uk/ena/browser/api/xml/%s' % prj_id)
 
         if r.status_code != 200:
             raise ValueError('Unexpected response from ENA: status %d' % r.status_code)
@@ -53,14 +53,14 @@ def get_ena_nuc_details(nuc_id):
     try:
         title = ''
         request = 'https://www.ebi.ac.uk/ena/browser/api/xml/%s' % nuc_id
-        r = requests.get(request)
+        r = http_get(request)
         if r.status_code == 200:
             root = ET.fromstring(r.content)
             entries = root.findall("./entry/description")
             title = entries[0].text
         else:
             request = 'https://www.ebi.ac.uk/ena/browser/api/embl/%s' % nuc_id
-            r = requests.get(request)
+            r = http_get(request)
             if r.status_code == 200:
                 lines = r.content.decode('utf-8')
                 lines = lines.split('\n')
@@ -90,7 +90,7 @@ def get_ena_srr_details(srr_id):
         raise ValueError('badly formatted sequence set accession number: %s' % (srr_id))
 
     try:
-        r = requests.get('https://www.ebi.ac.uk/ena/browser/api/xml/%s' % srr_id)
+        r = http_get('https://www.ebi.ac.uk/ena/browser/api/xml/%s' % srr_id)
         if r.status_code != 200:
             raise ValueError('Unexpected response from ENA: status %d' % r.status_code)
 
@@ -120,7 +120,7 @@ def get_ena_samn_details(sam_id):
         raise ValueError('badly formatted sample accession number: %s' % (sam_id))
 
     try:
-        r = requests.get('https://www.ebi.ac.uk/ena/browser/api/xml/%s' % sam_id)
+        r = http_get('https://www.ebi.ac.uk/ena/browser/api/xml/%s' % sam_id)
         if r.status_code != 200:
             raise ValueError('Unexpected response from ENA: status %d' % r.status_code)
 
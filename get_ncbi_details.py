@@ -7,120 +7,204 @@
 # Get publication details from PubMed
 
 
-import requests
 import argparse
 import sys
 import re
 import html
-import time
+from urllib.parse import urlencode
 from head import ncbi_api_key
+from http_client import http_get
 
-# Requests to NCBI are limited to 10 per second. There's a sleep before each call to limit request rate
-# Still no guarantee that we won't hit rate limiting if multiple users make requests at the same time
+# Requests to NCBI are limited to 10 per second. http_get rate-limits requests to NCBI across the process, and
+# caches the responses, so that repeated lookups of the same id don't reach NCBI at all
+#
+# The _batch functions resolve many ids at once, with one esummary call for up to ESUMMARY_BATCH ids. They return
+# (results, errors): results maps each id that was resolved to its details, and errors maps each id that was not
+# to a message. The single-id functions are wrappers that raise ValueError with the id's message
 
 
-def get_pmid_details(pmid):
-    ret = {}
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+ESUMMARY_BATCH = 200
+ESEARCH_BATCH = 50
 
-    try:
-        i = int(pmid)
-    except:
-        raise ValueError('PubMed id must be an integer')
+title_exp = re.compile('Title.*?>(?P<title>.*?)<')
+run_exp = re.compile('Run acc="(?P<acc>.*?)"')
+sample_name_exp = re.compile('Id db_label="Sample name">(?P<title>.*?)<')
 
-    try:
-        time.sleep(0.11)
-        r = requests.get('https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?api_key=%s&db=pubmed&retmode=json&rettype=abstract&id=%s' % (ncbi_api_key, pmid))
-        if r.status_code != 200:
-            raise ValueError('Unexpected response from NIH: status %d' % r.status_code)
-        c = r.json()
 
-        if 'error' in c['result'][pmid]:
-            e = c['result'][pmid]['error']
-            if 'cannot get document summary' in e:
-                e = 'No document exists with pubMed id %s' % pmid
-            raise ValueError(e)
+def _chunks(ids, size):
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
 
-        ret['title'] = c['result'][pmid]['title']
 
-        authors  = []
-        for author in c['result'][pmid]['authors']:
-            authors.append(author['name'])
+def _eutils_get(util, **params):
+    r = http_get(EUTILS_URL + '%s.fcgi?api_key=%s&%s' % (util, ncbi_api_key, urlencode(params)))
+    if r.status_code != 200:
+        raise ValueError('Unexpected response from NCBI: status %d' % r.status_code)
+    return r.json()
 
-        ret['authors'] = ', '.join(authors)
 
-    except Exception as e:
-        exc_type, exc_value = sys.exc_info()[:2]
-        raise ValueError('Error fetching PmID info from NIH: %s' % (exc_value))
+def _esearch(db, term, retmax):
+    c = _eutils_get('esearch', db=db, retmode='json', retmax=retmax, term=term)
+    return c['esearchresult']['idlist']
 
-    return ret
 
+def _esummary(db, uids):
+    """
+    Fetch the document summaries of a list of uids, ESUMMARY_BATCH at a time
 
-def get_nih_project_details(prj_id):
-    ret = {}
+    Returns:
+        dict of uid to summary, for the uids that NCBI returned without error
+    """
+    summaries = {}
+
+    for chunk in _chunks(list(dict.fromkeys(uids)), ESUMMARY_BATCH):
+        c = _eutils_get('esummary', db=db, retmode='json', rettype='abstract', id=','.join(chunk))
+
+        if 'error' in c:
+            continue
+
+        for uid in chunk:
+            if uid in c['result'] and 'error' not in c['result'][uid]:
+                summaries[uid] = c['result'][uid]
+
+    return summaries
+
+
+def _accession_search(db, accessions):
+    """
+    Find the uids of a list of accession numbers, with one esearch for up to ESEARCH_BATCH accessions
+
+    Returns:
+        list of uids found for any of the accessions
+    """
+    uids = []
 
-    if len(prj_id) < 5 or (prj_id[:3] != 'SRP' and prj_id[:5] != 'PRJNA' and prj_id[:5] != 'PRJEB'):
-        raise ValueError('bady formatted project id: %s' % (prj_id))
+    for chunk in _chunks(accessions, ESEARCH_BATCH):
+        uids.extend(_esearch(db, ' OR '.join('%s[accn]' % acc for acc in chunk), 10 * len(chunk)))
+
+    return uids
+
+
+def _single(results, errors, id):
+    if id in errors:
+        raise ValueError(errors[id])
+    return results[id]
+
+
+def require_all(batch, ids):
+    """
+    Resolve a list of ids with one of the _batch functions
+
+    Raises:
+        ValueError listing the messages for the ids that could not be resolved
+    """
+    results, errors = batch(ids)
+    messages = [errors[id] for id in dict.fromkeys(ids) if id in errors]
+
+    if messages:
+        raise ValueError('; '.join(messages))
+
+    return results
+
+
+def get_pmid_details_batch(pmids):
+    results = {}
+    errors = {}
+    uids = {}
+
+    for pmid in pmids:
+        try:
+            uids[pmid] = str(int(pmid))
+        except (TypeError, ValueError):
+            errors[pmid] = 'PubMed id must be an integer'
+
+    if not uids:
+        return results, errors
 
     try:
-        if prj_id[:5] != 'PRJNA':
-            time.sleep(0.11)
-            foo = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?api_key=%s&db=sra&retmode=json&term=%s' % (ncbi_api_key, prj_id)
-            r = requests.get('https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?api_key=%s&db=sra&retmode=json&term=%s' % (ncbi_api_key, prj_id))
-            if r.status_code != 200:
-                raise ValueError('Unexpected response from NIH: status %d' % r.status_code)
-            c = r.json()
-
-            if len(c['esearchresult']['idlist']) == 0:
-                e = 'No project found in NCBI SRA with accession number %s' % prj_id
-                raise ValueError(e)
-
-            id = c['esearchresult']['idlist'][0]
-            time.sleep(0.11)
-            r = requests.get('https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?api_key=%s&db=sra&retmode=json&rettype=abstract&id=%s' % (ncbi_api_key, id))
-
-            if r.status_code != 200:
-                raise ValueError('Unexpected response from NCBI: status %d' % r.status_code)
-            c = r.json()
-
-            if 'error' in c or id not in c['result']:
-                e = 'No details could be retrieved for project with id %s' % id
-                raise ValueError(e)
-
-            xml = html.unescape(c['result'][id]['expxml'])
-            exp = re.compile('Title.*?>(?P<title>.*?)<')
-            m = exp.search(xml)
-            ret['title'] = m.group('title')
-            ret['url'] = 'https://www.ncbi.nlm.nih.gov/sra/?term=%s' % prj_id
+        summaries = _esummary('pubmed', list(uids.values()))
+    except Exception as e:
+        for pmid in uids:
+            errors[pmid] = 'Error fetching PmID info from NIH: %s' % e
+        return results, errors
+
+    for pmid, uid in uids.items():
+        if uid not in summaries:
+            errors[pmid] = 'Error fetching PmID info from NIH: No document exists with pubMed id %s' % pmid
+            continue
+
+        results[pmid] = {
+            'title': summaries[uid]['title'],
+            'authors': ', '.join(author['name'] for author in summaries[uid]['authors']),
+        }
+
+    return results, errors
+
+
+def get_pmid_details(pmid):
+    return _single(*get_pmid_details_batch([pmid]), pmid)
+
+
+def get_nih_project_details_batch(prj_ids):
+    """
+    BioProject (PRJNA) ids are summarised directly. SRA study and ENA project ids are looked up in SRA, one esearch
+    each, and the studies found are summarised together
+    """
+    results = {}
+    errors = {}
+    bioprojects = {}
+    sra_uids = {}
+
+    for prj_id in prj_ids:
+        if len(prj_id) < 5 or (prj_id[:3] != 'SRP' and prj_id[:5] != 'PRJNA' and prj_id[:5] != 'PRJEB'):
+            errors[prj_id] = 'bady formatted project id: %s' % (prj_id)
+        elif prj_id[:5] == 'PRJNA':
+            bioprojects[prj_id] = prj_id[5:]
         else:
-            id = prj_id[5:]
-            time.sleep(0.11)
-            r = requests.get('https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?api_key=%s&db=bioproject&retmode=json&rettype=abstract&id=%s' % (ncbi_api_key, id))
+            try:
+                idlist = _esearch('sra', prj_id, 1)
+                if len(idlist) == 0:
+                    errors[prj_id] = 'Error fetching project info from NCBI: No project found in NCBI SRA with accession number %s' % prj_id
+                else:
+                    sra_uids[prj_id] = idlist[0]
+            except Exception as e:
+                errors[prj_id] = 'Error fetching project info from NCBI: %s' % e
 
-            if r.status_code != 200:
-                raise ValueError('Unexpected response from NIH: status %d' % r.status_code)
-            c = r.json()
+    try:
+        summaries = _esummary('bioproject', list(bioprojects.values())) if bioprojects else {}
 
-            if 'error' in c or id not in c['result']:
-                e = 'No details could be retrieved for project id %s' % id
-                raise ValueError(e)
+        for prj_id, uid in bioprojects.items():
+            if uid in summaries:
+                results[prj_id] = {'title': summaries[uid]['project_title'], 'url': 'https://www.ncbi.nlm.nih.gov/bioproject/%s' % prj_id}
+            else:
+                errors[prj_id] = 'Error fetching project info from NCBI: No details could be retrieved for project id %s' % uid
 
-            ret['title'] = c['result'][id]['project_title']
-            ret['url'] = 'https://www.ncbi.nlm.nih.gov/bioproject/%s' % prj_id
+        summaries = _esummary('sra', list(sra_uids.values())) if sra_uids else {}
 
+        for prj_id, uid in sra_uids.items():
+            m = title_exp.search(html.unescape(summaries[uid]['expxml'])) if uid in summaries else None
+            if m:
+                results[prj_id] = {'title': m.group('title'), 'url': 'https://www.ncbi.nlm.nih.gov/sra/?term=%s' % prj_id}
+            else:
+                errors[prj_id] = 'Error fetching project info from NCBI: No details could be retrieved for project with id %s' % uid
 
     except Exception as e:
-        exc_type, exc_value = sys.exc_info()[:2]
-        raise ValueError('Error fetching project info from NCBI: %s' % (exc_value))
+        for prj_id in list(bioprojects) + list(sra_uids):
+            if prj_id not in results:
+                errors[prj_id] = 'Error fetching project info from NCBI: %s' % e
 
-    return ret
+    return results, errors
+
+
+def get_nih_project_details(prj_id):
+    return _single(*get_nih_project_details_batch([prj_id]), prj_id)
 
 
 def get_nih_nuc_details(nuc_id):
     ret = {}
 
     try:
-        time.sleep(0.11)
-        r = requests.get('https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?api_key=%s&db=nuccore&retmode=json&rettype=abstract&id=%s' % (ncbi_api_key, nuc_id))
+        r = http_get('https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?api_key=%s&db=nuccore&retmode=json&rettype=abstract&id=%s' % (ncbi_api_key, nuc_id))
         if r.status_code != 200:
             raise ValueError('Unexpected response from NIH: status %d' % r.status_code)
         c = r.json()
@@ -150,92 +234,97 @@ def get_nih_nuc_details(nuc_id):
     return ret
 
 
-def get_nih_srr_details(srr_id):
-    ret = {}
+def get_nih_srr_details_batch(srr_ids):
+    """
+    The runs are found with one esearch and one esummary per batch, and matched to the SRA records that list them
+    """
+    results = {}
+    errors = {}
+    wanted = []
 
-    if len(srr_id) < 5 or (srr_id[:3] != 'SRR' and srr_id[:3] != 'ERR'):
-        raise ValueError('badly formatted SRR record accession number: %s' % (srr_id))
+    for srr_id in srr_ids:
+        if len(srr_id) < 5 or (srr_id[:3] != 'SRR' and srr_id[:3] != 'ERR'):
+            errors[srr_id] = 'badly formatted SRR record accession number: %s' % (srr_id)
+        elif srr_id not in wanted:
+            wanted.append(srr_id)
 
-    try:
-        time.sleep(0.11)
-        r = requests.get('https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?api_key=%s&db=sra&retmode=json&term=%s[accn]' % (ncbi_api_key, srr_id))
-        if r.status_code != 200:
-            raise ValueError('Unexpected response from NIH: status %d' % r.status_code)
-        c = r.json()
+    if not wanted:
+        return results, errors
 
-        if len(c['esearchresult']['idlist']) == 0 or len(c['esearchresult']['idlist']) > 1:
-            e = 'No record set found in NCBI SRA with accession number %s' % srr_id
-            raise ValueError(e)
+    try:
+        summaries = _esummary('sra', _accession_search('sra', wanted))
+    except Exception as e:
+        for srr_id in wanted:
+            errors[srr_id] = 'Error fetching nucleotide info from NIH: %s' % e
+        return results, errors
 
-        id = c['esearchresult']['idlist'][0]
-        time.sleep(0.11)
-        r = requests.get('https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?api_key=%s&db=sra&retmode=json&rettype=abstract&id=%s' % (ncbi_api_key, id))
-        if r.status_code != 200:
-            raise ValueError('Unexpected response from NIH: status %d' % r.status_code)
-        c = r.json()
+    records = {srr_id: [] for srr_id in wanted}
 
-        if 'error' in c or id not in c['result']:
-            e = 'No details could be retrieved for project with sra if %s' % id
-            raise ValueError(e)
+    for uid, summary in summaries.items():
+        for m in run_exp.finditer(html.unescape(summary.get('runs', ''))):
+            if m.group('acc') in records:
+                records[m.group('acc')].append(summary)
 
-        xml = html.unescape(c['result'][id]['expxml'])
-        exp = re.compile('Title.*?>(?P<title>.*?)<')
-        m = exp.search(xml)
-        ret['title'] = m.group('title')
-        ret['url'] = 'https://trace.ncbi.nlm.nih.gov/Traces/sra/?run=' + srr_id
+    for srr_id, matches in records.items():
+        m = title_exp.search(html.unescape(matches[0]['expxml'])) if len(matches) == 1 else None
+        if m:
+            results[srr_id] = {'title': m.group('title'), 'url': 'https://trace.ncbi.nlm.nih.gov/Traces/sra/?run=' + srr_id}
+        else:
+            errors[srr_id] = 'Error fetching nucleotide info from NIH: No record set found in NCBI SRA with accession number %s' % srr_id
 
+    return results, errors
 
-    except Exception as e:
-        exc_type, exc_value = sys.exc_info()[:2]
-        raise ValueError('Error fetching nucleotide info from NIH: %s' % (exc_value))
 
-    return ret
+def get_nih_srr_details(srr_id):
+    return _single(*get_nih_srr_details_batch([srr_id]), srr_id)
 
-def get_nih_samn_details(sam_id):
-    ret = {}
 
-    if len(sam_id) < 5 or (sam_id[:4] != 'SAMN' and sam_id[:4] != 'SAME'):
-        raise ValueError('badly formatted sample record accession number: %s' % (sam_id))
+def get_nih_samn_details_batch(sam_ids):
+    """
+    The samples are found with one esearch and one esummary per batch, and matched by accession number
+    """
+    results = {}
+    errors = {}
+    wanted = []
 
-    try:
-        time.sleep(0.11)
-        r = requests.get('https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?api_key=%s&db=biosample&retmode=json&term=%s[accn]' % (ncbi_api_key, sam_id))
-        if r.status_code != 200:
-            raise ValueError('Unexpected response from NIH: status %d' % r.status_code)
-        c = r.json()
+    for sam_id in sam_ids:
+        if len(sam_id) < 5 or (sam_id[:4] != 'SAMN' and sam_id[:4] != 'SAME'):
+            errors[sam_id] = 'badly formatted sample record accession number: %s' % (sam_id)
+        elif sam_id not in wanted:
+            wanted.append(sam_id)
 
-        if len(c['esearchresult']['idlist']) == 0 or len(c['esearchresult']['idlist']) > 1:
-            e = 'No record set found in NCBI SRA with accession number %s' % sam_id
-            raise ValueError(e)
+    if not wanted:
+        return results, errors
 
-        id = c['esearchresult']['idlist'][0]
-        time.sleep(0.11)
-        r = requests.get('https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?api_key=%s&db=biosample&retmode=json&rettype=abstract&id=%s' % (ncbi_api_key, id))
-        if r.status_code != 200:
-            raise ValueError('Unexpected response from NIH: status %d' % r.status_code)
-        c = r.json()
+    try:
+        summaries = _esummary('biosample', _accession_search('biosample', wanted))
+    except Exception as e:
+        for sam_id in wanted:
+            errors[sam_id] = 'Error fetching nucleotide info from NIH: %s' % e
+        return results, errors
 
-        if 'error' in c or id not in c['result']:
-            e = 'No details could be retrieved for project with sra if %s' % id
-            raise ValueError(e)
+    records = {sam_id: [] for sam_id in wanted}
 
-        xml = html.unescape(c['result'][id]['sampledata'])
-        exp = re.compile('Id db_label="Sample name">(?P<title>.*?)<')
-        m = exp.search(xml)
+    for uid, summary in summaries.items():
+        if summary.get('accession') in records:
+            records[summary['accession']].append(summary)
 
-        if m is not None:
-            ret['title'] = m.group('title')
-        else:
-            ret['title'] = c['result'][id]['title']
+    for sam_id, matches in records.items():
+        if len(matches) != 1:
+            errors[sam_id] = 'Error fetching nucleotide info from NIH: No record set found in NCBI SRA with accession number %s' % sam_id
+            continue
 
-        ret['url'] = 'https://www.ncbi.nlm.nih.gov/biosample/=' + sam_id
+        m = sample_name_exp.search(html.unescape(matches[0].get('sampledata', '')))
+        results[sam_id] = {
+            'title': m.group('title') if m is not None else matches[0]['title'],
+            'url': 'https://www.ncbi.nlm.nih.gov/biosample/=' + sam_id,
+        }
 
+    return results, errors
 
-    except Exception as e:
-        exc_type, exc_value = sys.exc_info()[:2]
-        raise ValueError('Error fetching nucleotide info from NIH: %s' % (exc_value))
 
-    return ret
+def get_nih_samn_details(sam_id):
+    return _single(*get_nih_samn_details_batch([sam_id]), sam_id)
 
 
 def main(argv):
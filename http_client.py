@@ -0,0 +1,350 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Shared client for outbound HTTP requests to VDJbase, NCBI and ENA
+#
+# - Requests share one pooled requests session, and time out after HTTP_TIMEOUT seconds (default 30) unless the
+#   caller says otherwise.
+# - Requests to a host listed in HTTP_RATE_LIMITS (requests per second, by host name) wait for a token from that
+#   host's bucket. The buckets are shared by all threads of the process. NCBI allows 10 requests per second with an
+#   API key, so eutils.ncbi.nlm.nih.gov is limited to 9 unless configured otherwise.
+# - Successful GET responses are cached on disk, keyed by URL, in HTTP_CACHE_PATH if that is configured, otherwise in
+#   a subdirectory of the attachment path. A cached response younger than its ttl is returned without a request. An
+#   older one is revalidated with If-None-Match/If-Modified-Since if the server sent an ETag or Last-Modified, and
+#   refetched otherwise. If the server can't be reached, an expired response is returned rather than an error, unless
+#   the caller asks otherwise.
+# - Cache entries are keyed by the URL without its api_key parameter, so that keys are neither written to disk nor
+#   change the key. An entry whose body is unchanged when it is refetched only has its metadata rewritten.
+# - At most once every HTTP_CACHE_PRUNE_INTERVAL seconds (default 3600), a process that writes to the cache removes
+#   entries that have not been fetched or revalidated for HTTP_CACHE_MAX_AGE seconds (default 30 days), and then the
+#   least recently fetched entries until the cache is no larger than HTTP_CACHE_MAX_BYTES (default 1GB).
+
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+import head
+from head import app
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RATE_LIMITS = {
+    'eutils.ncbi.nlm.nih.gov': 9,
+}
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+PRIVATE_PARAMETERS = ('api_key',)
+DEFAULT_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+DEFAULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_CACHE_PRUNE_INTERVAL = 60 * 60
+
+
+class HttpResponse:
+    """
+    The parts of a requests.Response that callers use, for both live and cached responses
+    """
+    def __init__(self, url, status_code, content, headers, from_cache=False):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = CaseInsensitiveDict(headers)
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+session = None
+buckets = {}
+client_lock = threading.Lock()
+last_pruned = 0
+prune_lock = threading.Lock()
+
+
+def get_session():
+    global session
+
+    with client_lock:
+        if session is None:
+            pool_size = int(app.config.get('HTTP_POOL_SIZE', DEFAULT_POOL_SIZE))
+            s = requests.Session()
+            s.mount('http://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+            s.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+            session = s
+
+    return session
+
+
+def get_bucket(host):
+    with client_lock:
+        if host not in buckets:
+            rate_limits = dict(DEFAULT_RATE_LIMITS)
+            rate_limits.update(app.config.get('HTTP_RATE_LIMITS', {}))
+            buckets[host] = TokenBucket(rate_limits[host]) if rate_limits.get(host) else None
+
+    return buckets[host]
+
+
+def get_cache_dir():
+    if app.config.get('HTTP_CACHE_PATH'):
+        return app.config['HTTP_CACHE_PATH']
+
+    if head.attach_path:
+        return os.path.join(head.attach_path, 'http_cache')
+
+    return None
+
+
+def cache_key(url):
+    """
+    The URL without its private parameters, which identifies its cache entry
+    """
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in PRIVATE_PARAMETERS]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def _cache_paths(key):
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    base = os.path.join(get_cache_dir(), digest[:2], digest)
+    return base + '.json', base + '.body'
+
+
+def _atomic_write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+
+    with open(tmp, 'wb') as fo:
+        fo.write(content)
+
+    os.replace(tmp, path)
+
+
+def read_cached(url):
+    """
+    Returns:
+        (metadata, content) of the cached response to url, or None
+    """
+    if get_cache_dir() is None:
+        return None
+
+    key = cache_key(url)
+    meta_path, body_path = _cache_paths(key)
+
+    try:
+        with open(meta_path, 'r') as fi:
+            meta = json.load(fi)
+        with open(body_path, 'rb') as fi:
+            content = fi.read()
+    except (OSError, ValueError):
+        return None
+
+    if meta.get('url') != key:
+        return None
+
+    return meta, content
+
+
+def store_cached(url, response, previous_meta=None):
+    """
+    Cache a response
+
+    Args:
+        url: the URL requested
+        response: the requests.Response
+        previous_meta: metadata of the cached response that this replaces, if any
+    """
+    if get_cache_dir() is None:
+        return
+
+    key = cache_key(url)
+    meta = {
+        'url': key,
+        'fetched': time.time(),
+        'digest': hashlib.sha256(response.content).hexdigest(),
+        'headers': {k: response.headers[k] for k in CACHED_HEADERS if k in response.headers},
+    }
+
+    meta_path, body_path = _cache_paths(key)
+
+    try:
+        if previous_meta is None or previous_meta.get('digest') != meta['digest']:
+            _atomic_write(body_path, response.content)
+        _atomic_write(meta_path, json.dumps(meta).encode('utf-8'))
+    except OSError as e:
+        app.logger.warning('Error writing HTTP cache: %s' % e)
+
+    prune_cache()
+
+
+def touch_cached(url, meta):
+    meta['fetched'] = time.time()
+
+    try:
+        _atomic_write(_cache_paths(cache_key(url))[0], json.dumps(meta).encode('utf-8'))
+    except OSError as e:
+        app.logger.warning('Error writing HTTP cache: %s' % e)
+
+
+def prune_cache(force=False):
+    """
+    Remove expired cache entries, and then the least recently fetched entries until the cache is within its size
+    limit. Unless force is set, this does nothing if the cache was pruned by this process within the prune interval.
+
+    Returns:
+        number of entries removed
+    """
+    global last_pruned
+
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return 0
+
+    now = time.time()
+
+    with prune_lock:
+        if not force and now - last_pruned < float(app.config.get('HTTP_CACHE_PRUNE_INTERVAL', DEFAULT_CACHE_PRUNE_INTERVAL)):
+            return 0
+        last_pruned = now
+
+    max_age = float(app.config.get('HTTP_CACHE_MAX_AGE', DEFAULT_CACHE_MAX_AGE))
+    max_bytes = int(app.config.get('HTTP_CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES))
+
+    # The metadata file is rewritten whenever an entry is fetched or revalidated, so its mtime is the entry's age
+
+    entries = []
+    for dir_path, _, file_names in os.walk(cache_dir):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            if file_name.endswith('.tmp') or file_name.endswith('.body') and not os.path.exists(path[:-len('.body')] + '.json'):
+                if now - stat.st_mtime > max_age:
+                    _remove_files(path)
+            elif file_name.endswith('.json'):
+                body_path = path[:-len('.json')] + '.body'
+                try:
+                    size = stat.st_size + os.stat(body_path).st_size
+                except OSError:
+                    size = stat.st_size
+                entries.append((stat.st_mtime, size, path, body_path))
+
+    entries.sort()
+    total = sum(entry[1] for entry in entries)
+    removed = 0
+
+    for mtime, size, meta_path, body_path in entries:
+        if now - mtime <= max_age and total <= max_bytes:
+            break
+        _remove_files(meta_path, body_path)
+        total -= size
+        removed += 1
+
+    if removed:
+        app.logger.info('HTTP cache pruned: %d entries removed' % removed)
+
+    return removed
+
+
+def _remove_files(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def http_get(url, ttl=DEFAULT_TTL, timeout=None, stale_on_error=True):
+    """
+    GET a URL through the pooled session, rate limiter and response cache
+
+    Args:
+        url: the URL, including any query string
+        ttl: seconds for which a cached response is used without revalidation. 0 revalidates on every call, and None
+             bypasses the cache
+        timeout: request timeout in seconds, if not HTTP_TIMEOUT
+        stale_on_error: if True, return the cached response, however old, if the server can't be reached
+
+    Returns:
+        HttpResponse. Only responses with status 200 are cached: others are returned as received
+
+    Raises:
+        requests.RequestException, if the server can't be reached and no cached response can be returned
+    """
+    cached = read_cached(url) if ttl is not None else None
+
+    if cached is not None:
+        meta, content = cached
+        if time.time() - meta['fetched'] < ttl:
+            return HttpResponse(url, 200, content, meta['headers'], from_cache=True)
+
+    headers = {}
+    if cached is not None:
+        if 'ETag' in meta['headers']:
+            headers['If-None-Match'] = meta['headers']['ETag']
+        if 'Last-Modified' in meta['headers']:
+            headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+
+    bucket = get_bucket(urlsplit(url).hostname)
+    if bucket is not None:
+        bucket.acquire()
+
+    if timeout is None:
+        timeout = float(app.config.get('HTTP_TIMEOUT', DEFAULT_TIMEOUT))
+
+    try:
+        r = get_session().get(url, headers=headers, timeout=timeout)
+    except requests.RequestException:
+        if cached is not None and stale_on_error:
+            return HttpResponse(url, 200, content, meta['headers'], from_cache=True)
+        raise
+
+    if r.status_code == 304 and cached is not None:
+        touch_cached(url, meta)
+        return HttpResponse(url, 200, content, meta['headers'], from_cache=True)
+
+    if r.status_code == 200 and ttl is not None:
+        store_cached(url, r, meta if cached is not None else None)
+
+    return HttpResponse(url, r.status_code, r.content, r.headers)
@@ -11,174 +11,142 @@ import yaml
 from head import app
 import sys
 import os.path
-import pickle
 import json
+from functools import lru_cache
+from imgt.ref_store import ReferenceStore, ReferenceStoreError, build_store, get_store_path, find_family
 
 imgt_reference_genes = None
 imgt_gapped_reference_genes = None
+imgt_gapped_position_maps = None
+imgt_ref_store = None
 igpdb_genes = None
+
+# species names that refer to the references of another species
+SPECIES_ALIASES = {'Test': 'Homo sapiens'}
 imgt_config = None
+imgt_species_aliases = None
 
 # indexed by species and then by codon (first codon = 1), lists the residues found in that location in the reference set
 reference_v_codon_usage = None
 
 
-# Read IMGT reference file and build the reference and codon usage data, using species defined in the config file
+# Open the reference store built from the IMGT reference files, using species defined in the config file
+# The store is built by imgt/ref_store.py. If it is missing, or was built from different sources, it is rebuilt here
 def init_imgt_ref():
     global imgt_reference_genes
     global imgt_gapped_reference_genes
+    global imgt_gapped_position_maps
     global reference_v_codon_usage
     global imgt_config
+    global imgt_ref_store
+    global imgt_species_aliases
 
     with open('imgt/track_imgt_config.yaml', 'r') as fc:
         imgt_config = yaml.load(fc, Loader=yaml.FullLoader)
-        if 'Test' not in imgt_config['species']:
-            imgt_config['species']['Test'] = {'alias': 'Test'}
 
-    species = imgt_config['species']
+    store_path = get_store_path(imgt_config)
 
-    imgt_reference_genes = None
-    if os.path.exists(imgt_config['imgt_ref_pickle']) and max(os.path.getmtime('imgt/track_imgt_config.yaml'), os.path.getmtime(imgt_config['ogre_ref_file'])) < os.path.getmtime(imgt_config['imgt_ref_pickle']):
+    imgt_ref_store = None
+    try:
+        imgt_ref_store = ReferenceStore(store_path, SPECIES_ALIASES)
+        if not imgt_ref_store.is_current(imgt_config):
+            app.logger.error("Reference store %s is out of date: rebuilding" % store_path)
+            imgt_ref_store = None
+    except (OSError, ValueError, ReferenceStoreError):
+        app.logger.error("Error reading reference store %s: rebuilding" % store_path)
+
+    if imgt_ref_store is None:
         try:
-            imgt_reference_genes = pickle.load(open(imgt_config['imgt_ref_pickle'], "rb"))
+            imgt_ref_store = ReferenceStore(build_store(imgt_config), SPECIES_ALIASES)
         except:
-            imgt_reference_genes = None
-            app.logger.error("Error reading %s: rebuilding" % imgt_config['imgt_ref_pickle'])
+            app.logger.error("Error building reference store: %s" % sys.exc_info()[0])
 
-    if imgt_reference_genes is None:
-        try:
-            imgt_reference_genes = read_reference(imgt_config['ogre_ref_file'], species)
-            imgt_reference_genes['Test'] = imgt_reference_genes['Homo sapiens']
-            pickle.dump(imgt_reference_genes, open(imgt_config['imgt_ref_pickle'], "wb"))
-        except:
-            app.logger.error("Error parsing IMGT reference file: %s" % sys.exc_info()[0])
+    if 'Test' not in imgt_config['species']:
+        imgt_config['species']['Test'] = {'alias': 'Test'}
+
+    imgt_species_aliases = None
 
+    imgt_reference_genes = None
     imgt_gapped_reference_genes = None
-    if os.path.exists(imgt_config['imgt_gapped_ref_pickle']) and max(os.path.getmtime('imgt/track_imgt_config.yaml'), os.path.getmtime(imgt_config['gapped_ogre_ref_file'])) < os.path.getmtime(imgt_config['imgt_gapped_ref_pickle']):
-        try:
-            imgt_gapped_reference_genes = pickle.load(open(imgt_config['imgt_gapped_ref_pickle'], "rb"))
-        except:
-            imgt_gapped_reference_genes = None
-            app.logger.error("Error reading %s: rebuilding" % imgt_config['imgt_gapped_ref_pickle'])
+    reference_v_codon_usage = None
+    imgt_gapped_position_maps = {}
 
-    if imgt_gapped_reference_genes is None:
-        try:
-            imgt_gapped_reference_genes = read_reference(imgt_config['gapped_ogre_ref_file'], species)
-            imgt_gapped_reference_genes['Test'] = imgt_gapped_reference_genes['Homo sapiens']
-            pickle.dump(imgt_gapped_reference_genes, open(imgt_config['imgt_gapped_ref_pickle'], "wb"))
-        except:
-            app.logger.error("Error parsing IMGT gapped file: %s" % sys.exc_info()[0])
+    if imgt_ref_store is not None:
+        imgt_reference_genes = imgt_ref_store.reference_genes
+        imgt_gapped_reference_genes = imgt_ref_store.gapped_reference_genes
+        reference_v_codon_usage = imgt_ref_store.codon_usage
+        imgt_gapped_position_maps = imgt_ref_store.gapped_position_maps
 
-    reference_v_codon_usage = None
-    if os.path.exists(imgt_config['codon_usage_pickle']) and max(os.path.getmtime('imgt/track_imgt_config.yaml'), os.path.getmtime(imgt_config['ogre_ref_file'])) < os.path.getmtime(imgt_config['codon_usage_pickle']):
-        try:
-            reference_v_codon_usage = pickle.load(open(imgt_config['codon_usage_pickle'], "rb"))
-        except:
-            reference_v_codon_usage = None
-            app.logger.error("Error reading %s: rebuilding" % imgt_config['codon_usage_pickle'])
 
-    if reference_v_codon_usage is None:
-        try:
-            reference_v_codon_usage = {}
+# find the 1-based index of a nucleotide in a gapped reference sequence, given its index in the ungapped sequence
+# The position maps are built with the reference store, and read from it without decoding the sequence
+def find_gapped_index(ind_ungapped, species, gene_name):
+    if ind_ungapped <= 0:
+        return 1
 
-            for sp in imgt_gapped_reference_genes.keys():
-                reference_v_codon_usage[sp] = {}
-                for chain in 'IGHV', 'IGKV', 'IGLV':
-                    reference_v_codon_usage[sp][chain] = find_codon_usage(imgt_gapped_reference_genes, sp, chain)
+    return imgt_gapped_position_maps[species].position(gene_name, ind_ungapped - 1) + 2
 
-            pickle.dump(reference_v_codon_usage, open(imgt_config['codon_usage_pickle'], "wb"))
-        except:
-            app.logger.error("Error determining germline codon usage: %s" % sys.exc_info()[0])
 
+# Gapping template of a reference: a list of (n, gap) runs. Each run takes the next n nucleotides of the
+# sequence and follows them with the gap string. Dots at the 5' end of a partial reference take nucleotides,
+# so that they are passed through. Templates depend only on where the dots are, and are cached by reference.
 
-def read_reference(filename, species):
-    records = {}
+@lru_cache(maxsize=4096)
+def gap_template(ref):
+    runs = []
+    n = 0
+    gap = 0
+    five_gapped = True
 
-    for sp in species.keys():
-        for al in species[sp]['alias'].split(','):
-            records[al] = {}
+    for r in ref:
+        if r != '.':
+            five_gapped = False
 
-    for rec in SeqIO.parse(filename, 'fasta'):
-        rd = rec.description.split('|')
-        if rd[2] in species.keys() and (rd[4] in ['V-REGION', 'D-REGION', 'J-REGION']) and (rec.seq is not None):
-            for al in species[rd[2]]['alias'].split(','):
-                records[al][rd[1]] = rec.seq.lower()
+        if r != '.' or five_gapped:
+            if gap:
+                runs.append((n, '.' * gap))
+                n = 0
+                gap = 0
+            n += 1
+        else:
+            gap += 1
 
-    return records
+    if n or gap:
+        runs.append((n, '.' * gap))
 
-def find_family(gene):
-    if '-' not in gene:
-        return None
+    return tuple(runs)
 
-    return gene.split('-')[0][4:]
 
-# find the 1-based index of a nucleotide in a gapped reference sequence, given its index in the ungapped sequence
-def find_gapped_index(ind_ungapped, species, gene_name):
-    gapped_seq = list(imgt_gapped_reference_genes[species][gene_name])
+def _apply_gap_template(seq, runs):
+    seq = str(seq)
+    seq_len = len(seq)
+    parts = []
+    pos = 0
 
-    ind = 0
-    found_nt = 0
+    for n, gap in runs:
+        if pos + n > seq_len:
+            break
+        parts.append(seq[pos:pos + n])
+        parts.append(gap)
+        pos += n
 
-    while found_nt < ind_ungapped:
-        if gapped_seq[ind] != '.':
-            found_nt += 1
-        ind += 1
+    # the remainder: a partial run if the sequence is shorter than the ref, trailing nucs if it is longer
+    parts.append(seq[pos:])
+    return ''.join(parts)
 
-    return ind + 1
 
 # Gap a sequence given the closest gapped reference
 
 def gap_sequence(seq, ref):
-    i_seq = iter(list(seq))
-    i_ref = iter(list(ref))
-    ret = ''
+    return _apply_gap_template(seq, gap_template(str(ref)))
 
-    # if reference is partial at the 5' end, pass nucleotides through until we reach the first 'real' reference position
-    five_gapped = True
 
-    try:
-        while(True):
-            r = next(i_ref)
-            if r != '.':
-                five_gapped = False
-                ret += next(i_seq)
-            else:
-                if five_gapped:
-                    ret += next(i_seq)
-                else:
-                    ret += '.'
-    except StopIteration:
-        pass
-
-    # if the sequence is longer than the ref, need to add on trailing nucs
+# Gap a batch of sequences against the same gapped reference
+
+def gap_sequences(seqs, ref):
+    runs = gap_template(str(ref))
+    return [_apply_gap_template(seq, runs) for seq in seqs]
 
-    try:
-        while(True):
-            ret += next(i_seq)
-    except StopIteration:
-        pass
-
-    return ret
-
-def find_codon_usage(gapped_reference_genes, species, chain):
-    usage = {}
-
-    for (gene_name, nt_seq) in gapped_reference_genes[species].items():
-        if chain in gene_name:
-            family = find_family(gene_name)
-            if family not in usage:
-                usage[family] = [[],]
-            try:
-                aa_seq = list(nt_seq.upper().translate(gap='.'))
-
-                for i in range(0, len(aa_seq)):
-                    if len(usage[family]) <= i+1:
-                        usage[family].append([])
-                    if aa_seq[i] not in usage[family][i+1]:
-                        usage[family][i+1].append(aa_seq[i])
-            except:
-                pass
-    return usage
 
 def init_igpdb_ref():
     global igpdb_genes
@@ -207,3 +175,17 @@ def get_igpdb_ref():
 
 def get_imgt_config():
     return imgt_config
+
+
+# Map each species alias in the IMGT config to its IMGT species name
+def get_imgt_species_aliases():
+    global imgt_species_aliases
+
+    if imgt_species_aliases is None:
+        aliases = {}
+        for imgt_name, species in imgt_config['species'].items():
+            for alias in species['alias'].split(','):
+                aliases[alias] = imgt_name
+        imgt_species_aliases = aliases
+
+    return imgt_species_aliases
@@ -0,0 +1,288 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Read-only binary store of the IMGT reference sequences and germline codon usage
+#
+# The store is built from the IMGT FASTA files by running this module:
+#
+#   python imgt/ref_store.py imgt/track_imgt_config.yaml
+#
+# File layout: magic, header length (4 bytes, little-endian), JSON header, sequence data.
+# The header records the store format version, the sha256 of each source file, the offset and length
+# of every sequence in the data area, and the codon usage table. Sequences are stored as lower-case ASCII.
+# Each gapped sequence is followed by its position map: the 0-based index in the gapped sequence of each of its
+# nucleotides, as unsigned 16-bit little-endian integers.
+#
+# The web app maps the file read-only, so that all worker processes share one copy of the sequence data.
+# Sequences are decoded into Seq objects only when they are looked up.
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+from collections.abc import Mapping
+
+from Bio import SeqIO
+from Bio.Seq import Seq
+import yaml
+
+STORE_MAGIC = b'OGRDBREF'
+STORE_FORMAT_VERSION = 2
+HEADER_LEN = struct.Struct('<I')
+POSITION = struct.Struct('<H')
+
+REF_SETS = {
+    'ungapped': 'ogre_ref_file',
+    'gapped': 'gapped_ogre_ref_file',
+}
+
+CODON_USAGE_CHAINS = ('IGHV', 'IGKV', 'IGLV')
+
+
+class ReferenceStoreError(Exception):
+    pass
+
+
+def read_reference(filename, species):
+    records = {}
+
+    for sp in species.keys():
+        for al in species[sp]['alias'].split(','):
+            records[al] = {}
+
+    for rec in SeqIO.parse(filename, 'fasta'):
+        rd = rec.description.split('|')
+        if rd[2] in species.keys() and (rd[4] in ['V-REGION', 'D-REGION', 'J-REGION']) and (rec.seq is not None):
+            for al in species[rd[2]]['alias'].split(','):
+                records[al][rd[1]] = rec.seq.lower()
+
+    return records
+
+
+def find_family(gene):
+    if '-' not in gene:
+        return None
+
+    return gene.split('-')[0][4:]
+
+
+def find_codon_usage(gapped_reference_genes, species, chain):
+    usage = {}
+
+    for (gene_name, nt_seq) in gapped_reference_genes[species].items():
+        if chain in gene_name:
+            family = find_family(gene_name)
+            if family not in usage:
+                usage[family] = [[],]
+            try:
+                aa_seq = list(nt_seq.upper().translate(gap='.'))
+
+                for i in range(0, len(aa_seq)):
+                    if len(usage[family]) <= i+1:
+                        usage[family].append([])
+                    if aa_seq[i] not in usage[family][i+1]:
+                        usage[family][i+1].append(aa_seq[i])
+            except:
+                pass
+    return usage
+
+
+def get_store_path(imgt_config):
+    if 'imgt_ref_store' in imgt_config:
+        return imgt_config['imgt_ref_store']
+
+    return os.path.join(os.path.dirname(imgt_config['ogre_ref_file']), 'imgt_ref.store')
+
+
+def file_digest(filename):
+    digest = hashlib.sha256()
+
+    with open(filename, 'rb') as fi:
+        for chunk in iter(lambda: fi.read(1 << 20), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+# The version of the sources a store must be built from: the store format, the species configuration and the FASTA files
+
+def source_version(imgt_config):
+    return {
+        'format_version': STORE_FORMAT_VERSION,
+        'species': imgt_config['species'],
+        'files': {key: file_digest(imgt_config[key]) for key in REF_SETS.values()},
+    }
+
+
+def build_store(imgt_config):
+    """
+    Build the reference store from the FASTA files named in the config. The store is written to a temporary
+    file and moved into place, so that processes reading the old store are not disturbed.
+
+    Returns:
+        path of the store
+    """
+    species = imgt_config['species']
+    data = bytearray()
+    index = {}
+    refs = {}
+
+    for ref_set, config_key in REF_SETS.items():
+        refs[ref_set] = read_reference(imgt_config[config_key], species)
+        index[ref_set] = {}
+
+        for sp, genes in refs[ref_set].items():
+            index[ref_set][sp] = {}
+            for gene_name, seq in genes.items():
+                seq = str(seq).encode('ascii')
+                index[ref_set][sp][gene_name] = (len(data), len(seq))
+                data += seq
+
+    index['position_maps'] = {}
+    for sp, genes in refs['gapped'].items():
+        index['position_maps'][sp] = {}
+        for gene_name, seq in genes.items():
+            positions = [i for i, c in enumerate(str(seq)) if c != '.']
+            index['position_maps'][sp][gene_name] = (len(data), len(positions))
+            data += struct.pack('<%dH' % len(positions), *positions)
+
+    codon_usage = {}
+    for sp in refs['gapped'].keys():
+        codon_usage[sp] = {}
+        for chain in CODON_USAGE_CHAINS:
+            # family can be None, which JSON can't hold as a key
+            codon_usage[sp][chain] = list(find_codon_usage(refs['gapped'], sp, chain).items())
+
+    header = json.dumps({
+        'version': source_version(imgt_config),
+        'index': index,
+        'codon_usage': codon_usage,
+    }).encode('utf-8')
+
+    path = get_store_path(imgt_config)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+
+    with open(tmp, 'wb') as fo:
+        fo.write(STORE_MAGIC)
+        fo.write(HEADER_LEN.pack(len(header)))
+        fo.write(header)
+        fo.write(data)
+
+    os.replace(tmp, path)
+    return path
+
+
+# Sequences of one species, read from the store on demand
+
+class StoredSequences(Mapping):
+    def __init__(self, buf, base, index):
+        self.buf = buf
+        self.base = base
+        self.index = index
+
+    def __getitem__(self, gene_name):
+        offset, length = self.index[gene_name]
+        offset += self.base
+        return Seq(self.buf[offset:offset + length].decode('ascii'))
+
+    def __contains__(self, gene_name):
+        return gene_name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+# Position maps of the gapped sequences of one species, read from the store on demand
+
+class StoredPositionMaps(Mapping):
+    def __init__(self, buf, base, index):
+        self.buf = buf
+        self.base = base
+        self.index = index
+
+    def __getitem__(self, gene_name):
+        offset, count = self.index[gene_name]
+        return list(struct.unpack_from('<%dH' % count, self.buf, self.base + offset))
+
+    def __contains__(self, gene_name):
+        return gene_name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def position(self, gene_name, i):
+        """
+        The 0-based index in the gapped sequence of the i'th (0-based) nucleotide of the ungapped sequence
+        """
+        offset, count = self.index[gene_name]
+        if i < 0 or i >= count:
+            raise IndexError('%s has no nucleotide %d' % (gene_name, i))
+        return POSITION.unpack_from(self.buf, self.base + offset + POSITION.size * i)[0]
+
+
+class ReferenceStore:
+    """
+    An open reference store
+
+    Attributes:
+        reference_genes: dict of species to {gene name: ungapped Seq}
+        gapped_reference_genes: dict of species to {gene name: gapped Seq}
+        gapped_position_maps: dict of species to StoredPositionMaps of the gapped sequences
+        codon_usage: dict of species to {chain: {family: list of residues at each codon (first codon = 1)}}
+        version: the source version the store was built from
+
+    aliases is a dict of additional species names to the stored species they refer to
+    """
+    def __init__(self, path, aliases=None):
+        with open(path, 'rb') as fi:
+            self.map = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[:len(STORE_MAGIC)] != STORE_MAGIC:
+            raise ReferenceStoreError('%s is not a reference store' % path)
+
+        pos = len(STORE_MAGIC)
+        header_len = HEADER_LEN.unpack_from(self.map, pos)[0]
+        pos += HEADER_LEN.size
+        header = json.loads(self.map[pos:pos + header_len].decode('utf-8'))
+        data_offset = pos + header_len
+
+        self.version = header['version']
+        self.reference_genes = {sp: StoredSequences(self.map, data_offset, genes) for sp, genes in header['index']['ungapped'].items()}
+        self.gapped_reference_genes = {sp: StoredSequences(self.map, data_offset, genes) for sp, genes in header['index']['gapped'].items()}
+        self.gapped_position_maps = {sp: StoredPositionMaps(self.map, data_offset, genes) for sp, genes in header['index']['position_maps'].items()}
+        self.codon_usage = {sp: {chain: dict(usage) for chain, usage in chains.items()} for sp, chains in header['codon_usage'].items()}
+
+        for alias, sp in (aliases or {}).items():
+            for species_dict in (self.reference_genes, self.gapped_reference_genes, self.gapped_position_maps, self.codon_usage):
+                if sp in species_dict:
+                    species_dict[alias] = species_dict[sp]
+
+    def is_current(self, imgt_config):
+        return json.loads(json.dumps(source_version(imgt_config))) == self.version
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Build the IMGT reference store used by the web app.')
+    parser.add_argument('cfgfile', help='configuration file (yaml)')
+    args = parser.parse_args(argv)
+
+    with open(args.cfgfile, 'r') as fc:
+        imgt_config = yaml.load(fc, Loader=yaml.FullLoader)
+
+    print('Reference store written to %s' % build_store(imgt_config))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,11 +4,16 @@
 # the English version of which is available here: https://perma.cc/DK5U-NDVE
 #
 
+from datetime import datetime, timedelta
+import json
+import threading
+import time
+
 from flask_mail import Message
 from head import db
-from db.userdb import Role, User
-from sqlalchemy import distinct
-import time
+from db.userdb import Role, User, roles_users
+from db.misc_db import MailOutbox
+from sqlalchemy import insert, update, or_, and_
 
 
 from flask import current_app, render_template
@@ -28,49 +33,252 @@ def log_mail(message, app):
     app.logger.info(log_message)
 
 
+# Outgoing mail is queued in the MailOutbox table and sent by a dispatcher thread, so that requests don't wait on SMTP
+#
+# Each process started with init_mail_dispatcher runs a dispatcher. A dispatcher claims pending messages with a
+# conditional update, so that a message is only sent once whichever process picks it up. It expands role names for
+# the whole batch in one query, drops inactive accounts and duplicate addresses, and sends the batch over one SMTP
+# connection, waiting MAIL_SEND_INTERVAL seconds (default 3) between messages. Failed messages are retried up to
+# MAIL_MAX_ATTEMPTS times.
+#
+# A claim lapses after MAIL_CLAIM_TIMEOUT seconds, so that mail claimed by a process that has gone away is sent by
+# another. A long batch could outlast that, so the claim on each message is renewed just before it is sent, and a
+# message that has been claimed by another process in the meantime is left to that process.
+#
+# The dispatcher uses the normal Flask-Mail settings, so for testing it can be pointed at a local SMTP stand-in,
+# for example MAIL_SERVER = 'localhost', MAIL_PORT = 8025 with 'python -m aiosmtpd -n -l localhost:8025'
+
+MAIL_POLL_INTERVAL = 30         # seconds between checks for mail queued by other processes
+MAIL_CLAIM_TIMEOUT = 600        # seconds after which a message claimed by a process that has gone away is retried
+DEFAULT_SEND_INTERVAL = 3
+DEFAULT_MAX_ATTEMPTS = 5
+
+mail_dispatcher = None
+
+
 # send mail - modelled after the same function in flask_security
-# recipients list can include role names - which will be expanded to include role owners
+# recipients list can include role names - which will be expanded to include role owners when the mail is sent
 
 def send_mail(subject, recipients, template, **context):
     sender = current_app.config['MAIL_DEFAULT_SENDER']
+    recipients = [recipient for recipient in recipients if recipient != 'Test']    # don't send mails to the Test role as everyone has it
+
+    if len(recipients) == 0:
+        current_app.logger.info('No recpients for mail %s' % (subject))
+        return
+
+    ctx = ('email', template)
+    body = render_template('%s/%s.txt' % ctx, **context)
+    html = render_template('%s/%s.html' % ctx, **context)
+
+    # Queue on a separate connection, so that the caller's transaction is neither committed nor rolled back here
+    with db.engine.begin() as conn:
+        conn.execute(insert(MailOutbox).values(
+            subject=subject,
+            sender=sender,
+            recipients=json.dumps(recipients),
+            body=body,
+            html=html,
+            status='pending',
+            attempts=0,
+            created=datetime.utcnow(),
+        ))
+
+    if mail_dispatcher is not None:
+        mail_dispatcher.wake()
+
+
+# Expand role names and drop inactive accounts and duplicates, for a batch of recipient lists
+
+def expand_recipients(recipient_lists):
+    names = set()
+    for recipients in recipient_lists:
+        names.update(recipients)
+
+    # one query for all roles named in the batch. The outer join keeps roles that have no owners
+    role_owners = {}
+    for role_name, email in db.session.query(Role.name, User.email)\
+            .select_from(Role)\
+            .outerjoin(roles_users, roles_users.c.role_id == Role.id)\
+            .outerjoin(User, roles_users.c.user_id == User.id)\
+            .filter(Role.name.in_(names))\
+            .all():
+        owners = role_owners.setdefault(role_name, [])
+        if email is not None:
+            owners.append(email)
 
-    # Expand role names into role owners
-    rec = []
-    role_names = db.session.query(distinct(Role.name)).all()
-    role_names = [el[0] for el in role_names]
+    role_names = set(role_owners.keys())
 
-    for recipient in recipients:
-        if recipient != 'Test':        # don't send mails to the Test role as everyone has it
+    addresses = set()
+    for recipients in recipient_lists:
+        for recipient in recipients:
             if recipient in role_names:
-                role_owners = db.session.query(User.email).join(User.roles).filter(Role.name == recipient).all()
-                if len(role_owners) == 0:
+                addresses.update(role_owners[recipient])
+            else:
+                addresses.add(recipient)
+
+    inactive = set(el[0] for el in db.session.query(User.email).filter(User.email.in_(addresses), User.active.is_(False)).all())
+
+    ret = []
+    for recipients in recipient_lists:
+        rec = []
+        for recipient in recipients:
+            if recipient in role_names:
+                if len(role_owners[recipient]) == 0:
                     current_app.logger.info('Empty role: %s' % recipient)
-                else:
-                    role_owners = [el[0] for el in role_owners]
-                    rec.extend(role_owners)
+                rec.extend(role_owners[recipient])
             else:
                 rec.append(recipient)
 
-    # check for disabled accounts and remove if found
-    checked_rec = []
+        checked_rec = []
+        for recipient in rec:
+            if recipient in inactive:
+                current_app.logger.info('Mail not sent to recipient %s - not active' % recipient)
+            elif recipient not in checked_rec:
+                checked_rec.append(recipient)
 
-    for recipient in rec:
-        active = db.session.query(User).filter_by(email = recipient).first().active
-        if active is None or active:
-            checked_rec.append(recipient)
-        else:
-            current_app.logger.info('Mail %s not sent to recipient %s - not active' % (subject, recipient))
+        ret.append(checked_rec)
 
-    rec = checked_rec
+    return ret
 
-    if len(rec) == 0:
-        current_app.logger.info('No recpients for mail %s' % (subject))
-        return
 
-    msg = Message(subject, sender=sender, recipients=rec)
-    ctx = ('email', template)
-    msg.body = render_template('%s/%s.txt' % ctx, **context)
-    msg.html = render_template('%s/%s.html' % ctx, **context)
-    mail = current_app.extensions.get('mail')
-    mail.send(msg)
-    time.sleep(3)
+class MailDispatcher:
+    def __init__(self, app):
+        self.app = app
+        self.event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='mail-dispatcher', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def wake(self):
+        self.event.set()
+
+    def run(self):
+        while True:
+            self.event.wait(MAIL_POLL_INTERVAL)
+            self.event.clear()
+
+            with self.app.app_context():
+                try:
+                    self.dispatch()
+                except Exception:
+                    self.app.logger.exception('Error dispatching mail')
+                finally:
+                    db.session.remove()
+
+    # Claim the pending messages that no other process has claimed
+    #
+    # Returns the messages, and a dict of message id to the claim time written, which identifies our claim. Times
+    # are whole seconds, so that they compare equal to the stored value
+
+    def claim(self):
+        now = datetime.utcnow().replace(microsecond=0)
+        stale = now - timedelta(seconds=MAIL_CLAIM_TIMEOUT)
+
+        candidates = db.session.query(MailOutbox.id)\
+            .filter(or_(MailOutbox.status == 'pending', and_(MailOutbox.status == 'sending', MailOutbox.claimed < stale)))\
+            .order_by(MailOutbox.id)\
+            .all()
+
+        claimed = []
+        for (message_id,) in candidates:
+            res = db.session.execute(
+                update(MailOutbox)
+                .where(MailOutbox.id == message_id,
+                       or_(MailOutbox.status == 'pending', and_(MailOutbox.status == 'sending', MailOutbox.claimed < stale)))
+                .values(status='sending', claimed=now)
+            )
+            if res.rowcount == 1:
+                claimed.append(message_id)
+
+        db.session.commit()
+
+        if len(claimed) == 0:
+            return [], {}
+
+        messages = db.session.query(MailOutbox).filter(MailOutbox.id.in_(claimed)).order_by(MailOutbox.id).all()
+        return messages, {message_id: now for message_id in claimed}
+
+    # Renew our claim on a message. Returns False if the claim has lapsed and another process has taken the message
+
+    def renew_claim(self, message_id, claims):
+        now = datetime.utcnow().replace(microsecond=0)
+
+        res = db.session.execute(
+            update(MailOutbox)
+            .where(MailOutbox.id == message_id, MailOutbox.status == 'sending', MailOutbox.claimed == claims[message_id])
+            .values(claimed=now)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+        if res.rowcount != 1:
+            del claims[message_id]
+            return False
+
+        claims[message_id] = now
+        return True
+
+    def dispatch(self):
+        messages, claims = self.claim()
+
+        if len(messages) == 0:
+            return
+
+        send_interval = float(self.app.config.get('MAIL_SEND_INTERVAL', DEFAULT_SEND_INTERVAL))
+        max_attempts = int(self.app.config.get('MAIL_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS))
+        recipient_lists = expand_recipients([json.loads(message.recipients) for message in messages])
+        mail = self.app.extensions.get('mail')
+
+        try:
+            with mail.connect() as conn:
+                for i, (message, rec) in enumerate(zip(messages, recipient_lists)):
+                    if len(rec) == 0:
+                        self.app.logger.info('No recpients for mail %s' % (message.subject))
+                        message.status = 'sent'
+                        message.sent = datetime.utcnow()
+                        db.session.commit()
+                        continue
+
+                    if i > 0:
+                        time.sleep(send_interval)
+
+                    if not self.renew_claim(message.id, claims):
+                        self.app.logger.info('Mail %s claimed by another process' % (message.subject))
+                        continue
+
+                    try:
+                        msg = Message(message.subject, sender=message.sender, recipients=rec)
+                        msg.body = message.body
+                        msg.html = message.html
+                        conn.send(msg)
+                        message.status = 'sent'
+                        message.sent = datetime.utcnow()
+                    except Exception as e:
+                        message.attempts = (message.attempts or 0) + 1
+                        message.last_error = str(e)
+                        message.status = 'pending' if message.attempts < max_attempts else 'failed'
+                        self.app.logger.error('Error sending mail %s: %s' % (message.subject, e))
+
+                    db.session.commit()
+        except Exception as e:
+            # most likely the connection to the server failed: return anything unsent to the queue
+            self.app.logger.error('Error connecting to mail server: %s' % e)
+            db.session.rollback()
+            for message_id, claimed in claims.items():
+                db.session.execute(
+                    update(MailOutbox)
+                    .where(MailOutbox.id == message_id, MailOutbox.status == 'sending', MailOutbox.claimed == claimed)
+                    .values(status='pending')
+                    .execution_options(synchronize_session=False)
+                )
+            db.session.commit()
+
+
+def init_mail_dispatcher(app):
+    global mail_dispatcher
+
+    mail_dispatcher = MailDispatcher(app)
+    mail_dispatcher.start()
+    mail_dispatcher.wake()      # send anything left over from before a restart
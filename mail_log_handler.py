@@ -4,7 +4,14 @@
 # the English version of which is available here: https://perma.cc/DK5U-NDVE
 #
 
+import atexit
 import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import traceback
+from datetime import datetime
 
 from flask_mail import Message
 from head import app
@@ -28,4 +35,99 @@ class FlaskMailLogHandler(logging.Handler):
                     body=self.format(record),
                     subject=self.subject
                 )
-            )
\ No newline at end of file
+            )
+
+
+# Queue handler that records a key for each record before it is formatted, so that identical errors can be recognised
+# in the digest. Formatting happens here, on the logging thread, where the request context is still available
+
+class KeyedQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        key = (record.levelname, record.module, record.getMessage())
+        record = super().prepare(record)
+        record.digest_key = key
+        return record
+
+
+# Collect records for a time window and send them as a single mail. Repeats of the same error within the window
+# are listed once, with a count
+
+class DigestMailLogHandler(FlaskMailLogHandler):
+
+    def __init__(self, mail, sender, recipients, subject, window, *args, **kwargs):
+        super(DigestMailLogHandler, self).__init__(mail, sender, recipients, subject, *args, **kwargs)
+        self.window = window
+        self.entries = {}
+        self.digest_lock = threading.Lock()
+        self.timer = None
+
+    def emit(self, record):
+        key = getattr(record, 'digest_key', record.getMessage())
+
+        with self.digest_lock:
+            if key in self.entries:
+                self.entries[key]['count'] += 1
+                self.entries[key]['last'] = record.created
+            else:
+                self.entries[key] = {'text': record.getMessage(), 'count': 1, 'first': record.created, 'last': record.created}
+
+            if self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.digest_lock:
+            entries = list(self.entries.values())
+            self.entries = {}
+            self.timer = None
+
+        if len(entries) == 0:
+            return
+
+        total = sum(entry['count'] for entry in entries)
+        body = []
+        for entry in entries:
+            if entry['count'] > 1:
+                body.append('%d occurrences between %s and %s:' % (entry['count'],
+                                                                   datetime.fromtimestamp(entry['first']).strftime('%Y-%m-%d %H:%M:%S'),
+                                                                   datetime.fromtimestamp(entry['last']).strftime('%Y-%m-%d %H:%M:%S')))
+            body.append(entry['text'])
+            body.append('')
+
+        subject = self.subject if total == 1 else '%s (%d errors)' % (self.subject, total)
+
+        try:
+            with app.app_context():
+                self.mail.send(Message(sender=self.sender, recipients=self.recipients, body='\n'.join(body), subject=subject))
+        except Exception:
+            traceback.print_exc(file=sys.stderr)     # don't log it: that would be mailed as well
+
+    def close(self):
+        with self.digest_lock:
+            if self.timer is not None:
+                self.timer.cancel()
+        self.flush()
+        super(DigestMailLogHandler, self).close()
+
+
+# Install a digest mail handler behind a queue, so that logging an error never waits on the mail server
+# Returns the handler to add to the logger
+
+def init_mail_log_handler(mail, sender, recipients, subject, level, formatter, window=60):
+    digest_handler = DigestMailLogHandler(mail, sender, recipients, subject, window)
+
+    queue_handler = KeyedQueueHandler(queue.Queue(-1))
+    queue_handler.setLevel(level)
+    queue_handler.setFormatter(formatter)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, digest_handler)
+    listener.start()
+
+    def stop():
+        listener.stop()
+        digest_handler.close()
+
+    atexit.register(stop)
+
+    return queue_handler
@@ -0,0 +1,160 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Catalog of the species, subgroups, loci and gene names offered in the selection dropdowns
+#
+# The distinct values are read from gene_description, germline_set and committee once, and kept in process memory.
+# The catalog is cleared when a record that could change them - a gene description or germline set whose status,
+# species, subgroup, locus or name changes, or any committee - is inserted, updated or deleted in this process.
+# Other worker processes see the change when their copy expires, after CATALOG_TTL seconds (default 60).
+#
+# The values offered depend on the user's committee roles, so they are computed per request from the cached values.
+# JSON responses carry an ETag and a short private Cache-Control lifetime.
+
+import threading
+import time
+
+from flask import jsonify, request
+from flask_login import current_user
+from sqlalchemy import event, inspect
+
+from head import app, db
+from db.gene_description_db import GeneDescription
+from db.germline_set_db import GermlineSet
+from db.misc_db import Committee
+
+DEFAULT_CATALOG_TTL = 60
+CATALOG_STATUSES = ['published', 'draft']
+TRACKED_FIELDS = ('status', 'species', 'species_subgroup', 'locus', 'sequence_name')
+
+catalog = {}
+catalog_lock = threading.Lock()
+
+
+def clear_catalog():
+    with catalog_lock:
+        catalog.clear()
+
+
+def _cached(key, loader):
+    now = time.monotonic()
+
+    with catalog_lock:
+        if key in catalog and catalog[key][0] > now:
+            return catalog[key][1]
+
+    value = loader()
+
+    with catalog_lock:
+        catalog[key] = (now + app.config.get('CATALOG_TTL', DEFAULT_CATALOG_TTL), value)
+
+    return value
+
+
+def _record_changed(mapper, connection, target):
+    clear_catalog()
+
+
+def _record_updated(mapper, connection, target):
+    state = inspect(target)
+    if any(field in state.attrs and state.attrs[field].history.has_changes() for field in TRACKED_FIELDS):
+        clear_catalog()
+
+
+for model in (GeneDescription, GermlineSet):
+    event.listen(model, 'after_insert', _record_changed)
+    event.listen(model, 'after_update', _record_updated)
+    event.listen(model, 'after_delete', _record_changed)
+
+for event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Committee, event_name, _record_changed)
+
+
+def published_gene_species():
+    return _cached('gene_species', lambda: frozenset(
+        row[0] for row in db.session.query(GeneDescription.species).filter(GeneDescription.status == 'published').distinct()))
+
+
+def published_germline_set_species():
+    return _cached('germline_set_species', lambda: frozenset(
+        row[0] for row in db.session.query(GermlineSet.species).filter(GermlineSet.status == 'published').distinct()))
+
+
+def species_gene_entries(species):
+    """
+    The distinct (species_subgroup, locus, status, sequence_name) of the published and draft gene descriptions of a species
+    """
+    return _cached(('gene_entries', species), lambda: tuple(
+        tuple(row) for row in db.session.query(GeneDescription.species_subgroup, GeneDescription.locus, GeneDescription.status, GeneDescription.sequence_name)
+        .filter(GeneDescription.species == species, GeneDescription.status.in_(CATALOG_STATUSES))
+        .distinct()))
+
+
+def committee_loci(species):
+    def load():
+        loci = db.session.query(Committee.loci).filter(Committee.species == species).one_or_none()
+        return tuple(l.strip() for l in loci[0].split(',') if l.strip()) if loci and loci[0] else ()
+
+    return _cached(('committee_loci', species), load)
+
+
+def user_committees():
+    if not current_user.is_authenticated:
+        return []
+    return [role.name for role in current_user.roles if role.name not in ('Admin', 'AdminEdit')]
+
+
+def has_committee_access(species):
+    return current_user.is_authenticated and current_user.has_role(species)
+
+
+def visible_statuses(species):
+    return ('published', 'draft') if has_committee_access(species) else ('published',)
+
+
+def available_gene_species():
+    """Species that have published sequences, and species of the user's committees"""
+    return sorted(set(published_gene_species()) | set(user_committees()))
+
+
+def available_germline_set_species():
+    """Species that have published germline sets, and species of the user's committees"""
+    return sorted(set(published_germline_set_species()) | set(user_committees()))
+
+
+def available_subgroups(species):
+    """Subgroups of a species' published sequences, and of its draft sequences if the user is on the committee"""
+    statuses = visible_statuses(species)
+    return sorted(set(subgroup for subgroup, locus, status, name in species_gene_entries(species)
+                      if status in statuses and subgroup and subgroup != 'none'))
+
+
+def available_loci(species, subgroup=None):
+    """Loci of a species' published sequences, and all the committee's loci if the user is on the committee"""
+    loci = set(locus for sg, locus, status, name in species_gene_entries(species)
+               if status == 'published' and locus and (not subgroup or sg == subgroup))
+
+    if has_committee_access(species):
+        loci.update(committee_loci(species))
+
+    return sorted(loci)
+
+
+def available_gene_names(species, locus):
+    """Gene names (sequence names without allele designation) at a locus, including drafts if the user is on the committee"""
+    statuses = visible_statuses(species)
+    return sorted(set(name.split('*')[0] for sg, loc, status, name in species_gene_entries(species)
+                      if status in statuses and loc == locus and name))
+
+
+def catalog_response(values):
+    """JSON response for a dropdown endpoint, with an ETag and a short private cache lifetime"""
+    response = jsonify(values)
+    response.cache_control.private = True
+    response.cache_control.max_age = app.config.get('CATALOG_TTL', DEFAULT_CATALOG_TTL)
+    response.vary.add('Cookie')
+    response.add_etag()
+    return response.make_conditional(request)
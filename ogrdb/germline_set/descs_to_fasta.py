@@ -6,6 +6,18 @@ from sequence_format import format_fasta_sequence
 def descs_to_fasta(descs, format, fake_allele=False, extend=False):
     """
     Convert gene descriptions to FASTA format.
+
+    Returns:
+        String containing FASTA-formatted sequences with 60-character line width
+
+    See iter_descs_to_fasta for details.
+    """
+    return ''.join(iter_descs_to_fasta(descs, format, fake_allele, extend))
+
+
+def iter_descs_to_fasta(descs, format, fake_allele=False, extend=False):
+    """
+    Convert gene descriptions to FASTA format, one record at a time.
     
     Args:
         descs: List of gene description objects containing sequence information
@@ -14,9 +26,9 @@ def descs_to_fasta(descs, format, fake_allele=False, extend=False):
         extend: If True, groups sequences by coding_seq_imgt and selects representatives,
                 extending sequences with 3' extensions when available
     
-    Returns:
-        String containing FASTA-formatted sequences with 60-character line width
-        
+    Yields:
+        FASTA-formatted records with 60-character line width
+
     Notes:
         - When extend=True, selects one representative per sequence group based on:
           1. paralog_rep flag (if present)
@@ -25,8 +37,6 @@ def descs_to_fasta(descs, format, fake_allele=False, extend=False):
         - Removes trailing gaps from gapped sequences
         - Skips sequences with empty coding_seq_imgt
     """
-    ret = ''
- 
     gds = []
     sc_gds = []
     if extend:
@@ -102,13 +112,13 @@ def descs_to_fasta(descs, format, fake_allele=False, extend=False):
                 cs = cs[:-1]
             if extend and desc.ext_3prime:
                 cs += desc.ext_3prime
-            ret += format_fasta_sequence(name, cs, 60)
+            yield format_fasta_sequence(name, cs, 60)
         else:
             seq = coding_seq.replace('.', '')
             seq = seq.replace('-', '')
             if extend and desc.ext_3prime:
                 seq += desc.ext_3prime
-            ret += format_fasta_sequence(name, seq, 60)
+            yield format_fasta_sequence(name, seq, 60)
 
     for desc in sc_gds:
         name = desc.sequence_name
@@ -126,6 +136,4 @@ def descs_to_fasta(descs, format, fake_allele=False, extend=False):
 
         seq = coding_seq.replace('.', '')
         seq = seq.replace('-', '')
-        ret += format_fasta_sequence(name + '_SC', seq, 60)
-        
-    return ret
\ No newline at end of file
+        yield format_fasta_sequence(name + '_SC', seq, 60)
@@ -8,6 +8,7 @@ import copy
 
 from flask import url_for
 from db.germline_set_db import *
+from permission_context import get_permission_context
 
 
 def make_germline_action_string(item):
@@ -96,6 +97,7 @@ class GermlineSetListDoiCol(StyledCol):
 
 def setup_germline_set_list_table(results, current_user):
     table = make_GermlineSet_table(results)
+    current_user = get_permission_context(current_user)
     for item in table.items:
         item.viewable = item.can_see(current_user)
         item.editable = item.can_edit(current_user)
@@ -117,6 +119,7 @@ def setup_published_germline_set_list_info(results, current_user, extended):
         affirmed.add_column('download', GermlineSetListDownloadCol('Download'))
 
     add_actions = False
+    current_user = get_permission_context(current_user)
     for item in affirmed.items:
         item.viewable = item.can_see(current_user)
         item.editable = item.can_edit(current_user)
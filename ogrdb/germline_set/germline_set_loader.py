@@ -0,0 +1,58 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Bulk loading of germline sets for export
+#
+# germline_set_to_airr reads several collections of every gene description in the set. Left to lazy loading,
+# that is a handful of SELECTs per allele. The options below fetch the set and everything the exporters touch
+# in a fixed number of queries, whatever the size of the set.
+
+from sqlalchemy.orm import selectinload, joinedload, configure_mappers
+
+from head import db
+from db.germline_set_db import GermlineSet
+from db.gene_description_db import GeneDescription
+from db.inferred_sequence_db import InferredSequence
+from db.submission_db import Submission
+
+
+def germline_set_export_options():
+    # Relationships defined as backrefs only exist as class attributes once the mappers are configured
+    configure_mappers()
+
+    return (
+        selectinload(GermlineSet.gene_descriptions).options(
+            selectinload(GeneDescription.acknowledgements),
+            selectinload(GeneDescription.genomic_accessions),
+            selectinload(GeneDescription.inferred_sequences).options(
+                joinedload(InferredSequence.sequence_details),
+                joinedload(InferredSequence.submission).selectinload(Submission.repertoire),
+            ),
+        ),
+        selectinload(GermlineSet.acknowledgements),
+        selectinload(GermlineSet.pub_ids),
+        selectinload(GermlineSet.notes_entries),
+    )
+
+
+def load_germline_set(set_id):
+    """
+    Load a germline set with its gene descriptions and all the child collections used by germline_set_to_airr,
+    descs_to_fasta and the Zenodo file builder.
+
+    Any copy of the set already in the session is refreshed, so that the eager loads take effect.
+
+    Args:
+        set_id: GermlineSet.id of the set to load
+
+    Returns:
+        the GermlineSet, or None if there is no such set
+    """
+    return db.session.query(GermlineSet)\
+        .options(*germline_set_export_options())\
+        .execution_options(populate_existing=True)\
+        .filter(GermlineSet.id == set_id)\
+        .one_or_none()
@@ -34,8 +34,13 @@ from forms.germline_set_selection_form import GermlineSetSelectionForm
 from forms.journal_entry_form import JournalEntryForm
 from forms.notes_entry_form import NotesEntryForm
 from ogrdb.germline_set.descs_to_fasta import descs_to_fasta
+from ogrdb.germline_set.germline_set_loader import load_germline_set
+from ogrdb.germline_set.germline_set_service import resolve_germline_set, send_germline_set, clear_germline_set_resolutions, \
+    DOWNLOAD_FORMATS, NO_SEQUENCES, RENDER_FAILED
+from api_v2.api import prerender_germline_set
 
 from ogrdb.sequence.gene_table import get_available_species
+from ogrdb.catalog import available_germline_set_species
 from ogrdb.sequence.sequence_list_table import setup_sequence_list_table
 from ogrdb.sequence.sequence_routes import publish_sequence
 from ogrdb.submission.submission_edit_form import process_table_updates
@@ -43,10 +48,11 @@ from ogrdb.submission.submission_view_form import HiddenReturnForm
 
 from ogrdb.germline_set.germline_set_list_table import setup_germline_set_list_table, setup_published_germline_set_list_info
 from ogrdb.germline_set.germline_set_table import setup_germline_set_edit_tables, list_germline_set_changes
+from ogrdb.release_diff import store_germline_set_diff
 from ogrdb.germline_set.germline_set_view_form import setup_germline_set_view_tables
 
 from textile_filter import safe_textile
-from ogrdb.germline_set.to_airr import germline_set_to_airr
+from ogrdb.germline_set.to_airr import germline_set_to_airr, stream_germline_set_to_airr
 
 from journal import add_history
 from mail import send_mail
@@ -83,22 +89,7 @@ def germline_sets():
 
 def get_available_germline_set_species():
     """Get species that have published germline sets or unpublished sets for user's committees"""
-    species_set = set()
-    
-    # Get species with published germline sets
-    published_species = db.session.query(GermlineSet.species).filter(
-        GermlineSet.status == 'published'
-    ).distinct().all()
-    species_set.update([s[0] for s in published_species])
-    
-    # If user is authenticated and has committee roles, add species
-    if current_user.is_authenticated:
-        user_committees = [role.name for role in current_user.roles if role.name not in ('Admin', 'AdminEdit')]
-        
-        for committee_species in user_committees:
-            species_set.add(committee_species)
-    
-    return sorted(list(species_set))
+    return available_germline_set_species()
 
 
 @app.route('/germline_sets/<species>', methods=['GET', 'POST'])
@@ -307,6 +298,9 @@ def edit_germline_set(id):
                     germline_set.doi = ''
                     germline_set.status = 'published'
                     db.session.commit()
+                    store_germline_set_diff(germline_set)
+                    clear_germline_set_resolutions()
+                    prerender_germline_set(germline_set)
                     flash('Germline set published')
                     return redirect(url_for('germline_sets', species=germline_set.species))
 
@@ -604,6 +598,7 @@ def withdraw_germline_set(id):
         send_mail('Germline set %s version %d withdrawn by the IARC %s Committee' % (set.germline_set_id, set.release_version, set.species), [set.species], 'iarc_germline_set_withdrawn', reviewer=current_user, user_name=set.author, germline_set=set, comment='')
         set.status = 'withdrawn'
         db.session.commit()
+        clear_germline_set_resolutions()
         flash('Germline set %s withdrawn' % set.germline_set_name)
 
         db.session.commit()
@@ -808,45 +803,21 @@ def download_germline_set_by_name(species, subspecies, germline_set_name, versio
     subspecies = parse.unquote(parse.unquote(subspecies)) if subspecies else None
     germline_set_name = parse.unquote(parse.unquote(germline_set_name))
 
-    # check for common species name
-
-    requested_species = species
-
-    q = db.session.query(SpeciesLookup).filter(SpeciesLookup.common == species).one_or_none()
-    if q:
-        species = q.binomial
+    resolution = resolve_germline_set(species, subspecies, germline_set_name, version)
 
-    q = db.session.query(
-            GermlineSet.id,
-        )\
-        .filter(GermlineSet.species == species)\
-        .filter(GermlineSet.germline_set_name == germline_set_name)\
-        .distinct()    
-    
-    if subspecies:
-        q = q.filter(GermlineSet.species_subgroup == subspecies)
-    
-    if version == 'published' or version == 'latest':
-        q = q.filter(GermlineSet.status == 'published')
-    else:
-        if not version.isdigit():
-            flash('Invalid version')
-            return redirect('/')
-        
-        q = q.filter(GermlineSet.release_version == int(version))\
-            .filter(or_(GermlineSet.status == 'published', GermlineSet.status == 'superceded'))
-
-    result = q.one_or_none()
-
-    if result:
-        return download_germline_set_by_id(result[0], format, requested_species)
+    if resolution.set_id:
+        return download_germline_set_by_id(resolution.set_id, format, species)
     else:
         flash('Invalid version')
         return redirect('/')
 
 
+def render_airr_for_download(germline_set, extend, taxonomy):
+    return stream_germline_set_to_airr(germline_set, extend, taxonomy, fake_allele=True, indent=4)
+
+
 def download_germline_set_by_id(set_id, format, use_species_name=None):
-    if format not in ['gapped', 'ungapped', 'airr', 'gapped_ex', 'ungapped_ex', 'airr_ex']:
+    if format not in DOWNLOAD_FORMATS:
         flash('Invalid format')
         return redirect('/')
 
@@ -855,28 +826,13 @@ def download_germline_set_by_id(set_id, format, use_species_name=None):
         flash('Germline set not found')
         return redirect('/')
 
-    if len(germline_set.gene_descriptions) < 1:
-        flash('No sequences to download')
-        return redirect('/')
-    
-    extend = False
-    if '_ex' in format:
-        extend = True
-
-    species_for_file = use_species_name if use_species_name else germline_set.species
-    species_for_file = species_for_file.replace(' ', '_')
-
-    if 'airr' in format:
-        taxonomy = db.session.query(SpeciesLookup.ncbi_taxon_id).filter(SpeciesLookup.binomial == germline_set.species).one_or_none()
-        taxonomy = taxonomy[0] if taxonomy else 0
+    response, error = send_germline_set(germline_set.id, format, render_airr_for_download, airr_variant='web', species_name=use_species_name, extended_human_only=False)
 
-        dl = json.dumps(germline_set_to_airr(germline_set, extend, taxonomy, fake_allele=True), default=str, indent=4)
-        filename = '%s_%s_rev_%d%s.json' % (species_for_file, germline_set.germline_set_name, germline_set.release_version, '_ex' if 'ex' in format else '')
-    else:
-        dl = descs_to_fasta(germline_set.gene_descriptions, format, fake_allele=True, extend=extend)
-        filename = '%s_%s_rev_%d_%s.fasta' % (species_for_file, germline_set.germline_set_name, germline_set.release_version, format)
+    if error:
+        flash(error if error in (NO_SEQUENCES, RENDER_FAILED) else 'Germline set not found')
+        return redirect('/')
 
-    return Response(dl, mimetype="application/octet-stream", headers={"Content-disposition": "attachment; filename=%s" % filename})
+    return response
 
 
 zenodo_metadata_template = {
@@ -893,6 +849,7 @@ zenodo_metadata_template = {
 }
 
 def make_files_for_zenodo(germline_set):
+    germline_set = load_germline_set(germline_set.id)
     filenames = []
     filedesc_pairs = []
 
@@ -0,0 +1,257 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Resolution and download of germline sets, shared by API v1, API v2 and the web site's download routes
+#
+# A request names a set by species (binomial, common name or NCBI taxon id), optional species subgroup, set name
+# and release version ('published' or 'latest' for the current release). resolve_germline_set turns this into a
+# GermlineSet.id with at most two queries, and caches the answer - including 'not found' answers - for
+# GERMLINE_SET_RESOLUTION_TTL seconds (default 60). The cache is cleared in this process when a set is published
+# or withdrawn: other worker processes see the change when their entries expire.
+#
+# send_germline_set serves a rendering from the download cache, rendering and storing it on a miss. FASTA renderings
+# are the same whichever front end asks for them, and are cached once. Each front end supplies its own AIRR renderer,
+# and its AIRR renderings are cached under a name of its own.
+
+import itertools
+import threading
+import time
+from collections import namedtuple
+
+from flask import Response, send_file, stream_with_context
+
+from head import app, db
+from db.germline_set_db import GermlineSet
+from db.species_lookup_db import SpeciesLookup
+from api_v2.download_cache import get_cached_download, store_download, is_cacheable
+from ogrdb.germline_set.descs_to_fasta import iter_descs_to_fasta
+from ogrdb.germline_set.germline_set_loader import load_germline_set
+
+DOWNLOAD_FORMATS = ['gapped', 'ungapped', 'airr', 'gapped_ex', 'ungapped_ex', 'airr_ex']
+RELEASED_STATUSES = ['published', 'superceded']
+
+DEFAULT_RESOLUTION_TTL = 60
+
+# Resolution and download errors. Front ends map these to their own responses
+
+SPECIES_NOT_FOUND = 'Species not found'
+SUBGROUP_NOT_FOUND = 'Species subgroup not found'
+SET_NOT_FOUND = 'Germline set name not found'
+VERSION_NOT_FOUND = 'Germline set version not found'
+INVALID_VERSION = 'Invalid release_version'
+SUPERCEDED = 'This set has been superceded: there is no current published version'
+INVALID_FORMAT = 'invalid format specified'
+NO_SEQUENCES = 'No sequences to download'
+RENDER_FAILED = 'Error rendering germline set'
+
+# set_id is None if the set could not be resolved, in which case error says why. latest_version is the most recent
+# release of the named set, if there is one
+
+GermlineSetResolution = namedtuple('GermlineSetResolution', ['set_id', 'error', 'species', 'latest_version'])
+
+resolutions = {}
+resolutions_lock = threading.Lock()
+
+
+def clear_germline_set_resolutions():
+    with resolutions_lock:
+        resolutions.clear()
+
+
+def resolve_species(species):
+    """
+    Find the binomial name of a species given as a binomial, a common name, or an NCBI taxon id
+
+    Returns:
+        the binomial, or None if a taxon id is not known
+    """
+    if isinstance(species, int) or species.isdigit():
+        row = db.session.query(SpeciesLookup.binomial).filter(SpeciesLookup.ncbi_taxon_id == int(species)).first()
+        return row[0] if row else None
+
+    row = db.session.query(SpeciesLookup.binomial).filter(SpeciesLookup.common == species).first()
+    return row[0] if row else species
+
+
+def parse_release_version(version):
+    if version in ('published', 'latest'):
+        return version
+
+    try:
+        version = float(version)
+    except (TypeError, ValueError):
+        return None
+
+    return int(version) if version.is_integer() else None
+
+
+def _resolve(species, species_subgroup, germline_set_name, version):
+    binomial = resolve_species(species)
+
+    if binomial is None:
+        return GermlineSetResolution(None, SPECIES_NOT_FOUND, None, None)
+
+    release_version = parse_release_version(version)
+
+    if release_version is None:
+        return GermlineSetResolution(None, INVALID_VERSION, binomial, None)
+
+    rows = db.session.query(GermlineSet.id, GermlineSet.species_subgroup, GermlineSet.germline_set_name, GermlineSet.release_version, GermlineSet.status)\
+        .filter(GermlineSet.species == binomial)\
+        .filter(GermlineSet.status.in_(RELEASED_STATUSES))\
+        .all()
+
+    if not rows:
+        return GermlineSetResolution(None, SPECIES_NOT_FOUND, binomial, None)
+
+    if species_subgroup:
+        rows = [row for row in rows if row.species_subgroup == species_subgroup]
+        if not rows:
+            return GermlineSetResolution(None, SUBGROUP_NOT_FOUND, binomial, None)
+
+    rows = [row for row in rows if row.germline_set_name == germline_set_name]
+
+    if not rows:
+        return GermlineSetResolution(None, SET_NOT_FOUND, binomial, None)
+
+    latest_version = max(row.release_version for row in rows)
+
+    if release_version in ('published', 'latest'):
+        rows = [row for row in rows if row.status == 'published']
+        if not rows:
+            return GermlineSetResolution(None, SUPERCEDED, binomial, latest_version)
+    else:
+        rows = [row for row in rows if row.release_version == release_version]
+        if not rows:
+            return GermlineSetResolution(None, VERSION_NOT_FOUND, binomial, latest_version)
+
+    return GermlineSetResolution(rows[0].id, None, binomial, latest_version)
+
+
+def resolve_germline_set(species, species_subgroup, germline_set_name, version):
+    """
+    Find the published or superceded germline set named by a download request
+
+    Args:
+        species: binomial, common name, or NCBI taxon id
+        species_subgroup: species subgroup, or None if the request does not specify one
+        germline_set_name: name of the set
+        version: release version, or 'published' or 'latest' for the current published release
+
+    Returns:
+        GermlineSetResolution
+    """
+    key = (str(species), species_subgroup, germline_set_name, str(version))
+    now = time.monotonic()
+
+    with resolutions_lock:
+        if key in resolutions and resolutions[key][0] > now:
+            return resolutions[key][1]
+
+    resolution = _resolve(str(species), species_subgroup, germline_set_name, str(version))
+
+    with resolutions_lock:
+        resolutions[key] = (now + app.config.get('GERMLINE_SET_RESOLUTION_TTL', DEFAULT_RESOLUTION_TTL), resolution)
+
+    return resolution
+
+
+def germline_set_filename(germline_set, format, species_name=None):
+    species_for_file = (species_name if species_name else germline_set.species).replace(' ', '_')
+
+    if 'airr' in format:
+        return '%s_%s_rev_%d%s.json' % (species_for_file, germline_set.germline_set_name, germline_set.release_version, '_ex' if 'ex' in format else '')
+
+    return '%s_%s_rev_%d_%s.fasta' % (species_for_file, germline_set.germline_set_name, germline_set.release_version, format)
+
+
+def download_cache_format(format, airr_variant=None):
+    if 'airr' in format and airr_variant:
+        return '%s_%s' % (airr_variant, format)
+
+    return format
+
+
+def render_germline_set(germline_set, format, render_airr):
+    """
+    Render a germline set in the given download format. The rendering is streamed.
+
+    Args:
+        germline_set: the GermlineSet, as returned by load_germline_set
+        format: one of DOWNLOAD_FORMATS
+        render_airr: function(germline_set, extend, taxonomy) returning an iterable of str, used for AIRR formats
+
+    Returns:
+        iterable yielding the rendered content
+    """
+    extend = '_ex' in format
+
+    if 'airr' in format:
+        taxonomy = db.session.query(SpeciesLookup.ncbi_taxon_id).filter(SpeciesLookup.binomial == germline_set.species).one_or_none()
+        taxonomy = taxonomy[0] if taxonomy else 0
+        return render_airr(germline_set, extend, taxonomy)
+
+    return iter_descs_to_fasta(germline_set.gene_descriptions, format, fake_allele=True, extend=extend)
+
+
+def send_germline_set(set_id, format, render_airr, airr_variant=None, species_name=None, extended_human_only=True):
+    """
+    Send a germline set as a file download.
+
+    Published and superceded releases are served from the download cache, with an ETag. Renderings that are
+    not yet in the cache are added to it. Other sets are rendered and streamed.
+
+    Args:
+        set_id: GermlineSet.id
+        format: one of DOWNLOAD_FORMATS
+        render_airr: AIRR renderer, as for render_germline_set
+        airr_variant: name under which AIRR renderings are cached: front ends whose renderings differ must use different names
+        species_name: species name to use in the filename, if not the set's binomial
+        extended_human_only: if True, extended formats are only available for human sets
+
+    Returns:
+        (Response, None), or (None, error)
+    """
+    if format not in DOWNLOAD_FORMATS:
+        return None, INVALID_FORMAT
+
+    germline_set = db.session.query(GermlineSet).filter(GermlineSet.id == set_id).one_or_none()
+
+    if not germline_set:
+        return None, SET_NOT_FOUND
+
+    if extended_human_only and '_ex' in format and 'Homo sapiens' not in germline_set.species:
+        return None, SET_NOT_FOUND
+
+    cache_format = download_cache_format(format, airr_variant)
+    cached = get_cached_download(germline_set, cache_format)
+
+    if cached is None:
+        germline_set = load_germline_set(germline_set.id)
+
+        if len(germline_set.gene_descriptions) < 1:
+            return None, NO_SEQUENCES
+
+        content = render_germline_set(germline_set, format, render_airr)
+        filename = germline_set_filename(germline_set, format, species_name)
+
+        if not is_cacheable(germline_set):
+            # Headers are sent before the body is streamed, so start rendering here: an error found now can still be reported
+
+            content = iter(content)
+            try:
+                first = next(content, '')
+            except Exception:
+                app.logger.exception('Error rendering germline set %d' % germline_set.id)
+                return None, RENDER_FAILED
+
+            return Response(stream_with_context(itertools.chain([first], content)), mimetype="application/octet-stream", headers={"Content-disposition": "attachment; filename=%s" % filename}), None
+
+        cached = store_download(germline_set, cache_format, content, filename)
+
+    path, digest, filename = cached
+    filename = germline_set_filename(germline_set, format, species_name)
+    return send_file(path, mimetype="application/octet-stream", as_attachment=True, download_name=filename, etag=digest, conditional=True), None
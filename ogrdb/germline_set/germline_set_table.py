@@ -15,6 +15,7 @@ from flask import url_for
 from db.gene_description_db import *
 from ogrdb.sequence.inferred_sequence_table import MessageHeaderCol, MessageBodyCol
 from operator import attrgetter
+from ogrdb.release_diff import germline_set_diff
 
 
 class GeneDescriptionTableActionCol(StyledCol):
@@ -170,62 +171,29 @@ def setup_gene_description_table(germline_set, action=True):
     return table
 
 def list_germline_set_changes(germline_set):
-    if germline_set.status == 'draft':
-        prev = db.session.query(GermlineSet).filter(GermlineSet.germline_set_id == germline_set.germline_set_id, GermlineSet.status == 'published').one_or_none()
+    diff = germline_set_diff(germline_set)
 
-        if prev is None:
-            prevs = db.session.query(GermlineSet).filter(GermlineSet.germline_set_id == germline_set.germline_set_id, GermlineSet.status == 'superceded').all()
-
-            if len(prevs) > 0:
-                prev = sorted(prevs, key=attrgetter('release_version'), reverse=True)[0]
-    else:
-        prev = None
-        prevs = db.session.query(GermlineSet).filter(GermlineSet.germline_set_id == germline_set.germline_set_id, GermlineSet.status.in_(['published', 'superceded']))\
-            .filter(GermlineSet.release_version < germline_set.release_version)\
-            .all()
-
-        if len(prevs) > 0:
-            prev = sorted(prevs, key=attrgetter('release_version'), reverse=True)[0]
-
-    if prev is None:
+    if diff['prev_id'] is None:
         return ''
 
-    current_descs = {}
-    for desc in germline_set.gene_descriptions:
-        current_descs[desc.description_id] = desc
-
-    prev_descs = {}
-    for desc in prev.gene_descriptions:
-        prev_descs[desc.description_id] = desc
-
     added = []
     removed = []
     changed = []
 
-    for gid, prev_desc in prev_descs.items():
-        if gid not in current_descs.keys():
-            removed.append('<a href="%s">%s</a>' % (url_for('sequence', id=prev_descs[gid].id), prev_descs[gid].sequence_name))
-
-    for gid, current_desc in current_descs.items():
-        if gid not in prev_descs.keys():
-            added.append('<a href="%s">%s</a>' % (url_for('sequence', id=current_desc.id), current_desc.sequence_name))
-
-    for gid, current_desc in current_descs.items():
-        if gid in prev_descs.keys() and current_desc.id != prev_descs[gid].id:
-            if current_desc.coding_seq_imgt == prev_descs[gid].coding_seq_imgt:
-                changed.append('<a href="%s">%s</a>: v%d->%s' % (
-                    url_for('sequence', id=current_desc.id),
-                    current_desc.sequence_name,
-                    prev_descs[gid].release_version,
-                    'v%d' % current_desc.release_version if current_desc.status != 'draft' else 'draft',
-                ))
-            else:
-                changed.append('<a href="%s">%s</a>: v%d->%s, sequence changed' % (
-                    url_for('sequence', id=current_desc.id),
-                    current_desc.sequence_name,
-                    prev_descs[gid].release_version,
-                    'v%d' % current_desc.release_version if current_desc.status != 'draft' else 'draft'
-                ))
+    for desc in diff['removed']:
+        removed.append('<a href="%s">%s</a>' % (url_for('sequence', id=desc['id']), desc['sequence_name']))
+
+    for desc in diff['added']:
+        added.append('<a href="%s">%s</a>' % (url_for('sequence', id=desc['id']), desc['sequence_name']))
+
+    for desc in diff['changed']:
+        changed.append('<a href="%s">%s</a>: v%d->%s%s' % (
+            url_for('sequence', id=desc['id']),
+            desc['sequence_name'],
+            desc['prev_version'],
+            'v%d' % desc['version'] if desc['version'] is not None else 'draft',
+            ', sequence changed' if desc['sequence_changed'] else '',
+        ))
 
     history = []
 
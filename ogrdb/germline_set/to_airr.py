@@ -11,6 +11,22 @@ import re
 
 
 def germline_set_to_airr(germline_set, extend, taxonomy, fake_allele=False):
+    ad = list(iter_airr_allele_descriptions(germline_set, extend, taxonomy, fake_allele))
+    return airr_germline_set(germline_set, ad, extend, taxonomy)
+
+
+# Streamed equivalent of json.dumps(germline_set_to_airr(...), default=str, indent=indent)
+# Allele descriptions are built and serialised one at a time, so memory use does not grow with the size of the set
+
+def stream_germline_set_to_airr(germline_set, extend, taxonomy, fake_allele=False, indent=4):
+    skeleton = json.dumps(airr_germline_set(germline_set, None, extend, taxonomy), default=str, indent=indent)
+    items = (json.dumps(ad, default=str, indent=indent) for ad in iter_airr_allele_descriptions(germline_set, extend, taxonomy, fake_allele))
+    return stream_json_with_list(skeleton, 'allele_descriptions', items, indent)
+
+
+# Gene descriptions to include in the AIRR representation. The extended set has one representative of each coding sequence
+
+def select_gene_descriptions(germline_set, extend):
     gds = []
     if extend:
         sequences = {}
@@ -41,11 +57,16 @@ def germline_set_to_airr(germline_set, extend, taxonomy, fake_allele=False):
     else:
         gds.extend(germline_set.gene_descriptions)
 
-    ad = []
-    for desc in gds:
-        ad.append(vars(AIRRAlleleDescription(desc, extend, fake_allele, taxonomy=taxonomy)))
+    return gds
 
-    gs = {'GermlineSet': [vars(AIRRGermlineSet(germline_set, ad, taxonomy=taxonomy))]}
+
+def iter_airr_allele_descriptions(germline_set, extend, taxonomy, fake_allele=False):
+    for desc in select_gene_descriptions(germline_set, extend):
+        yield vars(AIRRAlleleDescription(desc, extend, fake_allele, taxonomy=taxonomy))
+
+
+def airr_germline_set(germline_set, allele_descriptions, extend, taxonomy):
+    gs = {'GermlineSet': [vars(AIRRGermlineSet(germline_set, allele_descriptions, taxonomy=taxonomy))]}
 
     if extend:
         gs['GermlineSet'][0]['germline_set_name'] += '_extended'
@@ -53,6 +74,46 @@ def germline_set_to_airr(germline_set, extend, taxonomy, fake_allele=False):
     return gs
 
 
+def stream_json_with_list(skeleton, field, items, indent=None):
+    """
+    Splice a stream of serialised list elements into a serialised JSON document.
+
+    Args:
+        skeleton: the document, serialised with the list field set to null
+        field: name of the list field
+        items: iterable yielding each element of the list, serialised with the same indent as the skeleton
+        indent: indent used for serialisation, or None for compact serialisation
+
+    Returns:
+        generator yielding the document in pieces. The concatenated output is identical to serialising the complete
+        document in one go (an empty list is rendered as null, as the AIRR representation uses null for empty lists)
+    """
+    sep = ': ' if indent is not None else ':'
+    head, tail = skeleton.split('"%s"%snull' % (field, sep), 1)
+    yield head + '"%s"%s' % (field, sep)
+
+    items = iter(items)
+    first = next(items, None)
+
+    if first is None:
+        yield 'null'
+    elif indent is None:
+        yield '[' + first
+        for item in items:
+            yield ',' + item
+        yield ']'
+    else:
+        line = head[head.rfind('\n') + 1:]
+        outer = line[:len(line) - len(line.lstrip(' '))]
+        inner = outer + ' ' * indent
+        yield '[\n' + inner + first.replace('\n', '\n' + inner)
+        for item in items:
+            yield ',\n' + inner + item.replace('\n', '\n' + inner)
+        yield '\n' + outer + ']'
+
+    yield tail
+
+
 # Enforce schema constraints on capitalisation, and use None explicitly rather than empty string
 def enum_choice(val, choice_list):
     if not val:
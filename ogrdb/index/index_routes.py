@@ -14,10 +14,9 @@ from werkzeug.utils import redirect
 
 from db.misc_db import Committee
 from db.userdb import User, Role
-from db.germline_set_db import GermlineSet
-from db.gene_description_db import GeneDescription
 from forms.security import ExtendedRegisterForm, FirstAccountForm, ProfileForm, save_Profile
 from head import app, security, db
+from ogrdb.index.landing_snapshot import get_landing_snapshot
 
 user_datastore = SQLAlchemyUserDatastore(db, User, Role)
 security = security.init_app(app, user_datastore, confirm_register_form=ExtendedRegisterForm)
@@ -47,65 +46,11 @@ def index():
             user_datastore.add_role_to_user(current_user, 'Test')
             db.session.commit()
 
-    # Get news from Wordpress
+    # News and database statistics are refreshed in the background
 
-    news_items = []
+    snapshot = get_landing_snapshot()
 
-    try:
-        cat_url = None
-        wp_url = app.config['WORDPRESS_NEWS_URL'] + app.config['WORDPRESS_REST']
-        r = requests.get(wp_url + 'categories')
-        if r.status_code == 200:
-            resp = r.content.decode("utf-8")
-            resp = json.loads(resp)
-
-            for rec in resp:
-                if rec['slug'] == 'ogrdb_news':
-                    cat_url = '%sposts?categories=%s' % (wp_url, rec['id'])
-
-        if cat_url:
-            r = requests.get(cat_url + '&per_page=5')
-            if r.status_code == 200:
-                resp = r.content.decode("utf-8")
-                resp = json.loads(resp)
-
-                for item in resp:
-                    news_items.append({
-                    'date': item['date'].split('T')[0],
-                    'title': item['title']['rendered'],
-                    'excerpt': item['excerpt']['rendered'],
-                    'link': item['link'],
-                })
-    except:
-        pass
-
-    # Calculate database statistics
-    stats = {
-        'germline_sets': 0,
-        'sequences': 0,
-        'species': 0,
-        'last_updated': 'N/A'
-    }
-    
-    try:
-        # Count published germline sets
-        stats['germline_sets'] = db.session.query(GermlineSet).filter(GermlineSet.status == 'published').count()
-        
-        # Count distinct species with published germline sets
-        stats['species'] = db.session.query(GermlineSet.species).filter(GermlineSet.status == 'published').distinct().count()
-        
-        # Count total sequences (gene descriptions)
-        stats['sequences'] = db.session.query(GeneDescription).count()
-        
-        # Get most recent release date from published germline sets
-        latest_release = db.session.query(GermlineSet.release_date).filter(GermlineSet.status == 'published').order_by(GermlineSet.release_date.desc()).first()
-        if latest_release and latest_release[0]:
-            stats['last_updated'] = latest_release[0]
-    except Exception as e:
-        print(f"Error calculating database statistics: {e}")
-        pass
-
-    return render_template('index.html', current_user=current_user, news_items=news_items, stats=stats)
+    return render_template('index.html', current_user=current_user, news_items=snapshot['news_items'], stats=snapshot['stats'])
 
 
 @app.route('/render_page/<page>')
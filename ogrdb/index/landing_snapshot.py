@@ -0,0 +1,215 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# News items and database statistics for the landing page, refreshed in the background
+#
+# The home page used to fetch news from the WordPress REST API and count the database on every view, so a slow
+# WordPress server held up the page. Instead, each process started with init_landing_snapshot runs a refresher thread
+# that rebuilds the snapshot every LANDING_REFRESH_INTERVAL seconds (default 300), with WordPress requests limited
+# to WORDPRESS_TIMEOUT seconds (default 5). The page is served from the snapshot held in memory.
+#
+# The snapshot is also stored in the SiteSnapshot table. A process that has just started serves the stored snapshot
+# until its first refresh, and a refresher that finds a stored snapshot newer than the interval - written by another
+# process - adopts it rather than repeating the work. If news or statistics can't be fetched, the last good values
+# are kept.
+
+from datetime import datetime, timedelta
+import json
+import threading
+
+import requests
+from sqlalchemy.exc import IntegrityError
+
+from head import db
+from db.gene_description_db import GeneDescription
+from db.germline_set_db import GermlineSet
+from db.misc_db import SiteSnapshot
+
+SNAPSHOT_NAME = 'landing_page'
+NEWS_ITEMS = 5
+DEFAULT_REFRESH_INTERVAL = 300
+DEFAULT_WORDPRESS_TIMEOUT = 5
+
+EMPTY_STATS = {
+    'germline_sets': 0,
+    'sequences': 0,
+    'species': 0,
+    'last_updated': 'N/A'
+}
+
+landing_snapshot = None
+landing_snapshot_lock = threading.Lock()
+landing_refresher = None
+
+
+def fetch_news(app):
+    """
+    Fetch the latest items in the ogrdb_news category of the WordPress site
+
+    Returns:
+        list of news items, or None if they could not be fetched
+    """
+    timeout = float(app.config.get('WORDPRESS_TIMEOUT', DEFAULT_WORDPRESS_TIMEOUT))
+
+    try:
+        wp_url = app.config['WORDPRESS_NEWS_URL'] + app.config['WORDPRESS_REST']
+        r = requests.get(wp_url + 'categories', params={'slug': 'ogrdb_news'}, timeout=timeout)
+        if r.status_code != 200:
+            return None
+
+        cat_id = None
+        for rec in r.json():
+            if rec['slug'] == 'ogrdb_news':
+                cat_id = rec['id']
+
+        if cat_id is None:
+            return []
+
+        r = requests.get(wp_url + 'posts', params={'categories': cat_id, 'per_page': NEWS_ITEMS}, timeout=timeout)
+        if r.status_code != 200:
+            return None
+
+        return [{
+            'date': item['date'].split('T')[0],
+            'title': item['title']['rendered'],
+            'excerpt': item['excerpt']['rendered'],
+            'link': item['link'],
+        } for item in r.json()]
+    except Exception as e:
+        app.logger.warning('Error fetching WordPress news: %s' % e)
+        return None
+
+
+def calculate_stats(app):
+    """
+    Calculate the statistics shown on the landing page
+
+    Returns:
+        dict of statistics, or None if they could not be calculated
+    """
+    try:
+        published = db.session.query(GermlineSet.species, GermlineSet.release_date).filter(GermlineSet.status == 'published').all()
+        release_dates = [row.release_date for row in published if row.release_date]
+
+        return {
+            'germline_sets': len(published),
+            'species': len(set(row.species for row in published)),
+            'sequences': db.session.query(db.func.count(GeneDescription.id)).scalar(),
+            'last_updated': str(max(release_dates)) if release_dates else 'N/A',
+        }
+    except Exception as e:
+        app.logger.warning('Error calculating database statistics: %s' % e)
+        db.session.rollback()
+        return None
+
+
+def read_stored_snapshot():
+    rec = db.session.query(SiteSnapshot).filter(SiteSnapshot.name == SNAPSHOT_NAME).one_or_none()
+
+    if rec is None or not rec.content:
+        return None, None
+
+    return json.loads(rec.content), rec.updated
+
+
+def store_snapshot(snapshot):
+    now = datetime.utcnow()
+    rec = db.session.query(SiteSnapshot).filter(SiteSnapshot.name == SNAPSHOT_NAME).one_or_none()
+
+    if rec is None:
+        rec = SiteSnapshot(name=SNAPSHOT_NAME)
+        db.session.add(rec)
+
+    rec.content = json.dumps(snapshot)
+    rec.updated = now
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # another process stored its first snapshot at the same time
+        db.session.rollback()
+
+
+def set_landing_snapshot(snapshot):
+    global landing_snapshot
+
+    with landing_snapshot_lock:
+        landing_snapshot = snapshot
+
+
+def get_landing_snapshot():
+    """
+    The landing page snapshot held in memory, or the stored snapshot if this process has not yet made one
+
+    Returns:
+        dict with news_items (list) and stats (dict)
+    """
+    with landing_snapshot_lock:
+        snapshot = landing_snapshot
+
+    if snapshot is None:
+        try:
+            snapshot, updated = read_stored_snapshot()
+        except Exception:
+            db.session.rollback()
+            snapshot = None
+
+        if snapshot is None:
+            return {'news_items': [], 'stats': dict(EMPTY_STATS)}
+
+        set_landing_snapshot(snapshot)
+
+    return snapshot
+
+
+class LandingSnapshotRefresher:
+    def __init__(self, app):
+        self.app = app
+        self.interval = float(app.config.get('LANDING_REFRESH_INTERVAL', DEFAULT_REFRESH_INTERVAL))
+        self.event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='landing-snapshot', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while True:
+            with self.app.app_context():
+                try:
+                    self.refresh()
+                except Exception:
+                    self.app.logger.exception('Error refreshing landing page snapshot')
+                finally:
+                    db.session.remove()
+
+            self.event.wait(self.interval)
+            self.event.clear()
+
+    def refresh(self):
+        stored, updated = read_stored_snapshot()
+
+        if stored is not None and updated is not None and updated > datetime.utcnow() - timedelta(seconds=self.interval):
+            set_landing_snapshot(stored)
+            return
+
+        previous = landing_snapshot or stored or {'news_items': [], 'stats': dict(EMPTY_STATS)}
+        news_items = fetch_news(self.app)
+        stats = calculate_stats(self.app)
+
+        snapshot = {
+            'news_items': news_items if news_items is not None else previous['news_items'],
+            'stats': stats if stats is not None else previous['stats'],
+        }
+
+        set_landing_snapshot(snapshot)
+        store_snapshot(snapshot)
+
+
+def init_landing_snapshot(app):
+    global landing_refresher
+
+    landing_refresher = LandingSnapshotRefresher(app)
+    landing_refresher.start()
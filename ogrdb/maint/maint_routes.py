@@ -1,4 +1,4 @@
-from flask import flash, redirect, Response
+from flask import flash, redirect, Response, request, jsonify, abort
 from flask_login import login_required, current_user
 from werkzeug.utils import redirect
 from markupsafe import escape
@@ -12,6 +12,7 @@ from db.germline_set_db import GermlineSet
 from db.submission_db import Submission
 from db.novel_vdjbase_db import NovelVdjbase
 from head import app, db
+from query_stats import get_query_stats, reset_query_stats
 
 
 STOP_CODONS = {'TAA', 'TAG', 'TGA'}
@@ -52,6 +53,21 @@ def _aligned_to_ungapped_pos(aligned_seq, aligned_pos):
         return None
     return sum(1 for ch in aligned_seq[:aligned_pos] if ch != '.')
 
+# Per-endpoint SQL statement counts and timings, collected when QUERY_STATS is set. Only served to local clients
+# Add ?reset=1 to clear the statistics after reading them
+@app.route('/query_stats', methods=['GET'])
+def query_stats():
+    if request.remote_addr not in ('127.0.0.1', '::1') or 'X-Forwarded-For' in request.headers:
+        abort(404)
+
+    stats = get_query_stats()
+
+    if request.args.get('reset'):
+        reset_query_stats()
+
+    return jsonify(stats)
+
+
 # Unpublished route that will remove all sequences and submissions published by the selenium test account
 #@app.route('/remove_test', methods=['GET'])
 #@login_required
@@ -0,0 +1,198 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Differences between successive versions of germline sets and gene descriptions
+#
+# The difference between a published version and the one before it can't change, so it is computed once, when the
+# version is published, and stored in ReleaseDiff. Versions published before diffs were stored get theirs the first
+# time they are asked for. Draft versions are compared on each request.
+#
+# A germline set diff is a dict:
+#   prev_id, prev_version: the GermlineSet row and release_version compared against (None if there is none)
+#   added, removed: lists of {id, description_id, sequence_name, release_version}
+#   changed: list of {id, description_id, sequence_name, prev_version, version, sequence_changed}. version is None for a draft
+#
+# A gene description diff is a dict:
+#   prev_id, prev_version, version: as above
+#   items: list of {item, field, value, value2} for each field of the sequence view that differs
+
+import datetime
+import json
+from operator import attrgetter
+
+from head import db
+from db.misc_db import ReleaseDiff
+from db.germline_set_db import GermlineSet
+from db.gene_description_db import GeneDescription, make_GeneDescription_view
+
+GERMLINE_SET = 'germline_set'
+GENE_DESCRIPTION = 'gene_description'
+
+# Fields of the sequence view that are expected to differ between versions
+UNCOMPARED_ITEMS = ('Version', 'Release Notes', 'Release Date')
+
+
+def get_release_diff(object_type, object_id):
+    rec = db.session.query(ReleaseDiff.diff).filter(ReleaseDiff.object_type == object_type, ReleaseDiff.object_id == object_id).first()
+    return json.loads(rec[0]) if rec else None
+
+
+def store_release_diff(object_type, object_id, diff):
+    db.session.query(ReleaseDiff).filter(ReleaseDiff.object_type == object_type, ReleaseDiff.object_id == object_id).delete()
+    db.session.add(ReleaseDiff(object_type=object_type, object_id=object_id, created=datetime.datetime.now(), diff=json.dumps(diff, default=str)))
+    db.session.commit()
+
+
+def previous_germline_set(germline_set):
+    if germline_set.status == 'draft':
+        prev = db.session.query(GermlineSet).filter(GermlineSet.germline_set_id == germline_set.germline_set_id, GermlineSet.status == 'published').one_or_none()
+
+        if prev is None:
+            prevs = db.session.query(GermlineSet).filter(GermlineSet.germline_set_id == germline_set.germline_set_id, GermlineSet.status == 'superceded').all()
+
+            if len(prevs) > 0:
+                prev = sorted(prevs, key=attrgetter('release_version'), reverse=True)[0]
+    else:
+        prev = None
+        prevs = db.session.query(GermlineSet).filter(GermlineSet.germline_set_id == germline_set.germline_set_id, GermlineSet.status.in_(['published', 'superceded']))\
+            .filter(GermlineSet.release_version < germline_set.release_version)\
+            .all()
+
+        if len(prevs) > 0:
+            prev = sorted(prevs, key=attrgetter('release_version'), reverse=True)[0]
+
+    return prev
+
+
+def compare_germline_sets(germline_set):
+    prev = previous_germline_set(germline_set)
+
+    diff = {
+        'prev_id': prev.id if prev else None,
+        'prev_version': prev.release_version if prev else None,
+        'added': [],
+        'removed': [],
+        'changed': [],
+    }
+
+    if prev is None:
+        return diff
+
+    current_descs = {desc.description_id: desc for desc in germline_set.gene_descriptions}
+    prev_descs = {desc.description_id: desc for desc in prev.gene_descriptions}
+
+    def desc_ref(desc):
+        return {'id': desc.id, 'description_id': desc.description_id, 'sequence_name': desc.sequence_name, 'release_version': desc.release_version}
+
+    for gid, prev_desc in prev_descs.items():
+        if gid not in current_descs:
+            diff['removed'].append(desc_ref(prev_desc))
+
+    for gid, current_desc in current_descs.items():
+        if gid not in prev_descs:
+            diff['added'].append(desc_ref(current_desc))
+
+    for gid, current_desc in current_descs.items():
+        if gid in prev_descs and current_desc.id != prev_descs[gid].id:
+            diff['changed'].append({
+                'id': current_desc.id,
+                'description_id': current_desc.description_id,
+                'sequence_name': current_desc.sequence_name,
+                'prev_version': prev_descs[gid].release_version,
+                'version': current_desc.release_version if current_desc.status != 'draft' else None,
+                'sequence_changed': current_desc.coding_seq_imgt != prev_descs[gid].coding_seq_imgt,
+            })
+
+    return diff
+
+
+def germline_set_diff(germline_set):
+    """
+    The difference between a germline set and its previous version, from the stored diff if the set is not a draft
+    """
+    if germline_set.status == 'draft':
+        return compare_germline_sets(germline_set)
+
+    diff = get_release_diff(GERMLINE_SET, germline_set.id)
+
+    if diff is None:
+        diff = compare_germline_sets(germline_set)
+        store_release_diff(GERMLINE_SET, germline_set.id, diff)
+
+    return diff
+
+
+def previous_gene_description(gene_description):
+    if gene_description.status == 'draft':
+        prev = db.session.query(GeneDescription).filter(GeneDescription.description_id == gene_description.description_id, GeneDescription.status == 'published').one_or_none()
+        if prev is None:
+            prevs = db.session.query(GeneDescription).filter(GeneDescription.description_id == gene_description.description_id, GeneDescription.status == 'superceded').all()
+
+            if len(prevs) > 0:
+                prev = sorted(prevs, key=attrgetter('release_version'))[0]
+    else:
+        prev = None
+        prevs = db.session.query(GeneDescription)\
+            .filter(GeneDescription.description_id == gene_description.description_id, GeneDescription.status.in_(['published', 'superceded']))\
+            .filter(GeneDescription.release_version < gene_description.release_version)\
+            .all()
+
+        if len(prevs) > 0:
+            prev = sorted(prevs, key=attrgetter('release_version'), reverse=True)[0]
+
+    return prev
+
+
+def compare_gene_descriptions(gene_description):
+    prev = previous_gene_description(gene_description)
+
+    diff = {
+        'prev_id': prev.id if prev else None,
+        'prev_version': prev.release_version if prev else None,
+        'version': gene_description.release_version if gene_description.status != 'draft' else None,
+        'items': [],
+    }
+
+    if prev is None:
+        return diff
+
+    prev_view = make_GeneDescription_view(prev)
+    this_view = make_GeneDescription_view(gene_description)
+
+    for prev_item, this_item in zip(prev_view.items, this_view.items):
+        if prev_item['value'] != this_item['value'] and prev_item['item'] not in UNCOMPARED_ITEMS:
+            diff['items'].append({'item': prev_item['item'], 'field': prev_item['field'], 'value': prev_item['value'], 'value2': this_item['value']})
+
+    if prev.notes != gene_description.notes:
+        diff['items'].append({'item': 'Notes', 'field': 'notea', 'value': '', 'value2': 'changed'})
+
+    return diff
+
+
+def gene_description_diff(gene_description):
+    """
+    The difference between a gene description and its previous version, from the stored diff if it is not a draft
+    """
+    if gene_description.status == 'draft':
+        return compare_gene_descriptions(gene_description)
+
+    diff = get_release_diff(GENE_DESCRIPTION, gene_description.id)
+
+    if diff is None:
+        diff = json.loads(json.dumps(compare_gene_descriptions(gene_description), default=str))
+        store_release_diff(GENE_DESCRIPTION, gene_description.id, diff)
+
+    return diff
+
+
+# Record the diffs of a newly published version. Called once the new status has been committed
+
+def store_germline_set_diff(germline_set):
+    store_release_diff(GERMLINE_SET, germline_set.id, compare_germline_sets(germline_set))
+
+
+def store_gene_description_diff(gene_description):
+    store_release_diff(GENE_DESCRIPTION, gene_description.id, compare_gene_descriptions(gene_description))
@@ -0,0 +1,252 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Alignment of the alleles of a gene, for the alignments page
+#
+# The alleles, their membership of published germline sets and, optionally, their genomic evidence are fetched in
+# one query. The finished alignment is cached in process memory, keyed on the request and a digest of everything
+# read from the database, so that a repeated view of a gene whose records have not changed skips gap_align and
+# the receptor_utils alignment. Any change to the records changes the digest, so stale alignments are never served.
+
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from flask_login import current_user
+from receptor_utils.number_v import gap_align
+from receptor_utils.sequence_alignment import create_alignment
+from sqlalchemy import case, or_
+
+from head import db
+from db.gene_description_db import GeneDescription, GenomicSupport
+from ogrdb.sequence.table_data import published_set_members
+
+ALIGNMENT_CACHE_SIZE = 128
+
+alignment_cache = OrderedDict()
+alignment_cache_lock = threading.Lock()
+
+# Attributes of an allele, and of a genomic support record, that the alignment depends on
+
+ALLELE_FIELDS = ('id', 'sequence_name', 'status', 'sequence_type', 'coding_seq_imgt', 'j_codon_frame',
+                 'gene_start', 'cdr1_start', 'cdr1_end', 'cdr2_start', 'cdr2_end', 'cdr3_start')
+EVIDENCE_FIELDS = ('id', 'accession', 'sequence', 'sequence_start', 'gene_start', 'gene_end')
+
+
+@lru_cache(maxsize=1024)
+def cached_gap_align(seq, ref):
+    return gap_align(seq, ref)
+
+
+def fetch_alignment_records(species, locus, gene_name, statuses, include_evidence):
+    """
+    Fetch the alleles of a gene, whether each is in a published germline set and, if requested, their genomic evidence
+
+    Returns:
+        list of (GeneDescription, in published set, list of GenomicSupport), published alleles first, in name order
+    """
+    members = published_set_members()
+    in_published_set = members.c.gene_description_id.isnot(None)
+    entities = [GeneDescription, in_published_set]
+
+    if include_evidence:
+        entities.append(GenomicSupport)
+
+    q = db.session.query(*entities)\
+        .outerjoin(members, members.c.gene_description_id == GeneDescription.id)\
+        .filter(GeneDescription.species == species,
+                GeneDescription.locus == locus,
+                or_(GeneDescription.sequence_name.like(f'{gene_name}*%'), GeneDescription.sequence_name == gene_name),
+                GeneDescription.status.in_(statuses))
+
+    order = [case((GeneDescription.status == 'published', 0), else_=1), GeneDescription.sequence_name, GeneDescription.id]
+
+    if include_evidence:
+        q = q.outerjoin(GenomicSupport, GenomicSupport.sequence_id == GeneDescription.id)
+        order.append(GenomicSupport.id)
+
+    records = OrderedDict()
+
+    for row in q.order_by(*order).all():
+        allele = row[0]
+        if allele.id not in records:
+            records[allele.id] = (allele, bool(row[1]), [])
+        if include_evidence and row[2] is not None:
+            records[allele.id][2].append(row[2])
+
+    return list(records.values())
+
+
+def records_digest(records):
+    digest = hashlib.sha256()
+
+    for allele, in_set, evidence in records:
+        digest.update(repr([getattr(allele, f) for f in ALLELE_FIELDS] + [in_set]).encode('utf-8'))
+        for rec in evidence:
+            digest.update(repr([getattr(rec, f) for f in EVIDENCE_FIELDS]).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def create_alignment_data(species, locus, gene_name, codons_per_line=20, include_evidence=False):
+    """Create alignment data for all alleles of a specific gene"""
+    try:
+        # Unpublished alleles are included if the user has access to this species committee
+        committee_access = bool(current_user.is_authenticated and current_user.has_role(species))
+        statuses = ['published', 'draft'] if committee_access else ['published']
+
+        records = fetch_alignment_records(species, locus, gene_name, statuses, include_evidence)
+        key = (species, locus, gene_name, codons_per_line, include_evidence, committee_access, records_digest(records))
+
+        with alignment_cache_lock:
+            if key in alignment_cache:
+                alignment_cache.move_to_end(key)
+                return dict(alignment_cache[key])
+
+        result = build_alignment_data(records, species, locus, gene_name, codons_per_line)
+
+        if result['alignment'] is not None:
+            with alignment_cache_lock:
+                alignment_cache[key] = dict(result)
+                while len(alignment_cache) > ALIGNMENT_CACHE_SIZE:
+                    alignment_cache.popitem(last=False)
+
+        return result
+
+    except Exception as e:
+        return {
+            'error': f'Error retrieving sequences: {str(e)}',
+            'alignment': None,
+            'sequences': [],
+            'suffixes': False
+        }
+
+
+def extract_gene_sequence(rec):
+    return rec.sequence[rec.gene_start - 1 - rec.sequence_start + 1:rec.gene_end - rec.sequence_start + 1]
+
+
+def build_alignment_data(records, species, locus, gene_name, codons_per_line):
+    published_alleles = [allele for allele, in_set, evidence in records if allele.status == 'published' and allele.coding_seq_imgt]
+    unpublished_alleles = [allele for allele, in_set, evidence in records if allele.status == 'draft' and allele.coding_seq_imgt]
+
+    # Combine all alleles
+    all_alleles = published_alleles + unpublished_alleles
+
+    if not all_alleles:
+        return {
+            'error': f'No sequences found for {species} {locus} {gene_name}',
+            'alignment': None,
+            'sequences': []
+        }
+
+    # Genomic evidence is aligned to the first published allele, or the first unpublished allele if none are published
+    ref = all_alleles[0]
+    published_evidence = {}
+    unpublished_evidence = {}
+
+    for allele, in_set, evidence in records:
+        if allele.status == 'published' and not published_alleles:
+            continue
+
+        for rec in evidence:
+            try:
+                seq = cached_gap_align(extract_gene_sequence(rec), ref.coding_seq_imgt)
+                if allele.status == 'published':
+                    published_evidence[f'{allele.sequence_name} {rec.accession}'] = seq
+                else:
+                    unpublished_evidence[f'{allele.sequence_name} {rec.accession} (U)'] = seq
+            except:
+                continue
+
+    # Calculate codon positions for CDRs in the gapped sequence
+    sequence_type = ref.sequence_type
+
+    v_coords = None
+    if sequence_type == 'V':
+        try:
+            seq_gapped = ref.coding_seq_imgt
+            # build a mapping of ungapped to gapped positions
+            ungapped_to_gapped = {}
+            ungapped_index = 0
+
+            for gapped_index in range(len(seq_gapped)):
+                if seq_gapped[gapped_index] != '.':
+                    ungapped_to_gapped[ungapped_index] = gapped_index
+                    ungapped_index += 1
+
+            cdr1_codon_start = int(1 + (ungapped_to_gapped[ref.cdr1_start - ref.gene_start])/3)
+            cdr1_codon_end = int(1 + (ungapped_to_gapped[ref.cdr1_end - ref.gene_start - 2])/3)
+            cdr2_codon_start = int(1 + (ungapped_to_gapped[ref.cdr2_start - ref.gene_start])/3)
+            cdr2_codon_end = int(1 + (ungapped_to_gapped[ref.cdr2_end - ref.gene_start - 2])/3)
+            cdr3_codon_start = int(1 + (ungapped_to_gapped[ref.cdr3_start - ref.gene_start])/3)
+            v_coords = (cdr1_codon_start, cdr1_codon_end, cdr2_codon_start, cdr2_codon_end, cdr3_codon_start)
+        except:
+            v_coords = None
+
+    # Prepare sequences for alignment
+    in_published_set = {allele.id: in_set for allele, in_set, evidence in records}
+    sequences = {}
+    suffixes = False
+
+    j_codon_frame = None
+    for allele in all_alleles:
+        # Add status indicator for unpublished sequences
+        name = allele.sequence_name
+        suffix = ''
+        if allele.status == 'draft':
+            suffix += 'U'
+
+        # Add status if sequence is not in a published germline set
+        if not in_published_set[allele.id]:
+            suffix += 'N'
+
+        if suffix:
+            name += f' ({suffix})'
+            suffixes = True
+
+        if sequence_type == 'J' and allele.j_codon_frame and j_codon_frame is None:
+            try:
+                j_codon_frame = int(allele.j_codon_frame)
+            except:
+                j_codon_frame = None
+        sequences.update({name: allele.coding_seq_imgt})
+
+    sequences.update(published_evidence)
+    sequences.update(unpublished_evidence)
+
+    if sequence_type == 'J' and j_codon_frame is not None:
+        prefix = '.' * ((4 - int(j_codon_frame)) % 3)
+        for name, sequence in sequences.items():
+            sequences[name] = prefix + sequence
+
+    if not sequences:
+        return {
+            'error': f'No valid coding sequences found for {species} {locus} {gene_name}',
+            'alignment': None,
+            'sequences': [],
+            'suffixes': False,
+        }
+
+    # Create alignment using receptor_utils
+    try:
+        alignment_result = create_alignment(sequences, sequence_type, codon_wrap=codons_per_line, v_coords=v_coords)
+
+        return {
+            'error': None,
+            'alignment': alignment_result,
+            'sequences': list(sequences.keys()),
+            'count': len(sequences),
+            'suffixes': suffixes
+        }
+    except Exception as e:
+        return {
+            'error': f'Error creating alignment: {str(e)}',
+            'alignment': None,
+            'sequences': list(sequences.keys()),
+            'suffixes': False
+        }
@@ -6,12 +6,15 @@
 
 # Gene table routes
 
-from flask import render_template, request, jsonify, make_response
+from flask import render_template, request, jsonify, make_response, url_for
 from flask_login import current_user
 from head import app, db
 from db.gene_description_db import GeneDescription
 from db.styled_table import StyledTable, Col, LinkCol, StyledCol
-from db.misc_db import Committee
+from ogrdb.catalog import available_gene_species, available_loci, available_subgroups, catalog_response
+from ogrdb.sequence.table_data import published_set_members, parse_datatable_request, apply_datatable_request, contains_filter, \
+    table_keys, datatable_response
+from sqlalchemy import func, not_, true
 from forms.gene_table_form import GeneTableForm
 import io
 import csv
@@ -75,84 +78,24 @@ def gene_table():
 
 def get_available_species():
     """Get species that have published sequences or unpublished sequences for user's committees"""
-    species_set = set()
-    
-    # Get species with published, non-withdrawn sequences
-    published_species = db.session.query(GeneDescription.species).filter(
-        GeneDescription.status == 'published'
-    ).distinct().all()
-    species_set.update([s[0] for s in published_species])
-    
-    # If user is authenticated and has committee roles, add species
-    if current_user.is_authenticated:
-        user_committees = [role.name for role in current_user.roles if role.name not in ('Admin', 'AdminEdit')]
-        
-        for committee_species in user_committees:
-            species_set.add(committee_species)
-    
-    return sorted(list(species_set))
+    return available_gene_species()
 
 
 def get_available_loci(species, subgroup=None):
     """Get loci available for a specific species and subgroup based on sequence availability"""
-    loci_set = set()
-    
-    # Base query filters
-    base_filters = [GeneDescription.species == species]
-    if subgroup:
-        base_filters.append(GeneDescription.species_subgroup == subgroup)
-    
-    # Get loci from published sequences
-    published_query = db.session.query(GeneDescription.locus).filter(
-        *base_filters,
-        GeneDescription.status == 'published'
-    ).distinct()
-    published_loci = published_query.all()
-    loci_set.update([locus[0] for locus in published_loci if locus[0]])
-    
-    # If user has access to this species committee, include all loci for the committee
-    if current_user.is_authenticated and current_user.has_role(species):
-        loci = db.session.query(Committee.loci).filter(Committee.species == species).one_or_none()
-        if loci and loci[0]:
-            committee_loci = [l.strip() for l in loci[0].split(',') if l.strip()]
-            loci_set.update(committee_loci)
-    
-    return sorted(list(loci_set))
+    return available_loci(species, subgroup)
 
 
 def get_available_subgroups(species):
     """Get available subgroups for a species"""
-    subgroups_set = set()
-    
-    # Get subgroups from published sequences
-    published_subgroups = db.session.query(GeneDescription.species_subgroup).filter(
-        GeneDescription.species == species,
-        GeneDescription.status == 'published',
-        GeneDescription.species_subgroup.isnot(None),
-        GeneDescription.species_subgroup != '',
-        GeneDescription.species_subgroup != 'none'
-    ).distinct().all()
-    subgroups_set.update([sg[0] for sg in published_subgroups if sg[0]])
-    
-    # If user has access to this species committee, include unpublished subgroups
-    if current_user.is_authenticated and current_user.has_role(species):
-        unpublished_subgroups = db.session.query(GeneDescription.species_subgroup).filter(
-            GeneDescription.species == species,
-            GeneDescription.status.in_(['draft']),
-            GeneDescription.species_subgroup.isnot(None),
-            GeneDescription.species_subgroup != '',
-            GeneDescription.species_subgroup != 'none'
-        ).distinct().all()
-        subgroups_set.update([sg[0] for sg in unpublished_subgroups if sg[0]])
-    
-    return sorted(list(subgroups_set))
+    return available_subgroups(species)
 
 
 @app.route('/get_subgroups/<species>', methods=['GET'])
 def get_subgroups_for_species(species):
     """AJAX endpoint to get available subgroups for a species"""
     subgroups = get_available_subgroups(species)
-    return jsonify(subgroups)
+    return catalog_response(subgroups)
 
 
 @app.route('/get_loci/<species>', methods=['GET'])
@@ -164,7 +107,7 @@ def get_loci_for_species(species):
         if subgroup == 'null' or subgroup == '' or subgroup == 'undefined':
             subgroup = None
     loci = get_available_loci(species, subgroup)
-    return jsonify(loci)
+    return catalog_response(loci)
 
 
 class InferenceTypeTickCol(StyledCol):
@@ -202,67 +145,99 @@ class GeneTable(StyledTable):
         super(GeneTable, self).__init__(items, *args, **kwargs)
 
 
-def create_gene_table(species, subgroup, locus):
-    """Create gene table data based on selection criteria"""
-    # Base query filters
-    base_filters = [
-        GeneDescription.species == species,
-        GeneDescription.locus == locus
-    ]
-    
-    if subgroup:
-        base_filters.append(GeneDescription.species_subgroup == subgroup)
-    
-    # Get published sequences (always included)
-    published_query = db.session.query(GeneDescription).filter(
-        *base_filters,
-        GeneDescription.status == 'published'
-    )
-    
-    # Get unpublished sequences if user has committee access
-    unpublished_query = None
+def gene_table_query(species, subgroup, locus):
+    """
+    Query for the sequences shown in the gene table, as (GeneDescription, in_published_set) rows.
+    Membership of a published germline set is found with one aggregated join, rather than a query per sequence.
+    """
+    statuses = ['published']
+
+    # Unpublished sequences are included if the user has committee access
     if current_user.is_authenticated and current_user.has_role(species):
-        unpublished_query = db.session.query(GeneDescription).filter(
-            *base_filters,
-            GeneDescription.status.in_(['draft'])
-        )
-    
-    # Combine queries
-    all_sequences = list(published_query.all())
-    if unpublished_query:
-        all_sequences.extend(unpublished_query.all())
-    
-    # Create table data
-    table_data = []
-    for seq in all_sequences:
-        gene_name = seq.sequence_name.split('*')[0] if seq.sequence_name else ''
-        # Generate allele name: <sequence_name> with (U) suffix for unpublished
-        allele_name = seq.sequence_name or ''
-        if seq.status == 'draft':
-            allele_name += ' (U)'
-        
-        # Check if sequence is in any published germline set
-        in_published_set = any(gs.status == 'published' for gs in seq.germline_sets)
-        
-        table_data.append({
-            'species': species,
-            'locus': locus,
-            'gene_name': gene_name,
-            'allele': allele_name,
-            'description_id': seq.id,  # For linking to sequence detail page
-            'inference_type': seq.inference_type or '',  # For tick display in unrearranged/rearranged columns
-            'affirmation_level': seq.affirmation_level or '',  # Affirmation level column
-            'in_published_set': in_published_set  # For tick display in 'in set' column
-        })
-    
-    # Sort by gene name
-    table_data.sort(key=lambda x: x['gene_name'])
-    
-    # Create table
-    table = GeneTable(table_data)
+        statuses.append('draft')
+
+    members = published_set_members()
+    in_published_set = members.c.gene_description_id.isnot(None).label('in_published_set')
+
+    q = db.session.query(GeneDescription, in_published_set)\
+        .outerjoin(members, members.c.gene_description_id == GeneDescription.id)\
+        .filter(GeneDescription.species == species,
+                GeneDescription.locus == locus,
+                GeneDescription.status.in_(statuses))
+
+    if subgroup:
+        q = q.filter(GeneDescription.species_subgroup == subgroup)
+
+    return q, in_published_set
+
+
+def gene_table_item(seq, in_published_set, species, locus):
+    gene_name = seq.sequence_name.split('*')[0] if seq.sequence_name else ''
+    # Generate allele name: <sequence_name> with (U) suffix for unpublished
+    allele_name = seq.sequence_name or ''
+    if seq.status == 'draft':
+        allele_name += ' (U)'
+
+    return {
+        'species': species,
+        'locus': locus,
+        'gene_name': gene_name,
+        'allele': allele_name,
+        'description_id': seq.id,  # For linking to sequence detail page
+        'inference_type': seq.inference_type or '',  # For tick display in unrearranged/rearranged columns
+        'affirmation_level': seq.affirmation_level or '',  # Affirmation level column
+        'in_published_set': bool(in_published_set)  # For tick display in 'in set' column
+    }
+
+
+def create_gene_table(species, subgroup, locus):
+    """Create the gene table. Rows are loaded a page at a time from gene_table_data"""
+    table = GeneTable([])
+    table.allow_empty = True
+    table.data_url = url_for('gene_table_data', species=species, locus=locus, subgroup=subgroup)
     return {'gene_table': table}
 
 
+def tick_filter(expr):
+    def filter(value):
+        if value.lower() in ('yes', 'y', 'true', '1'):
+            return expr
+        if value.lower() in ('no', 'n', 'false', '0'):
+            return not_(expr)
+        return true()
+    return filter
+
+
+@app.route('/gene_table_data/<species>/<locus>', methods=['GET'])
+def gene_table_data(species, locus):
+    """DataTables server-side endpoint for the gene table"""
+    subgroup = request.args.get('subgroup')
+    subgroup = None if subgroup in (None, 'null', '', 'None') else subgroup
+
+    q, in_published_set = gene_table_query(species, subgroup, locus)
+    inference_type = func.coalesce(GeneDescription.inference_type, '')
+
+    params = parse_datatable_request(request.args, table_keys(GeneTable([])))
+    sort_columns = {
+        'gene': GeneDescription.sequence_name,
+        'allele': GeneDescription.sequence_name,
+        'affirmation_level': GeneDescription.affirmation_level,
+        'in_set': in_published_set,
+    }
+    filters = {
+        'gene': contains_filter(GeneDescription.sequence_name),
+        'allele': contains_filter(GeneDescription.sequence_name),
+        'affirmation_level': contains_filter(GeneDescription.affirmation_level),
+        'unrearranged': tick_filter(inference_type.ilike('%unrearranged%')),
+        'rearranged': tick_filter(inference_type.ilike('%rearranged%')),
+        'in_set': tick_filter(in_published_set),
+    }
+
+    records_total, records_filtered, q = apply_datatable_request(q, params, sort_columns, filters, ['allele', 'affirmation_level'])
+    table = GeneTable([gene_table_item(seq, in_set, species, locus) for seq, in_set in q.all()])
+    return jsonify(datatable_response(params, records_total, records_filtered, table))
+
+
 @app.route('/download_gene_table_sequences/<species>/<locus>/<format>/<affirmation>/<in_set_only>')
 def download_gene_table_sequences(species, locus, format, affirmation, in_set_only):
     """Download sequences from gene table with specified filters"""
@@ -271,49 +246,18 @@ def download_gene_table_sequences(species, locus, format, affirmation, in_set_on
     subgroup = request.args.get('subgroup')
     subgroup = None if subgroup == 'null' or subgroup == '' or subgroup == 'None' else subgroup
     
-    # Build query filters
-    base_filters = [
-        GeneDescription.species == species,
-        GeneDescription.locus == locus
-    ]
-    
-    if subgroup:
-        base_filters.append(GeneDescription.species_subgroup == subgroup)
-    
-    # Get published sequences (always included)
-    published_query = db.session.query(GeneDescription).filter(
-        *base_filters,
-        GeneDescription.status == 'published'
-    )
-    
-    # Get unpublished sequences if user has committee access
-    unpublished_query = None
-    if current_user.is_authenticated and current_user.has_role(species):
-        unpublished_query = db.session.query(GeneDescription).filter(
-            *base_filters,
-            GeneDescription.status.in_(['draft'])
-        )
-    
-    # Combine queries
-    all_sequences = list(published_query.all())
-    if unpublished_query:
-        all_sequences.extend(unpublished_query.all())
-    
+    q, in_published_set = gene_table_query(species, subgroup, locus)
+
     # Apply filters
-    filtered_sequences = []
-    for seq in all_sequences:
-        # Apply affirmation level filter
-        if affirmation == 'gt0':
-            if not seq.affirmation_level or seq.affirmation_level == '0':
-                continue
-        
-        # Apply in set filter
-        if in_set_only == 'yes':
-            in_published_set = any(gs.status == 'published' for gs in seq.germline_sets)
-            if not in_published_set:
-                continue
-        
-        filtered_sequences.append(seq)
+    if affirmation == 'gt0':
+        q = q.filter(GeneDescription.affirmation_level.isnot(None), GeneDescription.affirmation_level != '', GeneDescription.affirmation_level != '0')
+
+    if in_set_only == 'yes':
+        q = q.filter(in_published_set)
+
+    rows = q.all()
+    filtered_sequences = [seq for seq, in_set in rows]
+    in_set_ids = set(seq.id for seq, in_set in rows if in_set)
     
     if not filtered_sequences:
         return "No sequences match the specified criteria", 404
@@ -327,7 +271,7 @@ def download_gene_table_sequences(species, locus, format, affirmation, in_set_on
     if format == 'fasta':
         return generate_fasta_download(filtered_sequences, base_filename)
     elif format == 'csv':
-        return generate_csv_download(filtered_sequences, base_filename)
+        return generate_csv_download(filtered_sequences, base_filename, in_set_ids)
     else:
         return "Invalid format", 400
 
@@ -377,8 +321,8 @@ def extract_flanking_sequence(sequence, start, end):
         return ""
 
 
-def generate_csv_download(sequences, filename):
-    """Generate CSV format download"""
+def generate_csv_download(sequences, filename, in_set_ids):
+    """Generate CSV format download. in_set_ids holds the ids of the sequences that are in a published germline set"""
     output = io.StringIO()
     writer = csv.writer(output)
     
@@ -406,7 +350,7 @@ def generate_csv_download(sequences, filename):
         if seq.status == 'draft':
             allele_name += ' (U)'
         
-        in_published_set = any(gs.status == 'published' for gs in seq.germline_sets)
+        in_published_set = seq.id in in_set_ids
         sequence_data = seq.sequence or ""
         gapped_sequence = seq.coding_seq_imgt or ""
         
@@ -15,7 +15,8 @@ from textile_filter import *
 from flask import url_for
 from db.gene_description_db import *
 from sequence_format import *
-from db.vdjbase import get_vdjbase_ref
+from db.vdjbase import get_vdjbase_ref, find_vdjbase_matches
+from ogrdb.release_diff import gene_description_diff
 
 class MessageHeaderCol(StyledCol):
     def td_contents(self, item, attr_list):
@@ -156,14 +157,11 @@ def make_VDJbase_table(results, private = False, classes=()):
 def setup_vdjbase_matches_table(seq):
     results = []
 
-    vdjbase_ref = get_vdjbase_ref()
     vdjbase_species = seq.species
-    if seq.coding_seq_imgt is not None and len(seq.coding_seq_imgt) > 0 \
-            and vdjbase_species in vdjbase_ref and seq.locus in vdjbase_ref[vdjbase_species]:
-        vdjbase_genes = vdjbase_ref[vdjbase_species][seq.locus]
+    if seq.coding_seq_imgt is not None and len(seq.coding_seq_imgt) > 0:
         gene_seq = seq.coding_seq_imgt.lower().replace('.', '')
-        for vdjbase_name, (vdjbase_seq, vdjbase_count) in vdjbase_genes.items():
-            if (gene_seq in vdjbase_seq or vdjbase_seq in gene_seq) and vdjbase_count != '0':
+        for vdjbase_name, vdjbase_seq, vdjbase_count in find_vdjbase_matches(vdjbase_species, seq.locus, gene_seq):
+            if vdjbase_count != '0':
                 results.append(
                     {'vdjbase_name': Markup('<a href="%sgenerep/%s/%s/%s"> %s </a>' % (app.config['VDJBASE_URL'], vdjbase_species, seq.locus, vdjbase_name, vdjbase_name)),
                      'allele_name': vdjbase_name,
@@ -349,45 +347,16 @@ class GeneDescription_difference_view(Table):
 
 
 def list_sequence_changes(gene_description):
-    if gene_description.status == 'draft':
-        prev = db.session.query(GeneDescription).filter(GeneDescription.description_id == gene_description.description_id, GeneDescription.status == 'published').one_or_none()
-        if prev is None:
-            prevs = db.session.query(GeneDescription).filter(GeneDescription.description_id == gene_description.description_id, GeneDescription.status == 'superceded').all()
-
-            if len(prevs) > 0:
-                prev = sorted(prevs, key=attrgetter('release_version'))[0]
-    else:
-        prev = None
-        prevs = db.session.query(GeneDescription)\
-            .filter(GeneDescription.description_id == gene_description.description_id, GeneDescription.status.in_(['published', 'superceded']))\
-            .filter(GeneDescription.release_version < gene_description.release_version)\
-            .all()
-
-        if len(prevs) > 0:
-            prev = sorted(prevs, key=attrgetter('release_version'), reverse=True)[0]
-
-    if prev is None:
+    diff = gene_description_diff(gene_description)
+
+    if diff['prev_id'] is None or len(diff['items']) == 0:
         return None
 
-    prev_view = make_GeneDescription_view(prev)
-    this_view = make_GeneDescription_view(gene_description)
-    diff_view = GeneDescription_difference_view([])
-
-    for i in range(len(prev_view.items)):
-        if prev_view.items[i]['value'] != this_view.items[i]['value'] \
-                and prev_view.items[i]['item'] not in ('Version', 'Release Notes', 'Release Date'):
-            item = prev_view.items[i]
-            item['value2'] = this_view.items[i]['value']
-            diff_view.items.append(item)
-        elif prev_view.items[i]['item'] == 'Version':
-            diff_view.value.name = 'v' + str(prev_view.items[i]['value'])
-            diff_view.value2.name = ('v' + str(this_view.items[i]['value']) if gene_description.status != 'draft' else 'draft')
-
-    if prev.notes != gene_description.notes:
-        item = {'item': 'Notes', 'value': '', 'value2': 'changed', 'field': 'notea'}
-        diff_view.items.append(item)
-
-    return diff_view if len(diff_view.items) > 0 else None
+    diff_view = GeneDescription_difference_view([dict(item) for item in diff['items']])
+    diff_view.value.name = 'v' + str(diff['prev_version'])
+    diff_view.value2.name = 'v' + str(diff['version']) if diff['version'] is not None else 'draft'
+
+    return diff_view
 
 
 
@@ -10,7 +10,8 @@ from copy import deepcopy
 from flask_table import DateCol
 
 import ogrdb.submission.genotype_routes
-from imgt.imgt_ref import get_imgt_config
+from permission_context import get_permission_context
+from imgt.imgt_ref import get_imgt_species_aliases
 from db.styled_table import *
 from db.gene_description_db import *
 
@@ -58,13 +59,7 @@ class SequenceListActionCol(StyledCol):
 class SequenceListIMGTCol(StyledCol):
     def td_contents(self, item, attr_list):
         if item.imgt_name:
-            imgt_config = get_imgt_config()
-            # imgt_species = {v['alias']: k for k, v in imgt_config['species'].items()}
-            imgt_species = {}
-            for k,v in imgt_config['species'].items():
-                aliases = v['alias'].split(',')
-                for alias in aliases:
-                    imgt_species[alias] = k
+            imgt_species = get_imgt_species_aliases()
             fmt_string = '<a href="http://www.imgt.org/IMGTrepertoire/Proteins/alleles/index.php?species=%s&group=%s%s&gene=%s">%s</a>' % (imgt_species[item.species], item.locus, item.sequence_type, item.imgt_name.split('*')[0], item.imgt_name)
             # fmt_string = '<a href="http://www.imgt.org/genedb/GENElect?query=2+%s&species=%s">%s</a>' % (item.imgt_name.split('*')[0], imgt_species[item.species], item.imgt_name)
         else:
@@ -103,8 +98,24 @@ def add_feature_to_table(table, feature_name, col_name=None):
     table.add_column(col_name, FeatureCol(feature_name.capitalize(), tooltip=f"{feature_name.replace('_', ' ').capitalize()} presence"))
 
 
+# Features shown as the subsequence between their start and end co-ordinates
+
+SEQUENCE_FEATURES = ['utr_5_prime', 'utr_3_prime', 'leader_1', 'leader_2', 'v_rs', 'd_rs_5_prime', 'd_rs_3_prime', 'j_rs',
+                     'c_exon_1', 'c_exon_2', 'c_exon_3', 'c_exon_4', 'c_exon_5', 'c_exon_6', 'c_exon_7', 'c_exon_8', 'c_exon_9']
+
+
+def feature_sequence_expression(feature_name):
+    """
+    SQL expression for the subsequence shown in a feature column, or NULL if the feature has no co-ordinates
+    """
+    start = getattr(GeneDescription, f"{feature_name}_start")
+    end = getattr(GeneDescription, f"{feature_name}_end")
+    return db.func.substr(GeneDescription.sequence, start, end - start + 1)
+
+
 def setup_sequence_list_table(results, current_user, edit=True):
     table = make_GeneDescription_table(results)
+    current_user = get_permission_context(current_user)
     for item in table.items:
         item.viewable = item.can_see(current_user)
         item.editable = item.can_edit(current_user) if edit else False
@@ -117,23 +128,8 @@ def setup_sequence_list_table(results, current_user, edit=True):
     table.add_column('sequence_name', SequenceListActionCol('Sequence Name'))
     table._cols.move_to_end('sequence_name', last=False)
 
-    add_feature_to_table(table, 'utr_5_prime')
-    add_feature_to_table(table, 'utr_3_prime')
-    add_feature_to_table(table, 'leader_1')
-    add_feature_to_table(table, 'leader_2')
-    add_feature_to_table(table, 'v_rs')
-    add_feature_to_table(table, 'd_rs_5_prime')
-    add_feature_to_table(table, 'd_rs_3_prime')
-    add_feature_to_table(table, 'j_rs')
-    add_feature_to_table(table, 'c_exon_1')
-    add_feature_to_table(table, 'c_exon_2')
-    add_feature_to_table(table, 'c_exon_3')
-    add_feature_to_table(table, 'c_exon_4')
-    add_feature_to_table(table, 'c_exon_5')
-    add_feature_to_table(table, 'c_exon_6')
-    add_feature_to_table(table, 'c_exon_7')
-    add_feature_to_table(table, 'c_exon_8')
-    add_feature_to_table(table, 'c_exon_9')
+    for feature_name in SEQUENCE_FEATURES:
+        add_feature_to_table(table, feature_name)
     return table
 
 
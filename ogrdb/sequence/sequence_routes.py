@@ -22,8 +22,6 @@ from markupsafe import Markup
 from sqlalchemy import and_, or_
 from wtforms import ValidationError
 from receptor_utils import simple_bio_seq as simple
-from receptor_utils.sequence_alignment import create_alignment
-from receptor_utils.number_v import gap_align
 
 from head import db, app, attach_path
 
@@ -51,6 +49,7 @@ from forms.sequence_new_form import NewSequenceForm
 from forms.sequence_table_form import SequenceTableForm
 from forms.alignment_form import AlignmentForm
 from ogrdb.sequence.gene_table import get_available_species, get_available_subgroups, get_available_loci
+from ogrdb.catalog import available_gene_names, catalog_response
 from imgt.imgt_ref import get_imgt_reference_genes
 from ogrdb.germline_set.descs_to_fasta import descs_to_fasta
 
@@ -61,12 +60,15 @@ from ogrdb.submission.submission_view_form import HiddenReturnForm
 
 from forms.sequence_view_form import setup_sequence_view_tables
 from ogrdb.sequence.inferred_sequence_table import setup_sequence_edit_tables
-from ogrdb.sequence.sequence_list_table import setup_sequence_list_table, setup_sequence_version_table
+from ogrdb.sequence.sequence_list_table import setup_sequence_list_table, setup_sequence_version_table, feature_sequence_expression, SEQUENCE_FEATURES
+from ogrdb.sequence.alignment_data import create_alignment_data
+from ogrdb.sequence.table_data import parse_datatable_request, apply_datatable_request, contains_filter, table_keys, datatable_response
 
 
 from textile_filter import safe_textile
 from journal import add_history, add_note
 from mail import send_mail
+from ogrdb.release_diff import store_gene_description_diff
 from ogrdb.germline_set.to_airr import AIRRAlleleDescription
 
 
@@ -398,266 +400,48 @@ def alignments(species=None, locus=None, gene_name=None):
 
 def get_available_gene_names(species, locus):
     """Get available gene names for a specific species and locus"""
-    gene_names_set = set()
-    
-    # Base query filters
-    base_filters = [
-        GeneDescription.species == species,
-        GeneDescription.locus == locus,
-        GeneDescription.sequence_name.isnot(None)
-    ]
-    
-    # Get gene names from published sequences
-    published_query = db.session.query(GeneDescription.sequence_name).filter(
-        *base_filters,
-        GeneDescription.status == 'published'
-    ).distinct()
-    
-    published_genes = published_query.all()
-    for gene_tuple in published_genes:
-        gene_name = gene_tuple[0]
-        if gene_name and '*' in gene_name:
-            # Extract gene name without allele designation
-            base_gene = gene_name.split('*')[0]
-            gene_names_set.add(base_gene)
-        elif gene_name:
-            gene_names_set.add(gene_name)
-    
-    # If user has access to this species committee, include unpublished gene names
-    if current_user.is_authenticated and current_user.has_role(species):
-        unpublished_query = db.session.query(GeneDescription.sequence_name).filter(
-            *base_filters,
-            GeneDescription.status.in_(['draft'])
-        ).distinct()
-        
-        unpublished_genes = unpublished_query.all()
-        for gene_tuple in unpublished_genes:
-            gene_name = gene_tuple[0]
-            if gene_name and '*' in gene_name:
-                # Extract gene name without allele designation
-                base_gene = gene_name.split('*')[0]
-                gene_names_set.add(base_gene)
-            elif gene_name:
-                gene_names_set.add(gene_name)
-    
-    return sorted(list(gene_names_set))
+    return available_gene_names(species, locus)
 
 
 @app.route('/get_gene_names/<species>/<locus>', methods=['GET'])
 def get_gene_names_for_species_locus(species, locus):
     """AJAX endpoint to get available gene names for a species and locus"""
     gene_names = get_available_gene_names(species, locus)
-    return jsonify(gene_names)
+    return catalog_response(gene_names)
 
 
-def create_alignment_data(species, locus, gene_name, codons_per_line=20, include_evidence=False):
-    """Create alignment data for all alleles of a specific gene"""
-    try:
-        # Base query filters to find all alleles of the specified gene
-        base_filters = [
-            GeneDescription.species == species,
-            GeneDescription.locus == locus,
-            or_(GeneDescription.sequence_name.like(f'{gene_name}*%'), GeneDescription.sequence_name == gene_name),
-            GeneDescription.coding_seq_imgt.isnot(None),
-            GeneDescription.coding_seq_imgt != ''
-        ]
-        
-        # Get published sequences (always included)
-        published_query = db.session.query(GeneDescription).filter(
-            *base_filters,
-            GeneDescription.status == 'published'
-        ).order_by(GeneDescription.sequence_name)
-        
-        published_alleles = published_query.all()
-        
-        # If user has access to this species committee, include unpublished alleles
-        unpublished_alleles = []
-        if current_user.is_authenticated and current_user.has_role(species):
-            unpublished_query = db.session.query(GeneDescription).filter(
-                *base_filters,
-                GeneDescription.status.in_(['draft'])
-            ).order_by(GeneDescription.sequence_name)
-            
-            unpublished_alleles = unpublished_query.all()
-
-        # if include evidence is selected, include genomic_evidence records for all alleles
-        published_evidence = {}
-        if include_evidence and published_alleles:
-            published_evidence_query = db.session.query(GenomicSupport, GeneDescription.sequence_name).join(GeneDescription).filter(
-                GeneDescription.species == species,
-                GeneDescription.locus == locus,
-                or_(GeneDescription.sequence_name.like(f'{gene_name}*%'), GeneDescription.sequence_name == gene_name),
-                GeneDescription.status == 'published'
-            )
+# Columns of the sequence list searched by the search box of a server-side table
+SEQUENCE_SEARCH_COLUMNS = ('sequence_name', 'imgt_name', 'alt_names', 'description_id', 'inference_type', 'affirmation_level')
 
-            published_recs = published_evidence_query.all()
-            if published_recs:
-                for rec, seq_name in published_recs:
-                    try:
-                        seq = rec.sequence[rec.gene_start - 1 - rec.sequence_start + 1:rec.gene_end - rec.sequence_start + 1]
-                        seq = gap_align(seq, published_alleles[0].coding_seq_imgt)  # Align to first published allele
-                        label = f'{seq_name} {rec.accession}'
-                        published_evidence[label] = seq
-                    except:
-                        continue
-
-        unpublished_evidence = {}
-        if current_user.is_authenticated and current_user.has_role(species):
-            if include_evidence and (published_alleles or unpublished_alleles):
-                unpublished_evidence_query = db.session.query(GenomicSupport, GeneDescription.sequence_name).join(GeneDescription).filter(
-                    GeneDescription.species == species,
-                    GeneDescription.locus == locus,
-                    or_(GeneDescription.sequence_name.like(f'{gene_name}*%'), GeneDescription.sequence_name == gene_name),
-                    GeneDescription.status == 'draft'
-                )
-
-                unpublished_recs = unpublished_evidence_query.all()
-                if unpublished_recs:
-                    for rec, seq_name in unpublished_recs:
-                        try:
-                            seq = rec.sequence[rec.gene_start - 1 - rec.sequence_start + 1:rec.gene_end - rec.sequence_start + 1]
-                            ref = published_alleles[0] if published_alleles else unpublished_alleles[0]
-                            seq = gap_align(seq, ref.coding_seq_imgt)  # Align to reference allele
-                            label = f'{seq_name} {rec.accession} (U)'
-                            unpublished_evidence[label] = seq
-                        except:
-                            continue
-
-        # Calculate codon positions for CDRs in the gapped sequence
-        ref = published_alleles[0] if published_alleles else unpublished_alleles[0]
-        sequence_type = ref.sequence_type
-
-        v_coords = None
-        if sequence_type == 'V':
-            try:
-                seq_gapped = ref.coding_seq_imgt
-                # build a mapping of ungapped to gapped positions
-                ungapped_to_gapped = {}
-                ungapped_index = 0                    
-
-                for gapped_index in range(len(seq_gapped)):
-                    if seq_gapped[gapped_index] != '.':
-                        ungapped_to_gapped[ungapped_index] = gapped_index
-                        ungapped_index += 1
-
-                cdr1_codon_start = int(1 + (ungapped_to_gapped[ref.cdr1_start - ref.gene_start])/3)
-                cdr1_codon_end = int(1 + (ungapped_to_gapped[ref.cdr1_end - ref.gene_start - 2])/3)
-                cdr2_codon_start = int(1 + (ungapped_to_gapped[ref.cdr2_start - ref.gene_start])/3)
-                cdr2_codon_end = int(1 + (ungapped_to_gapped[ref.cdr2_end - ref.gene_start - 2])/3)
-                cdr3_codon_start = int(1 + (ungapped_to_gapped[ref.cdr3_start - ref.gene_start])/3)
-                v_coords = (cdr1_codon_start, cdr1_codon_end, cdr2_codon_start, cdr2_codon_end, cdr3_codon_start)
-                print(v_coords)
-            except:
-                print('error calculating v_coords')
-                v_coords = None
 
-        # Combine all alleles
-        all_alleles = list(published_alleles) + unpublished_alleles
-        
-        if not all_alleles:
-            return {
-                'error': f'No sequences found for {species} {locus} {gene_name}',
-                'alignment': None,
-                'sequences': []
-            }
-        
-        # Prepare sequences for alignment
-        sequences = {}
-        suffixes = False
-        
-        j_codon_frame = None
-        for allele in all_alleles:
-            coding_seq = allele.coding_seq_imgt
-            if coding_seq:  # Only include non-empty sequences
-                # Add status indicator for unpublished sequences
-                name = allele.sequence_name
-                suffix = ''
-                if allele.status == 'draft':
-                    suffix += 'U'
-                # Add status if sequence is not in a published germline set
-                sets = db.session.query(GermlineSet).filter(
-                    GermlineSet.gene_descriptions.any(id=allele.id),
+def sequence_category_query(species, subgroup, locus, category):
+    q = db.session.query(GeneDescription).filter(GeneDescription.species == species, GeneDescription.locus == locus)
 
-                ).all()
+    if subgroup:
+        q = q.filter(GeneDescription.species_subgroup == subgroup)
 
-                published = False
-                for s in sets:
-                    if s.status == 'published':
-                        published = True
-                        break
+    if category == 'draft':
+        q = q.filter(GeneDescription.status.in_(['draft']))
+    elif category == 'level_0':
+        q = q.filter(GeneDescription.status == 'published', GeneDescription.affirmation_level == '0')
+    else:
+        q = q.filter(GeneDescription.status == 'published', GeneDescription.affirmation_level != '0')
 
-                if not published:
-                    suffix += 'N'
-
-                if suffix:
-                    name += f' ({suffix})'
-                    suffixes = True
-
-                prefix = ''
-                if sequence_type == 'J' and allele.j_codon_frame and j_codon_frame is None:
-                    try:
-                        j_codon_frame = int(allele.j_codon_frame)
-                    except:
-                        j_codon_frame = None
-                sequences.update({name: prefix + allele.coding_seq_imgt})
-
-        sequences.update(published_evidence)
-        sequences.update(unpublished_evidence)
-
-        if sequence_type == 'J' and j_codon_frame is not None:
-            prefix = '.' * ((4 - int(j_codon_frame)) % 3)
-            for name, sequence in sequences.items():
-                sequences[name] = prefix + sequence
-
-        if not sequences:
-            return {
-                'error': f'No valid coding sequences found for {species} {locus} {gene_name}',
-                'alignment': None,
-                'sequences': [],
-                'suffixes': False,
-            }
-        
-        # Create alignment using receptor_utils
-        try:
-            alignment_result = create_alignment(sequences, sequence_type, codon_wrap=codons_per_line, v_coords=v_coords)
-            
-            return {
-                'error': None,
-                'alignment': alignment_result,
-                'sequences': list(sequences.keys()),
-                'count': len(sequences),
-                'suffixes': suffixes
-            }
-        except Exception as e:
-            return {
-                'error': f'Error creating alignment: {str(e)}',
-                'alignment': None,
-                'sequences': list(sequences.keys()),
-                'suffixes': False
-            }
-            
-    except Exception as e:
-        return {
-            'error': f'Error retrieving sequences: {str(e)}',
-            'alignment': None,
-            'sequences': [],
-            'suffixes': False
-        }
+    return q
+
+
+def server_side_sequence_table(species, subgroup, locus, category):
+    # Only the header is rendered here: rows are loaded a page at a time from sequence_table_data
+    table = setup_sequence_list_table([], current_user)
+    table.allow_empty = True
+    table.data_url = url_for('sequence_table_data', species=species, locus=locus, category=category, subgroup=subgroup)
+    return table
 
 
 def create_sequence_tables(species, subgroup, locus):
     """Create sequence tables based on selection criteria"""
     tables = {}
     
-    # Base query filters
-    base_filters = [
-        GeneDescription.species == species,
-        GeneDescription.locus == locus
-    ]
-    
-    if subgroup:
-        base_filters.append(GeneDescription.species_subgroup == subgroup)
-    
     # Check if user has committee access for this species
     has_committee_access = current_user.is_authenticated and current_user.has_role(species)
     
@@ -667,38 +451,48 @@ def create_sequence_tables(species, subgroup, locus):
             tables['species'] = {}
         tables['species'][species] = {}
         
-        # Draft sequences
-        draft_query = db.session.query(GeneDescription).filter(
-            *base_filters,
-            GeneDescription.status.in_(['draft'])
-        )
-        draft_results = draft_query.all()
+        # Draft sequences. These are rendered in full, so that the whole table can be selected for publication or deletion
+        draft_results = sequence_category_query(species, subgroup, locus, 'draft').all()
         tables['species'][species]['draft'] = setup_sequence_list_table(draft_results, current_user)
         tables['species'][species]['draft'].table_id = species.replace(' ', '_') + '_draft'
         
         # Level 0 sequences
-        level_0_query = db.session.query(GeneDescription).filter(
-            *base_filters,
-            GeneDescription.status == 'published',
-            GeneDescription.affirmation_level == '0'
-        )
-        level_0_results = level_0_query.all()
-        tables['species'][species]['level_0'] = setup_sequence_list_table(level_0_results, current_user)
+        tables['species'][species]['level_0'] = server_side_sequence_table(species, subgroup, locus, 'level_0')
         tables['species'][species]['level_0'].table_id = species.replace(' ', '_') + '_level_0'
     
     # Affirmed sequences (available to all users)
-    affirmed_query = db.session.query(GeneDescription).filter(
-        *base_filters,
-        GeneDescription.status == 'published',
-        GeneDescription.affirmation_level != '0'
-    )
-    affirmed_results = affirmed_query.all()
-    tables['affirmed'] = setup_sequence_list_table(affirmed_results, current_user)
+    tables['affirmed'] = server_side_sequence_table(species, subgroup, locus, 'affirmed')
     tables['affirmed'].table_id = 'affirmed'
+    tables['affirmed_count'] = sequence_category_query(species, subgroup, locus, 'affirmed').count()
     
     return tables
 
 
+@app.route('/sequence_table_data/<species>/<locus>/<category>', methods=['GET'])
+def sequence_table_data(species, locus, category):
+    """DataTables server-side endpoint for the level 0 and affirmed sequence tables"""
+    if category not in ('level_0', 'affirmed'):
+        return jsonify({'error': 'Invalid category'}), 400
+
+    if category == 'level_0' and not (current_user.is_authenticated and current_user.has_role(species)):
+        return jsonify({'error': 'Not authorised'}), 403
+
+    subgroup = request.args.get('subgroup')
+    subgroup = None if subgroup in (None, 'null', '', 'None') else subgroup
+
+    q = sequence_category_query(species, subgroup, locus, category)
+
+    columns = GeneDescription.__table__.columns
+    params = parse_datatable_request(request.args, table_keys(setup_sequence_list_table([], current_user)))
+    sort_columns = {key: columns[key] for key in columns.keys()}
+    sort_columns.update({key: feature_sequence_expression(key) for key in SEQUENCE_FEATURES})
+    filters = {key: contains_filter(expression) for key, expression in sort_columns.items()}
+
+    records_total, records_filtered, q = apply_datatable_request(q, params, sort_columns, filters, SEQUENCE_SEARCH_COLUMNS)
+    table = setup_sequence_list_table(q.all(), current_user)
+    return jsonify(datatable_response(params, records_total, records_filtered, table))
+
+
 def copy_acknowledgements(seq, gene_description):
     def add_acknowledgement_to_gd(name, institution_name, orcid_id, gene_description):
         for ack in gene_description.acknowledgements:
@@ -2172,6 +1966,7 @@ def publish_sequence(seq, notes, email):
     seq.release_description = notes
     seq.status = 'published'
     db.session.commit()
+    store_gene_description_diff(seq)
 
 
 @app.route('/download_sequence_attachment/<id>')
@@ -0,0 +1,149 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Server-side paging, sorting and filtering for the DataTables on the sequence list and gene table pages
+#
+# Tables run in DataTables' serverSide mode. Each draw sends draw, start, length, search[value], order[i][column],
+# order[i][dir], columns[i][data] and columns[i][search][value]. Rows are sent as arrays, so columns[i][data] is the
+# index of the column in the table as built, whatever order ColReorder is showing them in.
+#
+# The page of rows is rendered with the same flask_table columns that would render the full HTML table, so that
+# cells are identical whichever way the table is delivered.
+
+from sqlalchemy import String, cast, or_
+
+from head import db
+from db.germline_set_db import GermlineSet, gene_descriptions_germline_sets
+
+MAX_PAGE_LENGTH = 5000
+DEFAULT_PAGE_LENGTH = 25
+
+
+def published_set_members():
+    """
+    Subquery of the ids of gene descriptions that belong to at least one published germline set.
+    Outer join it to GeneDescription on gene_description_id to tell members from non-members.
+    """
+    return db.session.query(gene_descriptions_germline_sets.c.gene_descriptions_id.label('gene_description_id'))\
+        .join(GermlineSet, GermlineSet.id == gene_descriptions_germline_sets.c.germline_sets_id)\
+        .filter(GermlineSet.status == 'published')\
+        .distinct()\
+        .subquery()
+
+
+def _int_arg(args, name, default):
+    try:
+        return int(args.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_datatable_request(args, keys):
+    """
+    Parse the parameters of a DataTables server-side request
+
+    Args:
+        args: request.args
+        keys: the keys of the table's columns, in the order the table was built
+
+    Returns:
+        dict with draw, start, length, search (global search value), order (list of (key, descending))
+        and column_search (dict of key to search value)
+    """
+    params = {
+        'draw': _int_arg(args, 'draw', 0),
+        'start': max(0, _int_arg(args, 'start', 0)),
+        'length': _int_arg(args, 'length', DEFAULT_PAGE_LENGTH),
+        'search': args.get('search[value]', '').strip(),
+        'order': [],
+        'column_search': {},
+    }
+
+    if params['length'] < 0 or params['length'] > MAX_PAGE_LENGTH:
+        params['length'] = MAX_PAGE_LENGTH
+
+    def column_key(i):
+        data = _int_arg(args, 'columns[%d][data]' % i, i)
+        return keys[data] if 0 <= data < len(keys) else None
+
+    i = 0
+    while 'order[%d][column]' % i in args:
+        key = column_key(_int_arg(args, 'order[%d][column]' % i, -1))
+        if key:
+            params['order'].append((key, args.get('order[%d][dir]' % i) == 'desc'))
+        i += 1
+
+    i = 0
+    while 'columns[%d][data]' % i in args:
+        value = args.get('columns[%d][search][value]' % i, '').strip()
+        key = column_key(i)
+        if value and key:
+            params['column_search'][key] = value
+        i += 1
+
+    return params
+
+
+def contains_filter(expr):
+    return lambda value: cast(expr, String).ilike('%' + value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%', escape='\\')
+
+
+def apply_datatable_request(q, params, sort_columns, filters, search_keys):
+    """
+    Filter, sort and page a query as requested
+
+    Args:
+        q: the query for all rows the user may see
+        params: as returned by parse_datatable_request
+        sort_columns: dict of column key to the SQL expression to sort on. Other columns can't be sorted
+        filters: dict of column key to a function taking a search value and returning a filter clause
+        search_keys: keys of the filters used for the global search
+
+    Returns:
+        total number of rows, number of rows after filtering, and the query for the requested page
+    """
+    records_total = q.order_by(None).count()
+
+    if params['search']:
+        q = q.filter(or_(*[filters[key](params['search']) for key in search_keys]))
+
+    for key, value in params['column_search'].items():
+        if key in filters:
+            q = q.filter(filters[key](value))
+
+    records_filtered = q.order_by(None).count() if (params['search'] or params['column_search']) else records_total
+
+    order = []
+    for key, descending in params['order']:
+        if key in sort_columns:
+            order.append(sort_columns[key].desc() if descending else sort_columns[key].asc())
+
+    if order:
+        q = q.order_by(None).order_by(*order)
+
+    q = q.offset(params['start']).limit(params['length'])
+    return records_total, records_filtered, q
+
+
+def table_keys(table):
+    return [key for key, col in table._cols.items() if col.show]
+
+
+def render_table_rows(table):
+    """
+    Render the cells of a flask_table table, as a list of rows, each a list of cell contents
+    """
+    cols = [(key, col) for key, col in table._cols.items() if col.show]
+    return [[str(col.td_contents(item, col.get_attr_list(key))) for key, col in cols] for item in table.items]
+
+
+def datatable_response(params, records_total, records_filtered, table):
+    return {
+        'draw': params['draw'],
+        'recordsTotal': records_total,
+        'recordsFiltered': records_filtered,
+        'data': render_table_rows(table),
+    }
@@ -48,8 +48,10 @@ def update_sample_details(gen, form, repo):
         sam_ids = sam_ids.replace(';', ' ')
         sam_ids = sam_ids.split()
 
+        details = require_all(get_nih_samn_details_batch, sam_ids) if repo == 'NCBI SRA' else {}
+
         for sam_id in sam_ids:
-            resp = get_nih_samn_details(sam_id) if repo == 'NCBI SRA' else get_ena_samn_details(sam_id)
+            resp = details[sam_id] if repo == 'NCBI SRA' else get_ena_samn_details(sam_id)
             rec = SampleName()
             rec.sam_accession_no = sam_id
             rec.sam_record_title = resp['title']
@@ -69,8 +71,10 @@ def update_sample_details(gen, form, repo):
         run_ids = run_ids.replace(';', ' ')
         run_ids = run_ids.split()
 
+        details = require_all(get_nih_srr_details_batch, run_ids) if repo == 'NCBI SRA' else {}
+
         for run_id in run_ids:
-            resp = get_nih_srr_details(run_id) if repo == 'NCBI SRA' else get_ena_srr_details(run_id)
+            resp = details[run_id] if repo == 'NCBI SRA' else get_ena_srr_details(run_id)
             rec = RecordSet()
             rec.rec_accession_no = run_id
             rec.rec_record_title = resp['title']
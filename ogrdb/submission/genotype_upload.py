@@ -11,87 +11,203 @@
 #
 
 # Create genotype records from BLOB in database
+#
+# The whole file is read and validated before anything is written. If every row is valid, the records are
+# gapped where necessary and inserted with a single executemany in one transaction. Otherwise nothing is
+# imported and the errors are reported row by row.
 
-from io import StringIO, BytesIO
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
 import csv
 from db.genotype_db import *
 from flask import flash
 from wtforms import ValidationError
+from sqlalchemy import insert
 from sqlalchemy.exc import OperationalError
 from db.genotype_tables import *
-from imgt.imgt_ref import gap_sequence
+from imgt.imgt_ref import gap_sequences
 from imgt.imgt_ref import get_imgt_gapped_reference_genes
 
 light_loci = ['IGK', 'IGL', 'TRA', 'TRG']
 
-def file_to_genotype(name, desc, db):
-    refs = get_imgt_gapped_reference_genes()
-    line = 2
-    try:
-        fi = open(name, 'r')
+# number of row errors listed individually before the rest are summarised
+MAX_REPORTED_ERRORS = 20
+
+# Columns that may be imported, other than the keys
+
+genotype_columns = {col.key: col for col in Genotype.__table__.columns if col.key not in ['id', 'description_id']}
+
+
+def convert_genotype_field(field, value):
+    col = genotype_columns[field]
+
+    if isinstance(col.type, (db.Integer, db.Numeric)):
+        try:
+            num = Decimal(value.strip())
+        except InvalidOperation:
+            raise ValueError("'%s' is not a number" % value)
+
+        if not num.is_finite():
+            raise ValueError("'%s' is not a number" % value)
+
+        if isinstance(col.type, db.Integer):
+            if num != num.to_integral_value():
+                raise ValueError("'%s' is not a whole number" % value)
+            return int(num)
+
+        return num
+
+    if isinstance(col.type, db.String) and col.type.length and len(value) > col.type.length:
+        raise ValueError('value is longer than %d characters' % col.type.length)
+
+    return value
+
+
+def read_genotype_file(name, desc):
+    """
+    Read and validate a genotype file
+
+    Args:
+        name: path of the CSV file
+        desc: the GenotypeDescription that the genotypes will belong to
+
+    Returns:
+        (records, errors): records is a list of (line, dict of Genotype field values) for each row containing data,
+        errors is a list of (line, message) for each problem found
+    """
+    records = []
+    errors = []
+
+    with open(name, 'r') as fi:
         reader = csv.DictReader(fi, lineterminator = '\n')
-        first = True
+        fieldnames = reader.fieldnames or []
+
+        # support former field name 'haplotyping_locus' -> 'haplotyping_gene'
+        rename_locus = 'haplotyping_locus' in fieldnames and 'haplotyping_gene' not in fieldnames
+
+        unsupported = []
         imported = []
+        for field in fieldnames:
+            if field == 'haplotyping_locus':
+                if rename_locus:
+                    imported.append('haplotyping_gene')
+            elif field not in genotype_columns:
+                unsupported.append(field)
+            else:
+                imported.append(field)
+
+        if len(unsupported) > 0:
+            flash("Unrecognised field(s) '%s' have not been imported" % ','.join(unsupported))
+
+        if desc.sequence_type in ['V', 'J']:
+            chain = desc.sequence_type + ('L' if desc.locus in light_loci else 'H')
+        elif desc.sequence_type == 'D':
+            chain = 'D'
+        else:
+            chain = desc.sequence_type
+
+        missing = []
+        if chain in reqd_gen_fields:
+            for field in reqd_gen_fields[chain]:
+                if field not in fieldnames:
+                    missing.append(field)
+
+            if len(missing) > 0:
+                errors.append((1, 'Required column(s) %s are missing' % ', '.join(missing)))
+                return records, errors
+
         for row in reader:
-            # support former field name 'haplotyping_locus' -> 'haplotyping_gene'
-            if 'haplotyping_locus' in row and 'haplotyping_gene' not in row:
-                row['haplotyping_gene'] = row['haplotyping_locus']
-                del(row['haplotyping_locus'])
-            rec = Genotype()
-            if first:
-                unsupported = []
-                for field in reader.fieldnames:
-                    if field != 'haplotyping_locus':
-                        if not hasattr(rec, field):
-                            unsupported.append(field)
-                        else:
-                            imported.append(field)
-                if len(unsupported) > 0:
-                    flash("Unrecognised field(s) '%s' have not been imported" % ','.join(unsupported))
-
-                if desc.sequence_type in ['V', 'J']:
-                    chain = desc.sequence_type + ('L' if desc.locus in light_loci else 'H')
-                elif desc.sequence_type == 'D':
-                    chain = 'D'
-                else:
-                    chain = desc.sequence_type
-
-                missing = []
-                if chain in reqd_gen_fields:
-                    for field in reqd_gen_fields[chain]:
-                        if field not in reader.fieldnames:
-                            missing.append(field)
-
-                    if len(missing) > 0:
-                        raise ValidationError('Required column(s) %s are missing' % ', '.join(missing))
-
-                first = False
-
-            has_data = False
+            line = reader.line_num
+
+            if rename_locus:
+                row['haplotyping_gene'] = row.pop('haplotyping_locus')
+
+            rec = {}
             for field in imported:
                 if field in row and row[field] is not None:
                     f = row[field].strip()
                     if len(f) > 0:
-                        setattr(rec, field, row[field])
-                        has_data = True
+                        try:
+                            rec[field] = convert_genotype_field(field, row[field])
+                        except ValueError as e:
+                            errors.append((line, '%s: %s' % (field, e.args[0])))
+
+            if len(rec) > 0:
+                records.append((line, rec))
+
+    return records, errors
+
+
+# For the time being, we'll gap V records that don't have a gapped sequence provided.
+# We can phase this out after a few months, once we're confident that everyone is using an ogrdbstats script which provides gapped sequences
+# Records are grouped by reference, so that each reference is prepared once and its sequences gapped together
+
+def gap_genotype_records(records, species):
+    refs = get_imgt_gapped_reference_genes().get(species, {})
+    by_ref = defaultdict(list)
+    errors = []
+
+    for line, rec in records:
+        if rec.get('nt_sequence_gapped'):
+            continue
+
+        if not rec.get('nt_sequence'):
+            errors.append((line, 'nt_sequence is required to gap the sequence'))
+        elif rec.get('sequence_id') in refs:
+            by_ref[rec['sequence_id']].append(rec)
+        elif rec.get('closest_reference') in refs:
+            by_ref[rec['closest_reference']].append(rec)
+        else:
+            errors.append((line, "closest_reference '%s' is not in the IMGT reference set for %s" % (rec.get('closest_reference'), species)))
+
+    for ref_name, recs in by_ref.items():
+        gapped = gap_sequences([rec['nt_sequence'] for rec in recs], refs[ref_name].upper())
+        for rec, seq in zip(recs, gapped):
+            rec['nt_sequence_gapped'] = seq
+
+    return errors
+
 
-            if has_data:
-                rec.description_id = desc.id
+def report_genotype_errors(errors):
+    for line, msg in errors[:MAX_REPORTED_ERRORS]:
+        flash('Import error at line %d:  %s' % (line, msg), 'error')
+
+    if len(errors) > MAX_REPORTED_ERRORS:
+        flash('... and %d further errors' % (len(errors) - MAX_REPORTED_ERRORS), 'error')
+
+
+def file_to_genotype(name, desc, db):
+    """
+    Import the genotypes in a CSV file into a genotype description
+
+    Returns:
+        the number of genotypes imported
 
-                # For the time being, we'll gap V records that don't have a gapped sequence provided.
-                # We can phase this out after a few months, once we're confident that everyone is using an ogrdbstats script which provides gapped sequences
+    Raises:
+        ValidationError if any row could not be imported, in which case nothing is imported and the
+        per-row errors are flashed
+    """
+    try:
+        records, errors = read_genotype_file(name, desc)
 
-                if desc.sequence_type == 'V' and not rec.nt_sequence_gapped:
-                    if rec.sequence_id in refs[desc.submission.species]:
-                        rec.nt_sequence_gapped = gap_sequence(rec.nt_sequence, refs[desc.submission.species][rec.sequence_id].upper())
-                    else:
-                        rec.nt_sequence_gapped = gap_sequence(rec.nt_sequence, refs[desc.submission.species][rec.closest_reference].upper())
+        if not errors and desc.sequence_type == 'V':
+            errors = gap_genotype_records(records, desc.submission.species)
+    except Exception as e:
+        errors = [(1, e.args[0] if e.args else str(e))]
 
-                db.session.add(rec)
-                db.session.commit()
+    if errors:
+        report_genotype_errors(errors)
+        raise ValidationError('%d error(s) in genotype file' % len(errors))
 
-            line += 1
+    rows = []
+    for line, rec in records:
+        rec['description_id'] = desc.id
+        rows.append(rec)
 
+    try:
+        if rows:
+            db.session.execute(insert(Genotype), rows)
+        db.session.commit()
     except Exception as e:
         db.session.rollback()
 
@@ -103,8 +219,7 @@ def file_to_genotype(name, desc, db):
         else:
             msg = e.args[0]
 
-        flash('Import error at line %d:  %s' % (line, msg), 'error')
-        raise ValidationError(e.args[0])
-
-
+        flash('Import error:  %s' % msg, 'error')
+        raise ValidationError(msg)
 
+    return len(rows)
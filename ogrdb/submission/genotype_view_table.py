@@ -10,7 +10,7 @@ import sys
 import re
 from db.genotype_db import Genotype
 from head import app
-from db.vdjbase import get_vdjbase_ref
+from db.vdjbase import get_vdjbase_ref, find_vdjbase_matches
 
 class SeqCol(StyledCol):
     def td_contents(self, item, attr_list):
@@ -53,16 +53,12 @@ class SeqCol(StyledCol):
         bt_vdjbase = ''
 
         if item.genotype_description.submission.species == 'Homo sapiens' and item.sequence_id not in imgt_ref[item.genotype_description.submission.species]:
-            vdjbase_ref = get_vdjbase_ref()
             vdjbase_species = item.genotype_description.submission.species
             locus = item.genotype_description.locus
-            if vdjbase_species in vdjbase_ref and locus in vdjbase_ref[vdjbase_species]:
-                vdjbase_genes = vdjbase_ref[vdjbase_species][locus]
-                for vdjbase_name, (vdjbase_seq, vdjbase_count) in vdjbase_genes.items():
-                    if item.nt_sequence.lower() in vdjbase_seq or vdjbase_seq in item.nt_sequence.lower():
-                        bt_vdjbase = '<button type="button" name="vdjbasebtn" id="vdjbasebtn" class="btn btn-xs text-ogrdb-info icon_back"  onclick="window.open(%s)" data-bs-toggle="tooltip" title="Sequence matches VDJbase gene %s (found in %s subjects). Click to view in VDJbase."><i class="bi bi-info-circle-fill"></i>&nbsp;</button>' % \
-                                     (Markup("'%sgenerep/%s/%s/%s'" % (app.config['VDJBASE_URL'], 'Human', locus, vdjbase_name)), vdjbase_name, vdjbase_count)
-                        break
+            for vdjbase_name, vdjbase_seq, vdjbase_count in find_vdjbase_matches(vdjbase_species, locus, item.nt_sequence.lower()):
+                bt_vdjbase = '<button type="button" name="vdjbasebtn" id="vdjbasebtn" class="btn btn-xs text-ogrdb-info icon_back"  onclick="window.open(%s)" data-bs-toggle="tooltip" title="Sequence matches VDJbase gene %s (found in %s subjects). Click to view in VDJbase."><i class="bi bi-info-circle-fill"></i>&nbsp;</button>' % \
+                             (Markup("'%sgenerep/%s/%s/%s'" % (app.config['VDJBASE_URL'], 'Human', locus, vdjbase_name)), vdjbase_name, vdjbase_count)
+                break
 
         bt_indels = ''
         bt_imgt = ''
@@ -61,9 +61,11 @@ def update_inf_rep_details(seq, form, repo):
         run_ids = run_ids.replace(';', ' ')
         run_ids = run_ids.split()
 
+        details = require_all(get_nih_srr_details_batch, run_ids) if repo == 'NCBI SRA' else {}
+
         for run_id in run_ids:
             if repo == 'NCBI SRA':
-                resp = get_nih_srr_details(run_id)
+                resp = details[run_id]
             elif repo == 'ENA':
                 resp = get_ena_srr_details(run_id)
 
@@ -9,6 +9,7 @@ from copy import deepcopy
 
 from db.styled_table import *
 from db.submission_db import *
+from permission_context import get_permission_context
 
 class SubmissionListActionCol(StyledCol):
     def td_contents(self, item, attr_list):
@@ -39,6 +40,7 @@ class SubmissionListActionCol(StyledCol):
 
 def setup_submission_list_table(results, current_user):
     table = make_Submission_table(results)
+    current_user = get_permission_context(current_user)
     for item in table.items:
         item.viewable = item.can_see(current_user)
         item.editable = item.can_edit(current_user)
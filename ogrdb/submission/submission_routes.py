@@ -9,8 +9,9 @@ from os import mkdir, remove
 from os.path import isdir
 from traceback import format_exc
 
-from flask import request, render_template, redirect, flash, Response
+from flask import request, render_template, redirect, flash, Response, jsonify
 from flask_login import current_user, login_required
+from sqlalchemy import or_
 
 from db.journal_entry_db import JournalEntry
 from db.submission_db import Submission, save_Submission, populate_Submission
@@ -22,6 +23,9 @@ from textile_filter import safe_textile
 from ogrdb.submission.submission_edit_form import *
 from ogrdb.submission.submission_list_table import setup_submission_list_table
 from ogrdb.submission.submission_view_form import setup_submission_view_forms_and_tables
+from ogrdb.sequence.table_data import contains_filter
+
+DELEGATE_SEARCH_LIMIT = 20
 
 
 @app.route('/submissions', methods=['GET', 'POST'])
@@ -459,4 +463,25 @@ def submission(id):
            return render_template('submission_view.html', sub=sub, tables=tables, form=form, reviewer=reviewer, id=id, jump = validation_result.tag, status=sub.submission_status)
 
 
+# Users matching a search, to offer as delegates for a submission. The submission view's delegate picker calls this as the reviewer types
 
+@app.route('/delegate_candidates/<id>', methods=['GET'])
+@login_required
+def delegate_candidates(id):
+    sub = db.session.query(Submission).filter_by(submission_id = id).one_or_none()
+    if sub is None or not (current_user.has_role(sub.species) or current_user in sub.delegates):
+        return jsonify([]), 404
+
+    q = request.args.get('q', '').strip()
+    if len(q) < 2:
+        return jsonify([])
+
+    delegate_ids = [user.id for user in sub.delegates]
+    users = db.session.query(User.id, User.name, User.address)\
+        .filter(User.active == True, User.confirmed_at != None)\
+        .filter(or_(contains_filter(User.name)(q), contains_filter(User.address)(q)))\
+        .filter(User.id.notin_(delegate_ids))\
+        .order_by(User.name)\
+        .limit(DELEGATE_SEARCH_LIMIT)
+
+    return jsonify([{'id': user_id, 'text': '%s, %s' % (name, address)} for user_id, name, address in users])
@@ -11,6 +11,7 @@ from textile_filter import safe_textile
 from db.repertoire_db import *
 from db.editable_table import *
 from db.genotype_description_db import *
+from db.genotype_db import Genotype
 from db.inference_tool_db import *
 from db.inferred_sequence_db import *
 from db.journal_entry_db import *
@@ -36,11 +37,13 @@ class MessageHeaderCol(StyledCol):
 
 class MessageBodyCol(StyledCol):
     def td_contents(self, item, attr_list):
-        return Markup(safe_textile(item.body)) if item.parent is not None else "<strong>%s</strong><br>%s" % (item.title, Markup(safe_textile(item.body)))
+        return Markup(safe_textile(item.body)) if item.parent_id is not None else "<strong>%s</strong><br>%s" % (item.title, Markup(safe_textile(item.body)))
 
 
+# Users are offered on demand by the delegate_candidates endpoint, so the field can't validate against its choices
+
 class DelegateForm(FlaskForm):
-    delegate = SelectField('Delegate', coerce=int)
+    delegate = SelectField('Delegate', coerce=int, validate_choice=False)
 
 
 class Delegate_table(StyledTable):
@@ -62,12 +65,12 @@ class EditableDelegateTable(EditableTable):
             tagged = True
             try:
                 user_id = self.form.delegate.data
-                user = db.session.query(User).filter(User.id == user_id).one_or_none()
+                user = db.session.query(User).filter(User.id == user_id, User.active == True, User.confirmed_at != None).one_or_none() if user_id is not None and user_id >= 0 else None
+                if user is None:
+                    raise ValueError('Please select a delegate to add.')
                 sub = db.session.query(Submission).filter(Submission.id==self.sub_id).one_or_none()
                 if user in sub.delegates:
                     raise ValueError('%s is already a delegate!' % user.name)
-                if user_id < 0:
-                    raise ValueError('Please select a delegate to add.')
                 sub.delegates.append(user)
                 db.session.commit()
                 added = True
@@ -131,26 +134,37 @@ def make_MatchingSequences_table(results, classes=()):
     return ret
 
 def setup_matching_sequences_table(sub):
+    """
+    Published and draft sequences that duplicate a genotype of this submission, other than those inferred from it,
+    read with one query
+    """
     results = []
-    our_descriptions = []
-    for inf in sub.inferred_sequences:
-        our_descriptions.extend(inf.gene_descriptions)
-
-    for desc in sub.genotype_descriptions:
-        for seq in desc.genotypes:
-            for dup in seq.published_duplicates:
-                if dup not in our_descriptions:
-                    alignment = report_dupe(seq.nt_sequence, 'Sequence', dup.sequence, dup.description_id)
-                    match = Markup('<button id="aln_view" name="aln_view" type="button" class="btn btn-xs %s icon_back" data-bs-toggle="modal" data-bs-target="#seqModal" data-sequence="%s" data-name="%s" data-fa="%s" data-bs-toggle="tooltip" title="View"><i class="bi %s"></i>&nbsp;</button>' \
-                                   % ('text-ogrdb-info', alignment, dup.description_id, format_fasta_sequence('Sequence', seq.nt_sequence, 50) + format_fasta_sequence(dup.description_id, dup.sequence, 50), 'bi-search'))
-
-                    results.append({'subject_id': seq.genotype_description.genotype_subject_id,
-                                    'genotype_name': seq.genotype_description.genotype_name,
-                                    'sequence_name': seq.sequence_id,
-                                    'published_name': dup.description_id,
-                                    'published_id': dup.id,
-                                    'status': dup.status,
-                                    'match': match})
+
+    our_descriptions = db.session.query(inferred_sequences_gene_descriptions.c.gene_descriptions_id)\
+        .join(InferredSequence, InferredSequence.id == inferred_sequences_gene_descriptions.c.inferred_sequences_id)\
+        .filter(InferredSequence.submission_id == sub.id)
+
+    rows = db.session.query(Genotype.sequence_id, Genotype.nt_sequence, GenotypeDescription.genotype_subject_id, GenotypeDescription.genotype_name,
+                            GeneDescription.id, GeneDescription.description_id, GeneDescription.sequence, GeneDescription.status)\
+        .join(GenotypeDescription, Genotype.description_id == GenotypeDescription.id)\
+        .join(duplicate_sequences_published_duplicates, duplicate_sequences_published_duplicates.c.duplicate_sequences_id == Genotype.id)\
+        .join(GeneDescription, GeneDescription.id == duplicate_sequences_published_duplicates.c.published_duplicates_id)\
+        .filter(GenotypeDescription.submission_id == sub.id, GeneDescription.id.notin_(our_descriptions))\
+        .order_by(GenotypeDescription.id, Genotype.id, GeneDescription.id)\
+        .all()
+
+    for sequence_id, nt_sequence, subject_id, genotype_name, dup_id, description_id, dup_sequence, dup_status in rows:
+        alignment = report_dupe(nt_sequence, 'Sequence', dup_sequence, description_id)
+        match = Markup('<button id="aln_view" name="aln_view" type="button" class="btn btn-xs %s icon_back" data-bs-toggle="modal" data-bs-target="#seqModal" data-sequence="%s" data-name="%s" data-fa="%s" data-bs-toggle="tooltip" title="View"><i class="bi %s"></i>&nbsp;</button>' \
+                       % ('text-ogrdb-info', alignment, description_id, format_fasta_sequence('Sequence', nt_sequence, 50) + format_fasta_sequence(description_id, dup_sequence, 50), 'bi-search'))
+
+        results.append({'subject_id': subject_id,
+                        'genotype_name': genotype_name,
+                        'sequence_name': sequence_id,
+                        'published_name': description_id,
+                        'published_id': dup_id,
+                        'status': dup_status,
+                        'match': match})
 
     if len(results) == 0:
         return None
@@ -220,16 +234,26 @@ def setup_submission_view_forms_and_tables(sub, db, private):
     t.add_column('Published', PubGeneCol('Published'))
     tables['iarc_inferred_sequence'] = t
 
-    history = db.session.query(JournalEntry).filter_by(submission_id = sub.id, type = 'history').all()
+    # All journal entries are read in one query, and sorted into history and note threads
+
+    entries = db.session.query(JournalEntry).filter(JournalEntry.submission_id == sub.id, JournalEntry.type.in_(['history', 'note'])).order_by(JournalEntry.id).all()
+
+    history = [entry for entry in entries if entry.type == 'history']
     t = make_JournalEntry_table(history)
     tables['history'] = t
 
+    threads = []
+    replies = {}
+    for entry in entries:
+        if entry.type == 'note':
+            if entry.parent_id is None:
+                threads.append(entry)
+            else:
+                replies.setdefault(entry.parent_id, []).append(entry)
+
     tables['notes'] = []
-    threads = db.session.query(JournalEntry).filter_by(submission_id = sub.id, type = 'note', parent_id = None).order_by(JournalEntry.date.desc()).all()
-    for thread in threads:
-        replies = db.session.query(JournalEntry).filter_by(submission_id = sub.id, type = 'note', parent_id = thread.id).order_by(JournalEntry.date.asc()).all()
-        replies= [thread] + replies
-        t = StyledTable(replies, classes=['tablefixed'])
+    for thread in sorted(threads, key=lambda entry: entry.date, reverse=True):
+        t = StyledTable([thread] + sorted(replies.get(thread.id, []), key=lambda entry: entry.date), classes=['tablefixed'])
         t.add_column('header', MessageHeaderCol("", tooltip=""))
         t._cols['header'].th_html_attrs['class'] += ' row-20'
         t.add_column('body', MessageBodyCol("", tooltip=""))
@@ -247,8 +271,15 @@ def setup_submission_view_forms_and_tables(sub, db, private):
     tables['delegate_table'] = EditableDelegateTable(make_Delegate_table(delegates), 'delegates', DelegateForm, delegates, legend='Add Delegate')
     tables['delegate_table'].sub_id = sub.id
 
-    users = db.session.query(User).filter(User.active==True, User.confirmed_at!=None)
-    tables['delegate_table'].form.delegate.choices = [(-1, '--- Select User to add as Delegate ---')] + [(user.id, '%s, %s' % (user.name, user.address)) for user in users]
+    # Users are searched for with the delegate_candidates endpoint. Only a user already selected is offered here
+
+    choices = [(-1, '--- Select User to add as Delegate ---')]
+    selected = tables['delegate_table'].form.delegate.data
+    if selected is not None and selected >= 0:
+        user = db.session.query(User).filter(User.id == selected, User.active == True, User.confirmed_at != None).one_or_none()
+        if user is not None:
+            choices.append((user.id, '%s, %s' % (user.name, user.address)))
+    tables['delegate_table'].form.delegate.choices = choices
 
     form = AggregateForm(journal_entry_form, hidden_return_form, tables['delegate_table'].form)
     return (form, tables)
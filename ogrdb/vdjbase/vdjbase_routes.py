@@ -11,7 +11,7 @@ from sqlalchemy import and_
 
 from db.attached_file_db import AttachedFile, make_AttachedFile_table
 from db.novel_vdjbase_db import NovelVdjbase
-from db.vdjbase import update_from_vdjbase, setup_vdjbase_review_tables
+from db.vdjbase import start_vdjbase_import, setup_vdjbase_review_tables
 from forms.attached_file_form import AttachedFileForm
 from forms.notes_entry_form import NotesEntryForm
 from forms.review_vdjbase_form import ReviewVdjbaseForm
@@ -22,7 +22,8 @@ from textile_filter import safe_textile
 
 @app.route('/vdjbase_import', methods=['GET'])
 def vdjbase_import():
-    return update_from_vdjbase()
+    # The import runs in the background: progress and errors are logged
+    return start_vdjbase_import()
 
 
 def can_edit_vdjbase_review(species):
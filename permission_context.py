@@ -0,0 +1,61 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Request-scoped view of the current user's permissions
+#
+# The can_see/can_edit/can_draft checks of the record mixins are called for every row of a list table. Each check
+# scans the user's roles, and the submission checks load the user's delegations. A PermissionContext resolves the
+# role names and delegated submissions once, and is kept in flask.g for the rest of the request. The mixins accept
+# either a User or a PermissionContext, so list builders can resolve the context once and pass it to every row.
+
+from flask import g, has_request_context
+
+
+class PermissionContext:
+    def __init__(self, user):
+        self.user = user
+        self.is_authenticated = bool(user is not None and user.is_authenticated)
+        self.user_id = user.id if self.is_authenticated else None
+        self.roles = frozenset(role.name for role in user.roles) if self.is_authenticated else frozenset()
+        self._delegated_submission_ids = None
+
+    def has_role(self, role):
+        return role in self.roles
+
+    def is_user(self, user_id):
+        return self.is_authenticated and user_id == self.user_id
+
+    def is_delegate(self, submission):
+        if not self.is_authenticated:
+            return False
+
+        if self._delegated_submission_ids is None:
+            self._delegated_submission_ids = frozenset(sub.id for sub in self.user.delegated_submissions)
+
+        return submission.id in self._delegated_submission_ids
+
+
+def get_permission_context(user):
+    """
+    Get the permission context for a user. Within a request, the context is built once and then reused.
+
+    Args:
+        user: a User (usually current_user), or a PermissionContext, which is returned as is
+    """
+    if isinstance(user, PermissionContext):
+        return user
+
+    if not has_request_context():
+        return PermissionContext(user)
+
+    key = user.id if (user is not None and user.is_authenticated) else None
+    contexts = g.setdefault('permission_contexts', {})
+
+    if key not in contexts:
+        contexts[key] = PermissionContext(user)
+
+    return contexts[key]
+
@@ -0,0 +1,145 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Count and time the SQL statements issued by each request, and attribute them to the Flask endpoint
+#
+# Per-endpoint histograms of statements per request, database time per request and time per statement are
+# kept in process memory, and can be read from the local-only /query_stats route. Statements taking longer
+# than SLOW_QUERY_THRESHOLD seconds (default 0.5) are logged as warnings.
+#
+# Instrumentation is enabled by setting QUERY_STATS = True in the config.
+
+import threading
+import time
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+
+# upper bounds of the histogram buckets. The last bucket holds everything above the last bound
+COUNT_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+TIME_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]
+
+DEFAULT_SLOW_QUERY_THRESHOLD = 0.5
+
+endpoint_stats = {}
+stats_lock = threading.Lock()
+slow_query_threshold = DEFAULT_SLOW_QUERY_THRESHOLD
+logger = None
+
+
+def bucket_index(buckets, value):
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            return i
+    return len(buckets)
+
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.statements = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.statements_per_request = [0] * (len(COUNT_BUCKETS) + 1)
+        self.time_per_request = [0] * (len(TIME_BUCKETS) + 1)
+        self.time_per_statement = [0] * (len(TIME_BUCKETS) + 1)
+
+    def add_statement(self, elapsed):
+        self.time_per_statement[bucket_index(TIME_BUCKETS, elapsed)] += 1
+        self.max_time = max(self.max_time, elapsed)
+
+    def add_request(self, statements, elapsed):
+        self.requests += 1
+        self.statements += statements
+        self.total_time += elapsed
+        self.statements_per_request[bucket_index(COUNT_BUCKETS, statements)] += 1
+        self.time_per_request[bucket_index(TIME_BUCKETS, elapsed)] += 1
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'statements': self.statements,
+            'total_time': round(self.total_time, 6),
+            'max_statement_time': round(self.max_time, 6),
+            'statements_per_request': dict(zip(bucket_labels(COUNT_BUCKETS), self.statements_per_request)),
+            'time_per_request': dict(zip(bucket_labels(TIME_BUCKETS), self.time_per_request)),
+            'time_per_statement': dict(zip(bucket_labels(TIME_BUCKETS), self.time_per_statement)),
+        }
+
+
+def bucket_labels(buckets):
+    return ['<=%s' % b for b in buckets] + ['>%s' % buckets[-1]]
+
+
+def current_endpoint():
+    if has_request_context():
+        return request.endpoint or '(no endpoint)'
+    return '(no request)'
+
+
+def get_endpoint_stats(endpoint):
+    if endpoint not in endpoint_stats:
+        endpoint_stats[endpoint] = EndpointStats()
+    return endpoint_stats[endpoint]
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+    endpoint = current_endpoint()
+
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+        g.query_time = g.get('query_time', 0.0) + elapsed
+
+    with stats_lock:
+        get_endpoint_stats(endpoint).add_statement(elapsed)
+
+    if elapsed > slow_query_threshold:
+        logger.warning('Slow query (%.3fs) in %s: %s' % (elapsed, endpoint, ' '.join(statement.split())[:1000]))
+
+
+# A statement that fails never reaches after_cursor_execute, so its start time is discarded here
+
+def handle_error(exception_context):
+    conn = exception_context.connection
+    if exception_context.cursor is not None and conn is not None and conn.info.get('query_start_time'):
+        conn.info['query_start_time'].pop()
+
+
+def record_request(exc):
+    with stats_lock:
+        get_endpoint_stats(current_endpoint()).add_request(g.get('query_count', 0), g.get('query_time', 0.0))
+
+
+def get_query_stats():
+    with stats_lock:
+        return {endpoint: stats.as_dict() for endpoint, stats in sorted(endpoint_stats.items())}
+
+
+def reset_query_stats():
+    with stats_lock:
+        endpoint_stats.clear()
+
+
+def init_query_stats(app, db):
+    global slow_query_threshold, logger
+
+    if not app.config.get('QUERY_STATS'):
+        return
+
+    slow_query_threshold = float(app.config.get('SLOW_QUERY_THRESHOLD', DEFAULT_SLOW_QUERY_THRESHOLD))
+    logger = app.logger
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(db.engine, 'handle_error', handle_error)
+
+    app.teardown_request(record_request)
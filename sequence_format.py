@@ -245,19 +245,27 @@ def format_aln(alignment, name1, name2, width):
 # The 3nt in the genotype sequence closest to the junction with another segment are ignored
 
 IGNORE_NT = 3
+
+
+def trim_genotype_sequence(genotype_seq, sequence_type):
+    if sequence_type == 'V':
+        genotype_seq = genotype_seq[:0-IGNORE_NT]
+    elif sequence_type == 'J':
+        genotype_seq = genotype_seq[IGNORE_NT:]
+    elif sequence_type == 'D':
+        genotype_seq = genotype_seq[IGNORE_NT:0-IGNORE_NT]
+
+    # TODO: other sequence types
+
+    return genotype_seq
+
+
 def check_duplicate(genotype_seq, desc_seq, sequence_type):
     try:
-        if sequence_type == 'V':
-            genotype_seq = genotype_seq[:0-IGNORE_NT]
-        elif sequence_type == 'J':
-            genotype_seq = genotype_seq[IGNORE_NT:]
-        elif sequence_type == 'D':
-            genotype_seq = genotype_seq[IGNORE_NT:0-IGNORE_NT]
+        genotype_seq = trim_genotype_sequence(genotype_seq, sequence_type)
     except:
         return False    # ignore short/nonexistent sequences
 
-    # TODO: other sequence types
-
     return(genotype_seq in desc_seq or desc_seq in genotype_seq)
 
 
@@ -0,0 +1,85 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# In-memory k-mer index of nucleotide sequences, used to find stored sequences that contain, or are contained in,
+# a query sequence without testing every stored sequence.
+#
+# Two seeds are kept for each stored sequence:
+# - its first k-mer. If the stored sequence is contained in the query, this k-mer occurs somewhere in the query.
+# - every step'th k-mer. If the query is contained in the stored sequence, one of the query's first step k-mers
+#   starts at a sampled position of the stored sequence.
+#
+# Lookups return candidates only: callers must confirm containment with their own test.
+
+from collections import defaultdict
+
+KMER_LEN = 12
+KMER_STEP = 4
+
+
+class ContainmentIndex:
+    def __init__(self, k=KMER_LEN, step=KMER_STEP):
+        self.k = k
+        self.step = step
+        self.sequences = {}
+        self.prefixes = defaultdict(set)
+        self.sampled = defaultdict(set)
+        self.short = set()
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def add(self, key, seq):
+        if key in self.sequences:
+            self.remove(key)
+
+        self.sequences[key] = seq
+
+        if len(seq) < self.k:
+            self.short.add(key)
+            return
+
+        self.prefixes[seq[:self.k]].add(key)
+        for i in range(0, len(seq) - self.k + 1, self.step):
+            self.sampled[seq[i:i + self.k]].add(key)
+
+    def remove(self, key):
+        seq = self.sequences.pop(key, None)
+        if seq is None:
+            return
+
+        if len(seq) < self.k:
+            self.short.discard(key)
+            return
+
+        self.prefixes[seq[:self.k]].discard(key)
+        for i in range(0, len(seq) - self.k + 1, self.step):
+            self.sampled[seq[i:i + self.k]].discard(key)
+
+    # Keys of stored sequences that may contain, or be contained in, the query
+
+    def candidates(self, query):
+        if len(query) < self.k + self.step - 1:
+            return set(self.sequences.keys())      # too short to seed: every stored sequence is a candidate
+
+        res = set(self.short)
+
+        for i in range(len(query) - self.k + 1):
+            kmer = query[i:i + self.k]
+            if kmer in self.prefixes:
+                res.update(self.prefixes[kmer])
+
+        for j in range(self.step):
+            kmer = query[j:j + self.k]
+            if kmer in self.sampled:
+                res.update(self.sampled[kmer])
+
+        return res
+
+    # Keys of stored sequences that contain, or are contained in, the query
+
+    def find_containing(self, query):
+        return [key for key in self.candidates(query) if self.sequences[key] in query or query in self.sequences[key]]
@@ -0,0 +1,78 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Fixtures shared by the tests
+#
+# The tests run against an application with an SQLite database and no blueprints or routes, so that the models and
+# the modules under test can be exercised without the site's configuration. Run them from the repository root with
+# 'python -m pytest tests'
+
+import atexit
+import importlib
+import os
+import pkgutil
+import shutil
+import sys
+import tempfile
+
+import pytest
+from flask import Flask
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+import head
+
+
+# Modules under test take head.app when they are imported, so the application is made before any test module is
+# collected, and shared by the session
+
+def create_test_app(path):
+    app = Flask('ogrdb_test', template_folder=os.path.join(REPO_PATH, 'templates'))
+    app.config.update(
+        TESTING=True,
+        SECRET_KEY='test',
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(path, 'ogrdb.db'),
+        MAIL_DEFAULT_SENDER='ogrdb@example.com',
+        MAIL_SUPPRESS_SEND=False,
+        MAIL_LOG_BODY=False,
+        HTTP_CACHE_PATH=os.path.join(path, 'http_cache'),
+        VDJBASE_NOVEL_FILE=os.path.join(path, 'vdjbase_novels.json'),
+    )
+
+    head.app = app
+    head.attach_path = path
+
+    head.db.init_app(app)
+    head.mail.init_app(app)
+
+    import db
+    for module in pkgutil.iter_modules(db.__path__):
+        if module.name.endswith('_db') and not module.name.startswith('_'):
+            importlib.import_module('db.' + module.name)
+
+    return app
+
+
+test_path = tempfile.mkdtemp(prefix='ogrdb_test_')
+atexit.register(shutil.rmtree, test_path, ignore_errors=True)
+test_app = create_test_app(test_path)
+
+
+@pytest.fixture(scope='session')
+def app():
+    return test_app
+
+
+# An application context with empty tables
+
+@pytest.fixture
+def app_context(app):
+    with app.app_context():
+        head.db.create_all()
+        yield app
+        head.db.session.remove()
+        head.db.drop_all()
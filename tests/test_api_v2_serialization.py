@@ -0,0 +1,127 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Tests that trusted serialization of API v2 germline sets gives the same output as building the models by hand
+
+import copy
+
+from api_v2.api import allele_description_json, convert_to_GermlineSetResponse_obj, fill_missing_required_fields
+from api_v2.models import License, RearrangedSequence
+
+
+def acknowledgement(ack_id):
+    return {'acknowledgement_id': ack_id, 'name': 'A. Person', 'institution_name': 'A University', 'ORCID_id': '0000-0001-2345-6789'}
+
+
+def allele_description(**kwargs):
+    record = {
+        'allele_description_id': 'OGRDB:A0001',
+        'allele_description_ref': 'OGRDB:Homo sapiens:IGHV1-2*02.1',
+        'maintainer': 'A. Person',
+        'acknowledgements': [acknowledgement('1')],
+        'lab_address': 'A University',
+        'release_version': 1,
+        'release_date': '02-Feb-2021',
+        'release_description': 'First release',
+        'label': 'IGHV1-2*02',
+        'sequence': 'caggtgcagctggtg',
+        'coding_sequence': 'caggtgcagctggtg',
+        'ext_3prime': None,
+        'aliases': ['IGHV1-2*02'],
+        'locus': 'IGH',
+        'chromosome': 14,
+        'sequence_type': 'V',
+        'functional': True,
+        'inference_type': 'Genomic and rearranged',
+        'species': {'id': 'NCBITAXON:9606', 'label': 'Homo sapiens'},
+        'species_subgroup': None,
+        'species_subgroup_type': None,
+        'status': 'active',
+        'gene_designation': '2',
+        'subgroup_designation': '1',
+        'allele_designation': '02',
+        'allele_similarity_cluster_designation': None,
+        'allele_similarity_cluster_member_id': None,
+        'gene_start': 1,
+        'gene_end': 15,
+        'utr_5_prime_start': None,
+        'utr_5_prime_end': None,
+        'leader_1_start': None,
+        'leader_1_end': None,
+        'leader_2_start': None,
+        'leader_2_end': None,
+        'v_rs_start': None,
+        'v_rs_end': None,
+        'v_gene_delineations': [{
+            'sequence_delineation_id': '1',
+            'delineation_scheme': 'IMGT',
+            'unaligned_sequence': 'caggtgcagctggtg',
+            'aligned_sequence': 'caggtgcagctggtg',
+            'fwr1_start': 1, 'fwr1_end': 3, 'cdr1_start': 4, 'cdr1_end': 6, 'fwr2_start': 7, 'fwr2_end': 9,
+            'cdr2_start': 10, 'cdr2_end': 12, 'fwr3_start': 13, 'fwr3_end': None, 'cdr3_start': None,
+            'alignment_labels': ['1', '2', '3'],
+        }],
+        'unrearranged_support': [{
+            'sequence_id': '5', 'sequence': 'caggtgcagctggtg', 'repository_name': 'GenBank', 'repository_ref': 'MN000001',
+            'patch_no': None, 'gff_seqid': None, 'gff_start': 1, 'gff_end': 15, 'strand': None,
+        }],
+        'rearranged_support': [{
+            'sequence_id': '7', 'sequence': 'caggtgcagctggtg', 'derivation': None, 'observation_type': 'inference from repertoire',
+            'repository_name': 'SRA', 'repository_ref': 'SRR000001', 'deposited_version': None, 'sequence_start': 1, 'sequence_end': 15,
+        }],
+        'paralogs': None,
+        'curation': 'Notes on the sequence',
+        'curational_tags': ['likely_full_length', None],
+    }
+    record.update(kwargs)
+    return record
+
+
+def germline_set(allele_descriptions):
+    return {'GermlineSet': [{
+        'germline_set_id': 'OGRDB:G00001',
+        'author': 'A. Person',
+        'lab_name': 'A Lab',
+        'lab_address': 'A University',
+        'acknowledgements': [acknowledgement('2'), acknowledgement('3')],
+        'release_version': 2,
+        'release_description': 'Second release',
+        'release_date': '2021-02-02',
+        'germline_set_name': 'IGH_VDJ',
+        'germline_set_ref': 'OGRDB:Homo sapiens_IGH:IGH_VDJ.2',
+        'pub_ids': 'PMID:12345',
+        'species': {'id': 'NCBITAXON:9606', 'label': 'Homo sapiens'},
+        'species_subgroup': None,
+        'species_subgroup_type': None,
+        'locus': 'IGH',
+        'allele_descriptions': allele_descriptions,
+        'curation': None,
+    }]}
+
+
+def test_trusted_allele_description_matches():
+    variants = [
+        allele_description(),
+        allele_description(acknowledgements=[], inference_type='None', v_gene_delineations=None, unrearranged_support=None,
+                           rearranged_support=[], curational_tags=None, sequence=None, curation=None),
+    ]
+
+    for record in variants:
+        assert allele_description_json(copy.deepcopy(record), True) == allele_description_json(copy.deepcopy(record), False)
+
+
+def test_trusted_germline_set_matches():
+    for allele_descriptions in (None, [allele_description(), allele_description(label='IGHV1-2*04', curation=None)]):
+        record = germline_set(allele_descriptions)
+        trusted = convert_to_GermlineSetResponse_obj(copy.deepcopy(record), True).model_dump_json(by_alias=True)
+        assert trusted == convert_to_GermlineSetResponse_obj(copy.deepcopy(record), False).model_dump_json(by_alias=True)
+
+
+def test_fill_missing_required_fields_for_any_model():
+    filled = fill_missing_required_fields(RearrangedSequence, {'sequence': None, 'observation_type': None, 'curation': None})
+    assert filled == {'sequence': '', 'observation_type': 'direct_sequencing', 'curation': None}
+
+    assert fill_missing_required_fields(License, {'name': None, 'url': None}) == {'name': '', 'url': None}
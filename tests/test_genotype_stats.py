@@ -0,0 +1,94 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Tests of the genotype statistics report, calculated from a prepared statistics set
+
+import csv
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pytest
+
+import genotype_stats
+import head
+from db.misc_db import GenotypeStatsSet, GenotypeStatsColumn, GenotypeStatsRow
+from genotype_stats import generate_stats
+
+REFERENCE_GENES = {'Homo sapiens': {'IGHV1-2*02': 'cag', 'IGHV1-2*04': 'cag', 'IGHV3-23*01': 'gag', 'IGKV1-5*01': 'gac'}}
+
+
+@pytest.fixture
+def stats_set(app_context, monkeypatch):
+    monkeypatch.setattr(genotype_stats, 'get_imgt_reference_genes', lambda: REFERENCE_GENES)
+
+    stats_set = GenotypeStatsSet(species='Homo sapiens', locus='IGH', sequence_type='V')
+    head.db.session.add(stats_set)
+    head.db.session.flush()
+
+    columns = []
+    for position, name in enumerate(['S00001/first', 'S00002/second']):
+        column = GenotypeStatsColumn(set_id=stats_set.id, genotype_description_id=position + 1, name=name, position=position)
+        head.db.session.add(column)
+        columns.append(column)
+    head.db.session.flush()
+
+    genotype_id = 0
+
+    def add_row(column, sequence_id, unmutated_frequency):
+        nonlocal genotype_id
+        genotype_id += 1
+        head.db.session.add(GenotypeStatsRow(set_id=stats_set.id, column_id=column.id, genotype_id=genotype_id, sequence_id=sequence_id,
+                                             allelic_percentage=Decimal('50'), assigned_unmutated_frequency=Decimal('90'),
+                                             unmutated_frequency=Decimal(unmutated_frequency)))
+
+    add_row(columns[0], 'IGHV1-2*02', '10')
+    add_row(columns[0], 'ighv1-2*02', '50')
+    add_row(columns[0], 'IGHV3-23*01', '3')
+    add_row(columns[1], 'IGHV1-2*02 ', '50')
+    add_row(columns[1], 'IGHV1-2*02', '20')
+    add_row(columns[1], 'IGHV3-23*01', '1')
+    head.db.session.commit()
+
+    return stats_set
+
+
+def stats_form(**kwargs):
+    values = dict(species='Homo sapiens', locus='IGH', sequence_type='V', freq_threshold=Decimal('5'), rare_genes='IGHV3-23',
+                  rare_threshold=Decimal('2'), very_rare_genes='IGHV1-2*04', very_rare_threshold=Decimal('0.5'),
+                  allelic_threshold=Decimal('20'), assigned_unmutated_threshold=Decimal('20'))
+    values.update(kwargs)
+    return SimpleNamespace(**{name: SimpleNamespace(data=value, errors=[]) for name, value in values.items()})
+
+
+def test_stats_count_exact_sequence_ids(stats_set):
+    count, stats, raw = generate_stats(stats_form())
+
+    assert count == 2
+    stats = {stat['gene']: stat for stat in stats}
+    assert list(stats.keys()) == ['IGHV1-2*02', 'IGHV1-2*04', 'IGHV3-23*01']
+
+    # the lower-case and space-padded sequence ids don't count towards IGHV1-2*02
+
+    assert stats['IGHV1-2*02']['occurrences'] == 2
+    assert stats['IGHV1-2*02']['unmutated_freq'] == 15
+    assert stats['IGHV1-2*04']['occurrences'] == 0
+
+    # IGHV3-23*01 is rare, so only the genotype above the rare threshold counts
+
+    assert stats['IGHV3-23*01']['occurrences'] == 1
+    assert stats['IGHV3-23*01']['unmutated_freq'] == 3
+
+    rows = {row['gene']: row for row in csv.DictReader(raw.getvalue().splitlines())}
+    assert Decimal(rows['IGHV1-2*02']['S00001/first']) == 10
+    assert Decimal(rows['IGHV1-2*02']['S00002/second']) == 20
+
+
+def test_stats_reject_unknown_genes(stats_set):
+    form = stats_form(rare_genes='ighv3-23')
+    count, stats, raw = generate_stats(form)
+
+    assert count == 0
+    assert form.rare_genes.errors == ['Gene(s) ighv3-23 not found in IMGT reference database']
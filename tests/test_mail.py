@@ -0,0 +1,190 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Tests of the mail dispatcher against a local stub SMTP server
+
+from datetime import datetime, timedelta
+import json
+import socket
+import socketserver
+import threading
+
+import pytest
+from sqlalchemy import update
+
+import head
+from db.misc_db import MailOutbox
+from db.userdb import Role, User
+from mail import MailDispatcher
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        envelope = None
+        self.reply('220 stub ESMTP')
+
+        while True:
+            line = self.rfile.readline().decode('utf-8')
+            if not line:
+                return
+
+            command = line.strip().upper()
+
+            if command.startswith('EHLO') or command.startswith('HELO'):
+                self.reply('250 stub')
+            elif command.startswith('MAIL FROM:'):
+                envelope = {'sender': line.strip()[10:].strip('<> '), 'recipients': [], 'data': ''}
+                self.reply('250 OK')
+            elif command.startswith('RCPT TO:'):
+                envelope['recipients'].append(line.strip()[8:].strip('<> '))
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    line = self.rfile.readline().decode('utf-8')
+                    if line in ('.\r\n', '.\n', ''):
+                        break
+                    data.append(line)
+                envelope['data'] = ''.join(data)
+                self.server.received.append(envelope)
+                self.reply('250 OK')
+            elif command == 'RSET' or command == 'NOOP':
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubSMTPHandler)
+        self.received = []
+
+
+@pytest.fixture
+def smtp_server(app_context):
+    server = StubSMTPServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    point_mail_at(app_context, server.server_address[1])
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def point_mail_at(app, port):
+    app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=port, MAIL_USE_TLS=False, MAIL_USE_SSL=False,
+                      MAIL_USERNAME=None, MAIL_PASSWORD=None, MAIL_SEND_INTERVAL=0)
+    head.mail.init_app(app)
+
+
+def queue_message(subject, recipients):
+    message = MailOutbox(subject=subject, sender='ogrdb@example.com', recipients=json.dumps(recipients), body='body of %s' % subject,
+                         html='<p>%s</p>' % subject, status='pending', attempts=0, created=datetime.utcnow())
+    head.db.session.add(message)
+    head.db.session.commit()
+    return message.id
+
+
+def add_user(email, roles=(), active=True):
+    user = User(email=email, name=email, active=active, fs_uniquifier=email)
+    for role_name in roles:
+        role = head.db.session.query(Role).filter(Role.name == role_name).one_or_none()
+        if role is None:
+            role = Role(name=role_name)
+            head.db.session.add(role)
+        user.roles.append(role)
+    head.db.session.add(user)
+    head.db.session.commit()
+
+
+def outbox_status(message_id):
+    head.db.session.expire_all()
+    return head.db.session.query(MailOutbox).filter(MailOutbox.id == message_id).one()
+
+
+def test_dispatch_expands_roles(app_context, smtp_server):
+    add_user('chair@example.com', roles=['Human'])
+    add_user('member@example.com', roles=['Human'])
+    add_user('retired@example.com', roles=['Human'], active=False)
+    first = queue_message('First', ['Human', 'submitter@example.com', 'chair@example.com'])
+    second = queue_message('Second', ['submitter@example.com'])
+
+    MailDispatcher(app_context).dispatch()
+
+    assert len(smtp_server.received) == 2
+    assert 'Subject: First' in smtp_server.received[0]['data']
+    assert sorted(smtp_server.received[0]['recipients']) == ['chair@example.com', 'member@example.com', 'submitter@example.com']
+    assert smtp_server.received[1]['recipients'] == ['submitter@example.com']
+
+    for message_id in (first, second):
+        message = outbox_status(message_id)
+        assert message.status == 'sent'
+        assert message.sent is not None
+
+
+def test_dispatch_sends_claimed_message_once(app_context, smtp_server):
+    first = queue_message('First', ['a@example.com'])
+    second = queue_message('Second', ['b@example.com'])
+
+    dispatcher = MailDispatcher(app_context)
+    other_claim = datetime.utcnow().replace(microsecond=0) + timedelta(seconds=1)
+    claim = dispatcher.claim
+
+    # Once the batch is claimed, another process takes over the second message, as it would if our claim had lapsed
+
+    def claim_and_lose_second():
+        messages, claims = claim()
+        with head.db.engine.begin() as conn:
+            conn.execute(update(MailOutbox).where(MailOutbox.id == second).values(claimed=other_claim))
+        return messages, claims
+
+    dispatcher.claim = claim_and_lose_second
+    dispatcher.dispatch()
+
+    assert [envelope['recipients'] for envelope in smtp_server.received] == [['a@example.com']]
+    assert outbox_status(first).status == 'sent'
+
+    message = outbox_status(second)
+    assert message.status == 'sending'
+    assert message.claimed == other_claim
+
+
+def test_dispatch_reclaims_stale_message(app_context, smtp_server):
+    message_id = queue_message('Stale', ['a@example.com'])
+    with head.db.engine.begin() as conn:
+        conn.execute(update(MailOutbox).where(MailOutbox.id == message_id).values(status='sending', claimed=datetime.utcnow() - timedelta(days=1)))
+
+    MailDispatcher(app_context).dispatch()
+
+    assert [envelope['recipients'] for envelope in smtp_server.received] == [['a@example.com']]
+    assert outbox_status(message_id).status == 'sent'
+
+
+def test_dispatch_requeues_when_server_unavailable(app_context):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    point_mail_at(app_context, port)
+    message_id = queue_message('Unsent', ['a@example.com'])
+
+    MailDispatcher(app_context).dispatch()
+
+    message = outbox_status(message_id)
+    assert message.status == 'pending'
+    assert message.sent is None
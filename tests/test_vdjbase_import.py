@@ -0,0 +1,167 @@
+# Copyright William Lees
+#
+# This source code, and any executable file compiled or derived from it, is governed by the European Union Public License v. 1.2,
+# the English version of which is available here: https://perma.cc/DK5U-NDVE
+#
+
+# Tests of the VDJbase import against a local stub VDJbase server
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+
+import pytest
+
+import head
+from db.misc_db import Committee
+from db.notes_entry_db import NotesEntry
+from db.novel_vdjbase_db import NovelVdjbase
+from db.species_lookup_db import SpeciesLookup
+from db.vdjbase import import_from_vdjbase
+
+API_PATH = '/api/'
+
+
+class StubVdjbaseHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path[len(API_PATH):] if self.path.startswith(API_PATH) else None
+        body = self.server.responses.get(path)
+
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def vdjbase_server(app_context):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubVdjbaseHandler)
+    server.daemon_threads = True
+    server.responses = {
+        'repseq/species': ['Human'],
+        'repseq/ref_seqs/Human': [{'dataset': 'IGH'}, {'dataset': 'IGK'}],
+        'repseq/all_novels': {'Human': {'IGH': {}}},
+        'repseq/novels/Human/IGH': {},
+    }
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    app_context.config['VDJBASE_API'] = 'http://127.0.0.1:%d%s' % (server.server_address[1], API_PATH)
+    app_context.config['VDJBASE_WORKERS'] = 2
+
+    head.db.session.add(SpeciesLookup(binomial='Homo sapiens', common='Human', ncbi_taxon_id=9606))
+    head.db.session.add(Committee(committee='Human', species='Homo sapiens', loci='IGH', sequence_types='V'))
+    head.db.session.commit()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def novel(name, subject_count, sequence):
+    return {'name': name, 'subject_count': subject_count, 'j_haplotypes': 1, 'd_haplotypes': 0, 'hetero_alleleic_j_haplotypes': 1,
+            'example': 'P1_I1_S1', 'sequence': sequence}
+
+
+def set_novels(server, *novels):
+    server.responses['repseq/novels/Human/IGH'] = {n['name']: n for n in novels}
+
+
+def novel_records():
+    head.db.session.expire_all()
+    records = {}
+    for rec in head.db.session.query(NovelVdjbase).filter(NovelVdjbase.species == 'Homo sapiens', NovelVdjbase.locus == 'IGH'):
+        notes = head.db.session.query(NotesEntry.notes_text).filter(NotesEntry.novel_vdjbase_id == rec.id).order_by(NotesEntry.id).all()
+        records[rec.vdjbase_name] = (rec, [n[0] for n in notes])
+    return records
+
+
+def test_import_tracks_novels(vdjbase_server):
+    first = novel('IGHV1-2*02_a1b2', 10, 'caggtgcagctggtg')
+    second = novel('IGHV3-23*01_c3d4', 4, 'gaggtgcagctgttg')
+    third = novel('IGHV4-34*01_e5f6', 2, 'caggtgcagctacag')
+
+    # Add
+
+    set_novels(vdjbase_server, first, second)
+    assert import_from_vdjbase() == 'Import complete'
+
+    records = novel_records()
+    assert sorted(records.keys()) == [first['name'], second['name']]
+
+    for name, source in ((first['name'], first), (second['name'], second)):
+        rec, notes = records[name]
+        assert rec.status == 'not reviewed'
+        assert rec.subject_count == source['subject_count']
+        assert rec.sequence == source['sequence']
+        assert rec.first_seen is not None and rec.last_seen is not None
+        assert notes == ['']
+
+    # Change the first, drop the second and add a third
+
+    changed = dict(first, subject_count=12)
+    set_novels(vdjbase_server, changed, third)
+    import_from_vdjbase()
+
+    records = novel_records()
+    assert sorted(records.keys()) == [first['name'], second['name'], third['name']]
+
+    rec, notes = records[first['name']]
+    assert rec.status == 'modified'
+    assert rec.subject_count == 12
+    assert len(notes) == 1
+    assert re.fullmatch(r'\rfields changed at .+: subject_count\rPrevious status: not reviewed', notes[0])
+
+    rec, notes = records[second['name']]
+    assert rec.status == 'not current'
+    assert rec.subject_count == second['subject_count']
+    assert len(notes) == 1
+    assert re.fullmatch(r'\rNo longer seen in VDJbase at .+', notes[0])
+
+    rec, notes = records[third['name']]
+    assert rec.status == 'not reviewed'
+    assert notes == ['']
+
+    # The second reappears, unchanged: the others are as before
+
+    set_novels(vdjbase_server, changed, second, third)
+    import_from_vdjbase()
+
+    records = novel_records()
+
+    rec, notes = records[second['name']]
+    assert rec.status == 'not reviewed'
+    assert re.fullmatch(r'\rNo longer seen in VDJbase at .+\rPresent again in VDJbase at .+', notes[0])
+
+    rec, notes = records[first['name']]
+    assert rec.status == 'modified'
+    assert notes[0].count('fields changed') == 1
+
+    rec, notes = records[third['name']]
+    assert rec.status == 'not reviewed'
+    assert notes == ['']
+
+
+def test_import_keeps_records_when_vdjbase_unavailable(vdjbase_server):
+    set_novels(vdjbase_server, novel('IGHV1-2*02_a1b2', 10, 'caggtgcagctggtg'))
+    import_from_vdjbase()
+
+    del vdjbase_server.responses['repseq/novels/Human/IGH']
+    import_from_vdjbase()
+
+    records = novel_records()
+    rec, notes = records['IGHV1-2*02_a1b2']
+    assert rec.status == 'not reviewed'
+    assert notes == ['']
@@ -6,3 +6,4 @@ module load python3
 cd /l_mnt/as14/d/website/ogrdb.airr-community.org/ogre
 python imgt/track_imgt_ref.py imgt/track_imgt_config.yaml
 
+python imgt/ref_store.py imgt/track_imgt_config.yaml